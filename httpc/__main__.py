@@ -1,6 +1,12 @@
 """Executes the httpc program."""
 import argparse
-from requests import GET, POST
+import json
+import sys
+from urllib.parse import urljoin
+import bench
+from cache import Cache
+from fetch import Fetcher, read_jobs
+from requests import GET, POST, set_cache, get_cache
 
 
 def execute_get(args):
@@ -13,13 +19,22 @@ def execute_get(args):
     headers = dict(kv.split(":") for kv in args.headers)
     url = args.url
     while True:
-        response = GET(url, headers=headers)
-        print(response if args.verbose else response.body)
+        response = GET(url, headers=headers, stream=args.output is not None)
+        if args.output is None:
+            print(response if args.verbose else response.body)
+        elif args.verbose:
+            print(response.preamble())
         if response.code == 301 or response.code == 302:
-            url = response.headers['Location'].strip()
+            response.close()
+            url = urljoin(url, response.headers['Location'].strip())
             print('Redirecting to new url: {}'.format(url))
         else:
             break
+    if args.output is not None:
+        # Write the body as it is received, it is never held in memory.
+        with open(args.output, mode="wb") as f:
+            for chunk in response.iter_content():
+                f.write(chunk)
 
 
 
@@ -44,22 +59,90 @@ def execute_post(args):
         response = POST(url, data=data, headers=headers)
         print(response if args.verbose else response.body)
         if response.code == 301 or response.code == 302:
-            url = response.headers['Location'].strip()
+            url = urljoin(url, response.headers['Location'].strip())
             print('Redirecting to new url: {}'.format(url))
         else:
             break
 
 
+def execute_fetch(args):
+    """Fetch the URLs listed in a file or on standard input concurrently and
+    print a summary of the run.
+
+    Args:
+        args: Argparse argument object.
+    """
+    if args.file:
+        with open(args.file, mode="r") as f:
+            jobs = read_jobs(f)
+    else:
+        jobs = read_jobs(sys.stdin)
+
+    headers = dict(kv.split(":") for kv in args.headers)
+    fetcher = Fetcher(concurrency=args.concurrency, per_host=args.per_host,
+                      retries=args.retries, backoff=args.backoff,
+                      timeout=args.timeout, headers=headers,
+                      verbose=args.verbose, cache=get_cache())
+    summary = fetcher.run(jobs)
+    for url, error in summary.errors:
+        print("Failed {}: {}".format(url, error), file=sys.stderr)
+    print(summary)
+    if summary.failed:
+        sys.exit(1)
+
+
+def execute_bench(args):
+    """Send the same request over concurrent connections and print the
+    throughput and the latency distribution.
+
+    Args:
+        args: Argparse argument object.
+    """
+    if args.file:
+        with open(args.file, mode="r") as f:
+            data = f.read()
+    else:
+        data = args.inline_data
+
+    headers = dict(kv.split(":") for kv in args.headers)
+    # Without a count or a duration, run for 10 seconds.
+    duration = args.duration or (None if args.requests else 10.0)
+    report = bench.run(args.url, method=args.method.upper(), data=data,
+                       headers=headers, requests=args.requests,
+                       duration=duration, concurrency=args.concurrency,
+                       timeout=args.timeout)
+    print(bench.format_report(report))
+    if args.json:
+        with open(args.json, mode="w") as f:
+            json.dump(report, f, indent=2)
+
+
 parser = argparse.ArgumentParser(
     description=
     "httpc is a curl-like application but supports HTTP protocol only.",
     add_help=False,
     epilog='Use "httpc help [command]" for more information about a command.')
+parser.add_argument(
+    "--cache",
+    help="Caches the responses to GET requests in a directory, honoring "
+    "Cache-Control and Expires, and revalidating the stale responses.",
+    metavar="directory",
+    dest="cache")
+parser.add_argument(
+    "--cache-size",
+    help="Maximum size in bytes of the files of the cache, the least recently "
+    "used responses are removed first. Default is 268435456.",
+    metavar="bytes",
+    type=int,
+    default=256 << 20,
+    dest="cache_size")
 subparsers = parser.add_subparsers(
     title="The commands are",
     help="""
 get executes a HTTP GET request and prints the response.
 post executes a HTTP POST request and prints the response.
+fetch executes HTTP GET requests for a list of URLs concurrently.
+bench sends the same HTTP request over concurrent connections.
 help prints this screen.""")
 
 get_parser = subparsers.add_parser(
@@ -79,6 +162,11 @@ get_parser.add_argument(
     action="append",
     default=[],
     dest="headers")
+get_parser.add_argument(
+    "-o",
+    help="Writes the body of the response to a file instead of printing it.",
+    metavar="file",
+    dest="output")
 get_parser.add_argument("url", help="The URL of the host.", metavar="URL")
 get_parser.set_defaults(func=execute_get)
 
@@ -113,12 +201,143 @@ data_group.add_argument(
 post_parser.add_argument("url", help="The URL of the host.", metavar="URL")
 post_parser.set_defaults(func=execute_post)
 
+fetch_parser = subparsers.add_parser(
+    "fetch",
+    description="Fetch executes HTTP GET requests for a list of URLs "
+    "concurrently, reusing the connections to each host. Each line of the "
+    "list is a URL, optionally followed by the file to write its body to. "
+    "Without a file the body is discarded.",
+    add_help=False)
+fetch_parser.add_argument(
+    "-v",
+    help="Prints the result of each URL.",
+    action="store_true",
+    dest="verbose")
+fetch_parser.add_argument(
+    "-h",
+    help="Associates headers to HTTP Request with the format 'key:value'.",
+    metavar="key:value",
+    action="append",
+    default=[],
+    dest="headers")
+fetch_parser.add_argument(
+    "-f",
+    help="Reads the list of URLs from a file instead of standard input.",
+    metavar="file",
+    dest="file")
+fetch_parser.add_argument(
+    "-c",
+    help="Number of URLs fetched at the same time. Default is 8.",
+    metavar="concurrency",
+    type=int,
+    default=8,
+    dest="concurrency")
+fetch_parser.add_argument(
+    "--per-host",
+    help="Maximum number of requests in flight to a host. Default is 4.",
+    metavar="connections",
+    type=int,
+    default=4,
+    dest="per_host")
+fetch_parser.add_argument(
+    "--retries",
+    help="Number of retries of a URL after a connection error or a 429 or "
+    "5xx response. Default is 3.",
+    metavar="count",
+    type=int,
+    default=3,
+    dest="retries")
+fetch_parser.add_argument(
+    "--backoff",
+    help="Seconds before the first retry, doubled at each retry. Default is "
+    "0.5.",
+    metavar="seconds",
+    type=float,
+    default=0.5,
+    dest="backoff")
+fetch_parser.add_argument(
+    "--timeout",
+    help="Socket timeout in seconds. Default is 30.",
+    metavar="seconds",
+    type=float,
+    default=30.0,
+    dest="timeout")
+fetch_parser.set_defaults(func=execute_fetch)
+
+bench_parser = subparsers.add_parser(
+    "bench",
+    description="Bench sends the same HTTP request over concurrent keep-alive "
+    "connections, for a number of requests or a duration, and prints the "
+    "throughput and the latency distribution.",
+    add_help=False)
+bench_parser.add_argument(
+    "-h",
+    help="Associates headers to HTTP Request with the format 'key:value'.",
+    metavar="key:value",
+    action="append",
+    default=[],
+    dest="headers")
+bench_parser.add_argument(
+    "-m",
+    help="Method of the requests. Default is GET.",
+    metavar="method",
+    default="GET",
+    dest="method")
+bench_body_group = bench_parser.add_mutually_exclusive_group()
+bench_body_group.add_argument(
+    "-d",
+    help="Associates an inline data to the body of the requests.",
+    metavar="inline-data",
+    dest="inline_data")
+bench_body_group.add_argument(
+    "-f",
+    help="Associates the content of a file to the body of the requests.",
+    metavar="file",
+    dest="file")
+bench_limit_group = bench_parser.add_mutually_exclusive_group()
+bench_limit_group.add_argument(
+    "-n",
+    help="Total number of requests.",
+    metavar="requests",
+    type=int,
+    dest="requests")
+bench_limit_group.add_argument(
+    "-t",
+    help="Seconds to send requests for. Default is 10 without -n.",
+    metavar="duration",
+    type=float,
+    dest="duration")
+bench_parser.add_argument(
+    "-c",
+    help="Number of concurrent connections. Default is 8.",
+    metavar="concurrency",
+    type=int,
+    default=8,
+    dest="concurrency")
+bench_parser.add_argument(
+    "--timeout",
+    help="Socket timeout in seconds. Default is 30.",
+    metavar="seconds",
+    type=float,
+    default=30.0,
+    dest="timeout")
+bench_parser.add_argument(
+    "--json",
+    help="Writes the report to a file as JSON.",
+    metavar="file",
+    dest="json")
+bench_parser.add_argument("url", help="The URL of the host.", metavar="URL")
+bench_parser.set_defaults(func=execute_bench)
+
 help_parser = subparsers.add_parser("help", add_help=False)
 help_parser.add_argument(
-    "command", choices=("get", "post"), nargs="?", metavar="command")
+    "command", choices=("get", "post", "fetch", "bench"), nargs="?",
+    metavar="command")
 parser.set_defaults(command=None)
 
 args = parser.parse_args()
+if args.cache:
+    set_cache(Cache(args.cache, args.cache_size))
 try:
     args.func(args)
 except AttributeError:
@@ -128,3 +347,7 @@ except AttributeError:
         get_parser.print_help()
     elif args.command == "post":
         post_parser.print_help()
+    elif args.command == "fetch":
+        fetch_parser.print_help()
+    elif args.command == "bench":
+        bench_parser.print_help()
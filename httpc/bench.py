@@ -0,0 +1,184 @@
+"""Load generator sending the same request over many connections.
+
+The request message is built once by the request construction of GET and
+POST. Each worker thread then owns one keep-alive connection, sends the
+prebuilt bytes and reads the response on it in a loop: no URL parsing, no
+header formatting and no Response object per request. The latencies are kept
+in a list per worker, sorted once at the end of the run.
+"""
+import itertools
+import time
+from threading import Thread
+from requests import Connection, _build_request, _read_body, _status_code
+
+# Upper bounds in milliseconds of the buckets of the latency histogram.
+HISTOGRAM_BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000,
+                     2000, 5000, 10000)
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class WorkerResult:
+    """Counts of a worker.
+
+    Attributes:
+        latencies (list): Latency in seconds of each successful exchange.
+        bytes (int): Bytes of the responses received.
+        errors (int): Connection errors, timeouts and malformed responses.
+        non_2xx (int): Responses with a status code other than 2xx.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.non_2xx = 0
+
+
+def run(url: str, method: str = "GET", data=None, headers=None,
+        requests: int = None, duration: float = None, concurrency: int = 8,
+        timeout: float = 30.0):
+    """Send requests until a count or a duration is reached and return the
+    report of the run.
+
+    Args:
+        url (str): The URL of the requests.
+        method (str): The request method. Default is GET.
+        data (str): Request body, None to send no body. Default is None.
+        headers (dict): Dictionary containing key-value pairs representing the
+            request headers. Default is None.
+        requests (int): Total number of requests to send.
+        duration (float): Seconds to send requests for, if requests is None.
+        concurrency (int): Number of connections. Default is 8.
+        timeout (float): Socket timeout in seconds. Default is 30.
+
+    Returns:
+        dict: The report of the run, see report.
+    """
+    host, port, message = _build_request(method, url, data, headers)
+    if requests is not None:
+        counter = itertools.count()
+        stop = lambda: next(counter) >= requests
+    else:
+        deadline = time.perf_counter() + duration
+        stop = lambda: time.perf_counter() >= deadline
+
+    results = [WorkerResult() for _ in range(concurrency)]
+    workers = [Thread(target=_work, args=(host, port, method, message, timeout,
+                                          stop, result), daemon=True)
+               for result in results]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return report(results, elapsed, url=url, method=method,
+                  concurrency=concurrency)
+
+
+def _work(host: str, port: int, method: str, message: bytes, timeout: float,
+          stop, result: WorkerResult):
+    """Send the request in a loop until stop returns True."""
+    perf_counter = time.perf_counter
+    record = result.latencies.append
+    connection = None
+    while not stop():
+        start = perf_counter()
+        try:
+            if connection is None:
+                connection = Connection(host, port, timeout)
+            connection.sock.sendall(message)
+            head = connection.read_head()
+            chunks, keep_alive = _read_body(connection, method, head)
+            size = len(head) + 4
+            for chunk in chunks:
+                size += len(chunk)
+            code = _status_code(head)
+        except Exception:
+            # Connection errors, timeouts and malformed responses; the
+            # connection is not reused after any of them.
+            result.errors += 1
+            if connection is not None:
+                connection.close()
+                connection = None
+            continue
+        record(perf_counter() - start)
+        result.bytes += size
+        if not 200 <= code < 300:
+            result.non_2xx += 1
+        if not keep_alive:
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+
+
+def report(results: list, elapsed: float, **config):
+    """Return the report of a run from the results of its workers.
+
+    Returns:
+        dict: The configuration of the run, the counts, the rates, the
+            latencies in milliseconds and the histogram as a list of
+            [upper bound in milliseconds, count].
+    """
+    latencies = sorted(
+        latency for result in results for latency in result.latencies)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    histogram = [[bound, 0] for bound in HISTOGRAM_BUCKETS + (float("inf"),)]
+    bucket = 0
+    for latency in latencies:
+        while latency * 1000 > histogram[bucket][0]:
+            bucket += 1
+        histogram[bucket][1] += 1
+    count = len(latencies)
+    received = sum(result.bytes for result in results)
+    return dict(
+        config,
+        requests=count,
+        errors=sum(result.errors for result in results),
+        non_2xx=sum(result.non_2xx for result in results),
+        elapsed=round(elapsed, 3),
+        requests_per_second=round(count / elapsed, 1),
+        bytes_per_second=round(received / elapsed),
+        latency_ms=dict(
+            [("min", ms(latencies[0]) if latencies else None),
+             ("mean", ms(sum(latencies) / count) if latencies else None)] +
+            [("p{:g}".format(p), ms(_percentile(latencies, p))
+              if latencies else None) for p in PERCENTILES] +
+            [("max", ms(latencies[-1]) if latencies else None)]),
+        histogram=[[None if bound == float("inf") else bound, n]
+                   for bound, n in histogram],
+    )
+
+
+def format_report(report: dict):
+    """Return the report of a run as text."""
+    lines = [
+        "{} {} with {} connections, {:.2f} s".format(
+            report["method"], report["url"], report["concurrency"],
+            report["elapsed"]),
+        "Requests: {} ({} errors, {} non-2xx responses)".format(
+            report["requests"], report["errors"], report["non_2xx"]),
+        "Requests/sec: {:.1f}".format(report["requests_per_second"]),
+        "Transfer/sec: {:.2f} MB".format(report["bytes_per_second"] / 1e6),
+        "Latency (ms): " + "  ".join(
+            "{}={}".format(k, v) for k, v in report["latency_ms"].items()),
+        "Latency histogram:",
+    ]
+    counts = [n for _, n in report["histogram"]]
+    used = [i for i, n in enumerate(counts) if n]
+    peak = max(counts) or 1
+    for bound, n in report["histogram"][used[0]:used[-1] + 1] if used else ():
+        if bound is None:
+            label = "> {:g} ms".format(HISTOGRAM_BUCKETS[-1])
+        else:
+            label = "<= {:g} ms".format(bound)
+        lines.append("  {:>12} {:>9} {}".format(label, n,
+                                                "#" * (40 * n // peak)))
+    return "\n".join(lines)
+
+
+def _percentile(values: list, p: float):
+    """Nearest rank percentile of sorted values."""
+    return values[min(len(values) - 1,
+                      max(0, int(-(-p * len(values) // 100)) - 1))]
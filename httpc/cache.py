@@ -0,0 +1,432 @@
+"""Private HTTP cache of the responses to GET requests, stored on disk.
+
+Each response is stored as two files named by the sha256 of its URL: KEY.meta
+holds the URL, the head of the response and its freshness as JSON, and the
+body file it names holds the body. The index of the entries is kept in memory,
+in least recently used order, and rebuilt from the meta files when the cache is
+opened. The modification time of a meta file is its last use.
+
+A fresh entry is served without a request. A stale entry with an ETag or a
+Last-Modified date is revalidated: a 304 response refreshes the entry and its
+body is served from the cache. Permanent redirects are remembered and followed
+before sending the request. When the files of the cache grow past the byte
+budget, the least recently used entries are removed.
+"""
+import email.utils
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urljoin
+from requests import _parse_headers, _status_code
+
+# Status codes of the responses stored.
+CACHEABLE_CODES = (200, 203, 301, 308)
+PERMANENT_REDIRECT_CODES = (301, 308)
+# Lifetime in seconds of a response without an explicit one is a tenth of the
+# time since its modification, up to a day.
+MAX_HEURISTIC_LIFETIME = 86400
+MAX_REDIRECTS = 10
+BLOCK_SIZE = 65536
+
+
+class Entry:
+    """A stored response.
+
+    Attributes:
+        key (str): sha256 of the URL.
+        url (str): The URL of the request.
+        head (bytes): The status line and the headers of the response.
+        headers (dict): The headers of the response with lowercase names.
+        body (str): Name of the body file.
+        size (int): Bytes of the files of the entry.
+        stored (float): Time the response was generated by the host.
+        lifetime (float): Seconds the response is fresh for, None if forever.
+        vary (dict): Values of the request headers the response varies on.
+    """
+    __slots__ = ("key", "url", "head", "headers", "body", "size", "stored",
+                 "lifetime", "vary")
+
+    def __init__(self, key: str, meta: dict, size: int):
+        self.key = key
+        self.url = meta["url"]
+        self.head = meta["head"].encode("ISO-8859-1")
+        self.headers = _parse_headers(self.head)
+        self.body = meta["body"]
+        self.size = size
+        self.stored = meta["stored"]
+        self.lifetime = meta["lifetime"]
+        self.vary = meta["vary"]
+
+    @property
+    def code(self):
+        """int: The status code of the response."""
+        return _status_code(self.head)
+
+    def is_fresh(self, now: float = None):
+        """Return whether the response can be served without revalidation."""
+        if self.lifetime is None:
+            return True
+        return (now or time.time()) - self.stored < self.lifetime
+
+    def validators(self):
+        """Return the headers of a conditional request revalidating the
+        response.
+        """
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+    def meta(self):
+        """Return the content of the meta file."""
+        return {"url": self.url, "head": self.head.decode("ISO-8859-1"),
+                "body": self.body, "stored": self.stored,
+                "lifetime": self.lifetime, "vary": self.vary}
+
+
+class Cache:
+    """Stores the responses to GET requests in a directory.
+
+    Attributes:
+        directory (str): Directory of the files of the cache.
+        max_bytes (int): Byte budget of the files of the cache.
+        entries (OrderedDict): The entries by key, least recently used first.
+        total (int): Bytes of the files of the entries.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def resolve(self, url: str):
+        """Return the URL a URL is permanently redirected to, following the
+        remembered redirects.
+        """
+        for _ in range(MAX_REDIRECTS):
+            with self.lock:
+                entry = self.entries.get(_key(url))
+            if (entry is None or entry.url != url
+                    or entry.code not in PERMANENT_REDIRECT_CODES
+                    or "location" not in entry.headers
+                    or not entry.is_fresh()):
+                break
+            url = urljoin(url, entry.headers["location"])
+        return url
+
+    def lookup(self, url: str, headers=None):
+        """Return the entry of a request and an iterator over its body, or None
+        and None if the response is not stored.
+        """
+        if "no-store" in _request_directives(headers):
+            return None, None
+        key = _key(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.url != url:
+                return None, None
+            if any(_request_header(headers, name) != value
+                   for name, value in entry.vary.items()):
+                return None, None
+            self.entries.move_to_end(key)
+        try:
+            body = open(os.path.join(self.directory, entry.body), mode="rb")
+        except FileNotFoundError:
+            # Removed by another process sharing the directory.
+            self._remove(entry)
+            return None, None
+        try:
+            os.utime(self._meta_path(key))
+        except OSError:
+            pass
+        return entry, _iter_file(body)
+
+    def is_fresh(self, entry: Entry, headers=None):
+        """Return whether an entry can be served to a request without
+        revalidation.
+        """
+        directives = _request_directives(headers)
+        return (entry.is_fresh() and "no-cache" not in directives
+                and directives.get("max-age") != "0")
+
+    def store(self, url: str, headers, head: bytes, chunks):
+        """Return an iterator over the chunks of a response body that stores
+        the response once its body is read entirely.
+
+        Args:
+            url (str): The URL of the request.
+            headers (dict): The headers of the request.
+            head (bytes): The status line and the headers of the response.
+            chunks: Iterator over the chunks of the body.
+        """
+        if "no-store" in _request_directives(headers):
+            return chunks
+        code = _status_code(head)
+        response_headers = _parse_headers(head)
+        lifetime = _lifetime(code, response_headers)
+        vary = [name.strip().lower()
+                for name in response_headers.get("vary", "").split(",")
+                if name.strip()]
+        if (code not in CACHEABLE_CODES or lifetime is False or "*" in vary
+                or (lifetime == 0 and "etag" not in response_headers
+                    and "last-modified" not in response_headers)):
+            return chunks
+        meta = {
+            "url": url,
+            "head": head.decode("ISO-8859-1"),
+            "body": "{}-{}.body".format(_key(url), os.urandom(4).hex()),
+            "stored": _generated(response_headers),
+            "lifetime": lifetime,
+            "vary": {name: _request_header(headers, name) for name in vary},
+        }
+        return self._tee(meta, chunks)
+
+    def refresh(self, entry: Entry, head: bytes):
+        """Update a stored response with the headers of a 304 response
+        revalidating it, and return the updated entry.
+        """
+        head = _merge_head(entry.head, head)
+        response_headers = _parse_headers(head)
+        meta = entry.meta()
+        meta["head"] = head.decode("ISO-8859-1")
+        meta["stored"] = _generated(response_headers)
+        lifetime = _lifetime(entry.code, response_headers)
+        meta["lifetime"] = lifetime if lifetime is not False else 0
+        try:
+            return self._commit(meta, entry.size - self._meta_size(entry))
+        except OSError:
+            return entry
+
+    def invalidate(self, url: str):
+        """Remove the stored response of a URL, after an unsafe request."""
+        with self.lock:
+            entry = self.entries.get(_key(url))
+        if entry is not None:
+            self._remove(entry)
+
+    def _tee(self, meta: dict, chunks):
+        """Yield the chunks and write them to a temporary body file, committed
+        once all the chunks are read.
+        """
+        path = os.path.join(self.directory, meta["body"])
+        temp_path = path + ".tmp"
+        f = open(temp_path, mode="wb")
+        size = 0
+        complete = False
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        # Larger than the whole cache, it is not stored.
+                        f.close()
+                        f = None
+                        os.remove(temp_path)
+                    else:
+                        f.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            if f is not None:
+                f.close()
+                if not complete:
+                    _remove_file(temp_path)
+                else:
+                    try:
+                        os.replace(temp_path, path)
+                        self._commit(meta, size)
+                    except OSError:
+                        _remove_file(temp_path)
+                        _remove_file(path)
+
+    def _commit(self, meta: dict, body_size: int):
+        """Write the meta file of a response and add it to the index."""
+        key = _key(meta["url"])
+        data = json.dumps(meta).encode("UTF-8")
+        temp_path = self._meta_path(key) + ".tmp"
+        with open(temp_path, mode="wb") as f:
+            f.write(data)
+        os.replace(temp_path, self._meta_path(key))
+        entry = Entry(key, meta, body_size + len(data))
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            self.entries[key] = entry
+            self.total += entry.size - (previous.size if previous else 0)
+            evicted = self._evict()
+        if previous is not None and previous.body != entry.body:
+            _remove_file(os.path.join(self.directory, previous.body))
+        for old in evicted:
+            self._remove_files(old)
+        return entry
+
+    def _evict(self):
+        """Remove the least recently used entries from the index until the
+        cache fits its budget, and return them.
+        """
+        evicted = []
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.total -= entry.size
+            evicted.append(entry)
+        return evicted
+
+    def _remove(self, entry: Entry):
+        """Remove an entry from the index and its files."""
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                return
+            del self.entries[entry.key]
+            self.total -= entry.size
+        self._remove_files(entry)
+
+    def _remove_files(self, entry: Entry):
+        _remove_file(self._meta_path(entry.key))
+        _remove_file(os.path.join(self.directory, entry.body))
+
+    def _load(self):
+        """Build the index from the meta files, least recently used first."""
+        loaded = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".meta"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, mode="rb") as f:
+                    data = f.read()
+                meta = json.loads(data.decode("UTF-8"))
+                body_size = os.path.getsize(
+                    os.path.join(self.directory, meta["body"]))
+                entry = Entry(name[:-len(".meta")], meta,
+                              body_size + len(data))
+                loaded.append((os.path.getmtime(path), entry))
+            except (OSError, ValueError, KeyError):
+                # Incomplete entry, removed with its body if there is one.
+                _remove_file(path)
+        for _, entry in sorted(loaded, key=lambda item: item[0]):
+            self.entries[entry.key] = entry
+            self.total += entry.size
+        for old in self._evict():
+            self._remove_files(old)
+
+    def _meta_path(self, key: str):
+        return os.path.join(self.directory, key + ".meta")
+
+    def _meta_size(self, entry: Entry):
+        return len(json.dumps(entry.meta()).encode("UTF-8"))
+
+
+def _iter_file(f):
+    """Yield the content of an open file in blocks and close it."""
+    with f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def _request_directives(headers):
+    """Return the Cache-Control directives of a request."""
+    return _directives(_request_header(headers, "cache-control") or "")
+
+
+def _key(url: str):
+    return hashlib.sha256(url.encode("UTF-8")).hexdigest()
+
+
+def _directives(value: str):
+    """Return the directives of a Cache-Control header by lowercase name."""
+    directives = {}
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def _http_date(value: str):
+    """Return the timestamp of an HTTP date, None if it is invalid."""
+    try:
+        date = email.utils.parsedate_tz(value)
+        return email.utils.mktime_tz(date) if date else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _generated(headers: dict):
+    """Return the time a response was generated, from the Age header."""
+    try:
+        age = max(0, int(headers.get("age", 0)))
+    except ValueError:
+        age = 0
+    return time.time() - age
+
+
+def _lifetime(code: int, headers: dict):
+    """Return the freshness lifetime of a response in seconds, None if it
+    does not expire and False if it must not be stored.
+    """
+    directives = _directives(headers.get("cache-control", ""))
+    if "no-store" in directives:
+        return False
+    if "no-cache" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            return max(0, int(directives["max-age"]))
+        except ValueError:
+            return 0
+    date = _http_date(headers.get("date", "")) or time.time()
+    if "expires" in headers:
+        expires = _http_date(headers["expires"])
+        return max(0, expires - date) if expires is not None else 0
+    if code in PERMANENT_REDIRECT_CODES:
+        return None
+    last_modified = _http_date(headers.get("last-modified", ""))
+    if last_modified is not None:
+        return min(MAX_HEURISTIC_LIFETIME, max(0, date - last_modified) / 10)
+    return 0
+
+
+def _merge_head(head: bytes, update: bytes):
+    """Return a stored response head with the headers of a 304 response."""
+    status_line, *lines = head.split(b"\r\n")
+    updates = OrderedDict()
+    for line in update.split(b"\r\n")[1:]:
+        if b":" in line:
+            updates[line.split(b":", 1)[0].strip().lower()] = line
+    # The 304 does not describe the body.
+    for name in (b"content-length", b"transfer-encoding", b"content-encoding"):
+        updates.pop(name, None)
+    merged = [status_line]
+    for line in lines:
+        name = line.split(b":", 1)[0].strip().lower()
+        merged.append(updates.pop(name, line))
+    merged.extend(updates.values())
+    return b"\r\n".join(merged)
+
+
+def _request_header(headers, name: str):
+    """Return the value of a request header, whatever its case, None if it is
+    missing.
+    """
+    for k, v in (headers or {}).items():
+        if k.strip().lower() == name:
+            return v.strip()
+    return None
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,264 @@
+"""Fetches many URLs concurrently.
+
+The URLs are fetched by a pool of worker threads sharing one Session, so the
+connections to each host are reused from one URL to the next. The requests in
+flight to a host are limited: a worker takes the next URL of the first host
+below its limit, going round the hosts. A failed request is retried after an
+exponential backoff, during which its host slot and its worker are free to
+fetch other URLs.
+"""
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+from urllib.parse import urljoin, urlparse
+from requests import Session
+
+# Status codes of the responses retried as transient failures.
+RETRY_CODES = (429, 500, 502, 503, 504)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class Job:
+    """A URL to fetch.
+
+    Attributes:
+        url (str): The URL.
+        output (str): Path of the file to write the body to, None to discard
+            the body.
+        attempts (int): Number of times the URL was requested.
+        not_before (float): Monotonic time before which the job is not retried.
+    """
+    __slots__ = ("url", "output", "attempts", "not_before")
+
+    def __init__(self, url: str, output: str = None):
+        self.url = url
+        self.output = output
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class Summary:
+    """Results of a run.
+
+    Attributes:
+        succeeded (int): Number of URLs fetched.
+        failed (int): Number of URLs that failed after all their retries.
+        retries (int): Number of requests retried.
+        bytes (int): Number of body bytes received by the successful fetches.
+        elapsed (float): Duration of the run in seconds.
+        errors (list): The URLs that failed with their last error.
+    """
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.errors = []
+
+    def __str__(self):
+        """Return the summary line of the run."""
+        elapsed = self.elapsed or float("inf")
+        return ("{} succeeded, {} failed, {} retries, {} bytes in {:.2f} s "
+                "({:.1f} URLs/s, {:.2f} MB/s)").format(
+                    self.succeeded, self.failed, self.retries, self.bytes,
+                    self.elapsed, (self.succeeded + self.failed) / elapsed,
+                    self.bytes / elapsed / 1e6)
+
+
+class FetchError(Exception):
+    """A response that is not a success.
+
+    Attributes:
+        retry (bool): Whether the failure is transient.
+    """
+
+    def __init__(self, message: str, retry: bool = False):
+        super().__init__(message)
+        self.retry = retry
+
+
+def read_jobs(lines):
+    """Return the jobs of the lines of an input file.
+
+    Each line holds a URL, optionally followed by the path of the file to write
+    its body to. Empty lines and lines starting with # are skipped.
+    """
+    jobs = []
+    for line in lines:
+        fields = line.split(None, 1)
+        if not fields or fields[0].startswith("#"):
+            continue
+        jobs.append(Job(fields[0], fields[1].strip() if len(fields) > 1 else
+                        None))
+    return jobs
+
+
+class Fetcher:
+    """Fetches a list of URLs with a pool of worker threads.
+
+    Attributes:
+        concurrency (int): Number of worker threads.
+        per_host (int): Maximum number of requests in flight to a host.
+        retries (int): Maximum number of retries of a URL.
+        backoff (float): Delay in seconds before the first retry, doubled at
+            each following retry.
+        headers (dict): Headers of the requests.
+        verbose (bool): Print the result of each URL.
+        session (Session): The session sending the requests.
+    """
+
+    def __init__(self, concurrency: int = 8, per_host: int = 4,
+                 retries: int = 3, backoff: float = 0.5,
+                 timeout: float = 30.0, headers=None, verbose=False,
+                 cache=None):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers
+        self.verbose = verbose
+        self.session = Session(max_idle_per_host=per_host, timeout=timeout,
+                               cache=cache)
+        self.condition = Condition()
+        # Jobs waiting to run by host, the next host to serve first.
+        self.pending = OrderedDict()
+        # Requests in flight by host.
+        self.active = {}
+        # Jobs not finished, waiting or in flight.
+        self.remaining = 0
+        self.summary = Summary()
+
+    def run(self, jobs: list):
+        """Fetch the jobs and return the Summary of the run."""
+        start = time.monotonic()
+        for job in jobs:
+            self.pending.setdefault(_host(job.url), deque()).append(job)
+        self.remaining = len(jobs)
+        workers = [Thread(target=self._work, daemon=True)
+                   for _ in range(min(self.concurrency, len(jobs)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.session.close()
+        self.summary.elapsed = time.monotonic() - start
+        return self.summary
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            size, error, retry = 0, None, False
+            try:
+                size = self._fetch(job)
+            except FetchError as err:
+                error, retry = err, err.retry
+            except OSError as err:
+                error, retry = err, True
+            except Exception as err:
+                # A malformed response or a bug: the URL fails, the worker
+                # goes on, otherwise the run would never finish.
+                error = err
+            self._done(job, size, error, retry)
+
+    def _next(self):
+        """Return the next job to run, None once all the jobs are finished."""
+        with self.condition:
+            while self.remaining:
+                now = time.monotonic()
+                wait = None
+                for host, queue in self.pending.items():
+                    if self.active.get(host, 0) >= self.per_host:
+                        continue
+                    job = queue[0]
+                    if job.not_before > now:
+                        delay = job.not_before - now
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    queue.popleft()
+                    if queue:
+                        self.pending.move_to_end(host)
+                    else:
+                        del self.pending[host]
+                    self.active[host] = self.active.get(host, 0) + 1
+                    job.attempts += 1
+                    return job
+                self.condition.wait(wait)
+            return None
+
+    def _done(self, job: Job, size: int, error, retry: bool):
+        """Record the result of a job, or schedule its retry."""
+        host = _host(job.url)
+        with self.condition:
+            self.active[host] -= 1
+            if error is not None and retry and job.attempts <= self.retries:
+                delay = self.backoff * 2 ** (job.attempts - 1)
+                job.not_before = time.monotonic() + random.uniform(
+                    0.5 * delay, 1.5 * delay)
+                self.pending.setdefault(host, deque()).append(job)
+                self.summary.retries += 1
+            else:
+                self.remaining -= 1
+                if error is None:
+                    self.summary.succeeded += 1
+                    self.summary.bytes += size
+                else:
+                    self.summary.failed += 1
+                    self.summary.errors.append((job.url, str(error)))
+                if self.verbose:
+                    print("{} {}".format(job.url, error if error is not None
+                                         else "{} bytes".format(size)))
+            self.condition.notify_all()
+
+    def _fetch(self, job: Job):
+        """Fetch a URL, following its redirects, and return the size of its
+        body.
+        """
+        url = job.url
+        for _ in range(MAX_REDIRECTS + 1):
+            with self.session.get(url, headers=self.headers,
+                                  stream=True) as response:
+                location = _header(response, "location")
+                if response.code in REDIRECT_CODES and location:
+                    # Read the body to reuse the connection.
+                    response.content
+                    url = urljoin(url, location)
+                    continue
+                if not 200 <= response.code < 300:
+                    response.content
+                    raise FetchError("{} {}".format(response.code,
+                                                    response.status),
+                                     retry=response.code in RETRY_CODES)
+                size = 0
+                if job.output is None:
+                    for chunk in response.iter_content():
+                        size += len(chunk)
+                    return size
+                directory = os.path.dirname(job.output)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(job.output, mode="wb") as f:
+                    for chunk in response.iter_content():
+                        f.write(chunk)
+                        size += len(chunk)
+                return size
+        raise FetchError("Too many redirects")
+
+
+def _host(url: str):
+    """Return the host and port of a URL, the key of its connection limit."""
+    return urlparse(url).netloc.rpartition("@")[2].lower()
+
+
+def _header(response, name: str):
+    """Return the value of a response header, None if it is missing."""
+    for k, v in response.headers.items():
+        if k.strip().lower() == name:
+            return v.strip()
+    return None
@@ -1,39 +1,115 @@
-"""Implements GET and POST request methods."""
+"""Implements GET and POST request methods.
+
+Requests are sent over HTTP/1.1 by a Session, which keeps the connections to
+each host open and reuses them for the next requests to the same host. GET and
+POST are shortcuts using a default session shared by the program.
+"""
+import atexit
+import select
 import socket
+import time
+from threading import Lock
 from urllib.parse import urlparse
 
+BUFFER_SIZE = 65536
+
 
 class Response:
     """Represents an HTTP response message.
-    
+
+    The body is read from the connection when it is first accessed. A streamed
+    response is returned before its body is read, iter_content then yields the
+    body in chunks without keeping it in memory. The connection goes back to the
+    pool of the session once the body has been read entirely. A streamed
+    response should be closed if its body is not read to the end.
+
     Attributes:
         http_version (str): HTTP version.
         code (int): Status code.
         status (str): Description of status code.
         headers (dict): Collection of key value pairs representing the response
             headers.
-        body (str): The response body.
     """
 
-    def __init__(self, response: str):
-        """Parse the response string."""
-        # The first consecutive CRLF sequence demarcates the start of the
-        # entity-body.
-        preamble, self.body = response.split("\r\n\r\n", maxsplit=1)
-        status_line, *headers = preamble.split("\r\n")
+    def __init__(self, head: bytes, chunks=(), done=None):
+        """Parse the status line and the headers of the response.
+
+        Args:
+            head (bytes): The status line and the header lines.
+            chunks: Iterator over the chunks of the body.
+            done: Called once the body is read, with True if it was read
+                entirely and False if the response was closed before.
+        """
+        status_line, *headers = head.decode("ISO-8859-1").split("\r\n")
         self.http_version, code, *status = status_line.split()
         self.code = int(code)
         self.status = " ".join(status)
         map(_remove_whitespace, headers)
         self.headers = dict(kv.split(":", maxsplit=1) for kv in headers)
+        self._chunks = iter(chunks)
+        self._done = done
+        self._content = None
 
-    def __str__(self):
-        """Return a string representation of the response."""
+    @property
+    def content(self):
+        """bytes: The response body, read on first access."""
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    @property
+    def body(self):
+        """str: The response body decoded as UTF-8."""
+        return self.content.decode("UTF-8", errors="replace")
+
+    def iter_content(self):
+        """Yield the response body in chunks of bytes.
+
+        The body can only be iterated once, unless it was already read by
+        content.
+        """
+        if self._content is not None:
+            yield self._content
+            return
+        if self._chunks is None:
+            raise RuntimeError("The response body was already read")
+        chunks, self._chunks = self._chunks, None
+        try:
+            for chunk in chunks:
+                yield chunk
+        except BaseException:
+            self._finish(False)
+            raise
+        self._finish(True)
+
+    def close(self):
+        """Release the connection, closing it if the body was not read."""
+        if self._chunks is not None:
+            self._chunks = None
+            self._finish(False)
+
+    def preamble(self):
+        """Return the status line and the headers as a string."""
         status_line = "{} {} {}".format(self.http_version, self.code,
                                         self.status)
         headers = "\n".join(
             "{}: {}".format(k, v) for k, v in self.headers.items())
-        return "\n".join((status_line, headers, self.body))
+        return "\n".join((status_line, headers))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __str__(self):
+        """Return a string representation of the response."""
+        return "\n".join((self.preamble(), self.body))
+
+    def _finish(self, complete: bool):
+        done, self._done = self._done, None
+        if done:
+            done(complete)
 
 
 def _remove_whitespace(s: str):
@@ -41,102 +117,418 @@ def _remove_whitespace(s: str):
     return "".join(s.split())
 
 
-def _recvall(sock: socket.socket):
-    """Receive all data from the socket until EOF or close and return as a byte
-    string.
+class Connection:
+    """A connection to a host, reused for the next requests while both ends
+    keep it alive.
+
+    Attributes:
+        host (str): Host name.
+        port (int): Port of the host.
+        sock (socket.socket): The connected socket.
+        buffer (bytearray): Data received and not consumed yet.
+        idle_since (float): Monotonic time the connection was last released to
+            the pool.
     """
-    BUFFER_SIZE = 8192
-    response = b""
-    while True:
-        last_buff = sock.recv(BUFFER_SIZE, socket.MSG_WAITALL)
-        response += last_buff
-        if len(last_buff) < BUFFER_SIZE:
-            break
 
-    return response
+    def __init__(self, host: str, port: int, timeout: float = None):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = bytearray()
+        self.idle_since = time.monotonic()
 
+    def is_alive(self):
+        """Return whether a request can be sent on the idle connection.
 
-def GET(url: str, headers=None):
-    """Perform an HTTP GET request. Return response as a Response object.
+        An idle connection has nothing to read: if the socket is readable, the
+        host closed the connection or sent data that answers no request.
+        """
+        if self.buffer:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def read_head(self):
+        """Read the status line and the headers of a response.
+
+        Returns:
+            bytes: The status line and the header lines, without the empty line
+                ending them.
+        """
+        return self._read_until(b"\r\n\r\n")
+
+    def iter_length(self, length: int):
+        """Yield the next length bytes received, in chunks."""
+        while length > 0:
+            chunk = self._read_some(length)
+            length -= len(chunk)
+            yield chunk
+
+    def iter_chunked(self):
+        """Yield the data of a body sent with the chunked transfer coding."""
+        while True:
+            size = int(self._read_until(b"\r\n").split(b";", 1)[0], 16)
+            if size == 0:
+                break
+            yield from self.iter_length(size)
+            self._read_until(b"\r\n")
+        # Trailer fields, up to the empty line.
+        while self._read_until(b"\r\n"):
+            pass
+
+    def iter_until_close(self):
+        """Yield the data received until the host closes the connection.
+
+        Only the end of the stream ends the body: an error such as a reset
+        of the connection is raised, the body is incomplete.
+        """
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            yield data
+        while True:
+            data = self.sock.recv(BUFFER_SIZE)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        """Close the socket."""
+        self.sock.close()
+
+    def _read_some(self, size: int):
+        """Return up to size bytes, receiving them if none is buffered."""
+        if not self.buffer:
+            data = self.sock.recv(min(size, BUFFER_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed by the host")
+            return data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _read_until(self, delimiter: bytes):
+        """Return the data up to the delimiter and consume the delimiter."""
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(delimiter)]
+                return data
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            data = self.sock.recv(BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed by the host")
+            self.buffer += data
+
+
+class Session:
+    """Sends requests over HTTP/1.1, keeping a pool of idle connections per
+    host.
+
+    A connection goes back to the pool once its response has been read, unless
+    the host asked to close it. Before a pooled connection is reused, it is
+    checked with select: the host may have closed it while it was idle. If the
+    host closes a reused connection before answering, the request is sent again
+    on a new connection.
+
+    Attributes:
+        max_idle_per_host (int): Maximum number of idle connections kept open
+            per host, the oldest ones are closed first.
+        idle_timeout (float): Seconds after which an idle connection is closed
+            instead of being reused.
+        timeout (float): Socket timeout in seconds of the connections, None to
+            block.
+        cache (cache.Cache): Cache of the responses to GET requests, None to
+            send every request.
+    """
+
+    def __init__(self, max_idle_per_host: int = 4, idle_timeout: float = 30.0,
+                 timeout: float = None, cache=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.cache = cache
+        self.pools = {}
+        self.lock = Lock()
+
+    def request(self, method: str, url: str, data=None, headers=None,
+                stream=False):
+        """Perform an HTTP request. Return response as a Response object.
+
+        Args:
+            method (str): The request method.
+            url (str): The URL to perform the request on.
+            data (str): Data to send in the request body, None to send no body.
+                Default is None.
+            headers (dict): Dictionary containing key-value pairs representing
+                the request headers. Default is None.
+            stream (bool): Return the response before reading its body.
+                Default is False.
+
+        Returns:
+            Response: The response from the host, or from the cache.
+        """
+        if self.cache is not None and method == "GET":
+            response = self._cached_get(url, headers)
+        else:
+            if self.cache is not None and method != "HEAD":
+                self.cache.invalidate(url)
+            response = Response(*self._exchange(method, url, data, headers))
+        if not stream:
+            response.content
+        return response
+
+    def _cached_get(self, url: str, headers=None):
+        """Perform a GET request through the cache."""
+        cache = self.cache
+        url = cache.resolve(url)
+        entry, body = cache.lookup(url, headers)
+        if entry is not None and cache.is_fresh(entry, headers):
+            return Response(entry.head, body)
+        request_headers = headers
+        if entry is not None:
+            request_headers = dict(entry.validators(), **(headers or {}))
+        try:
+            head, chunks, done = self._exchange("GET", url, None,
+                                                request_headers)
+        except BaseException:
+            if body is not None:
+                body.close()
+            raise
+        if entry is not None and _status_code(head) == 304:
+            # A 304 response has no body.
+            for _ in chunks:
+                pass
+            done(True)
+            return Response(cache.refresh(entry, head).head, body)
+        if body is not None:
+            body.close()
+        return Response(head, cache.store(url, headers, head, chunks), done)
+
+    def _exchange(self, method: str, url: str, data=None, headers=None):
+        """Send a request and read the head of its response.
+
+        Returns:
+            tuple: The head of the response, an iterator over the chunks of its
+                body, and the function to call once the body is read.
+        """
+        host, port, message = _build_request(method, url, data, headers)
+        while True:
+            connection, reused = self._acquire(host, port)
+            try:
+                connection.sock.sendall(message)
+                head = connection.read_head()
+                break
+            except ConnectionError:
+                connection.close()
+                if not reused:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+        try:
+            # Skip the interim responses, such as 100 Continue.
+            while _status_code(head) // 100 == 1 and _status_code(head) != 101:
+                head = connection.read_head()
+            chunks, keep_alive = _read_body(connection, method, head)
+        except BaseException:
+            connection.close()
+            raise
+
+        def done(complete):
+            if complete and keep_alive:
+                self._release(connection)
+            else:
+                connection.close()
+
+        return head, chunks, done
+
+    def get(self, url: str, headers=None, stream=False):
+        """Perform an HTTP GET request, see request."""
+        return self.request("GET", url, headers=headers, stream=stream)
+
+    def post(self, url: str, data="", headers=None, stream=False):
+        """Perform an HTTP POST request, see request."""
+        return self.request("POST", url, data=data, headers=headers,
+                            stream=stream)
+
+    def close(self):
+        """Close the idle connections.
+
+        The session can still be used, it opens new connections.
+        """
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _acquire(self, host: str, port: int):
+        """Return an open connection to the host and whether it was pooled."""
+        now = time.monotonic()
+        with self.lock:
+            pool = self.pools.get((host, port), [])
+            while pool:
+                # The most recently used connection is the least likely to have
+                # been closed by the host.
+                connection = pool.pop()
+                if (now - connection.idle_since < self.idle_timeout
+                        and connection.is_alive()):
+                    return connection, True
+                connection.close()
+        return Connection(host, port, self.timeout), False
+
+    def _release(self, connection: Connection):
+        """Put a connection back in the pool of its host."""
+        connection.idle_since = time.monotonic()
+        with self.lock:
+            pool = self.pools.setdefault((connection.host, connection.port),
+                                         [])
+            pool.append(connection)
+            if len(pool) > self.max_idle_per_host:
+                pool.pop(0).close()
+
+
+def _build_request(method: str, url: str, data=None, headers=None):
+    """Construct an HTTP/1.1 request message.
 
     Args:
-        url (str): The URL to perform the GET request on.
+        method (str): The request method.
+        url (str): The URL of the request.
+        data (str): Request body, None to send no body. Default is None.
         headers (dict): Dictionary containing key-value pairs representing the
             request headers. Default is None.
 
-    Return:
-        Response: The response from the host.
+    Returns:
+        tuple: The host, the port and the request message as bytes.
     """
-    if not headers:
-        headers = {}
+    # Copy the headers, the caller may reuse them for another host.
+    headers = dict(headers) if headers else {}
 
     # Extract components from URL. If port is not specified default to 80.
     parsed_url = urlparse(url)
-    netloc = parsed_url.netloc
+    netloc = parsed_url.netloc.rpartition("@")[2]
     host = parsed_url.hostname
     port = parsed_url.port or 80
     path = parsed_url.path or "/"
     query = parsed_url.query
     request_uri = "{}?{}".format(path, query) if query else path
 
+    if isinstance(data, str):
+        data = data.encode("UTF-8")
+
     # Add standard headers.
-    headers.setdefault("Host", host)
+    headers.setdefault("Host", netloc)
     headers.setdefault("User-Agent", "Concordia-HTTP/1.0")
+    if data is not None:
+        headers.setdefault("Content-Length", str(len(data)))
 
     # Construct HTTP request message.
-    request_line = "GET {} HTTP/1.0".format(request_uri)
+    request_line = "{} {} HTTP/1.1\r\n".format(method, request_uri)
     headers_line = "".join(
         "{}:{}\r\n".format(k, v) for k, v in headers.items())
-    entity_body = ""
-    request = "\r\n".join((request_line, headers_line, entity_body))
+    request = (request_line + headers_line + "\r\n").encode("UTF-8")
+    return host, port, request + data if data else request
+
 
-    # Open a socket, connect to host, send request, and retrieve response.
-    sock = socket.create_connection((host, port))
-    sock.sendall(request.encode("UTF-8"))
-    data = _recvall(sock)
-    response = data.decode("UTF-8")
+def _status_code(head: bytes):
+    """Return the status code of a response head.
 
-    return Response(response)
+    Raises:
+        ValueError: The status line is malformed.
+    """
+    fields = head.split(None, 2)
+    if len(fields) < 2 or not fields[1].isdigit():
+        raise ValueError("Malformed status line: {!r}".format(
+            head.split(b"\r\n", 1)[0][:100]))
+    return int(fields[1])
 
 
-def POST(url: str, data="", headers=None):
-    """Perform an HTTP POST request. Return response as a Response object.
+def _parse_headers(head: bytes):
+    """Return the headers of a response head with lowercase names."""
+    lines = head.decode("ISO-8859-1").split("\r\n")[1:]
+    return dict((k.strip().lower(), v.strip())
+                for k, v in (line.split(":", 1) for line in lines if line))
+
+
+def _read_body(connection: Connection, method: str, head: bytes):
+    """Return an iterator over the body of a response and whether the
+    connection can be reused after it.
+    """
+    http_version = head.split(None, 1)[0]
+    code = _status_code(head)
+    headers = _parse_headers(head)
+    connection_tokens = headers.get("connection", "").lower()
+    if http_version == b"HTTP/1.1":
+        keep_alive = "close" not in connection_tokens
+    else:
+        keep_alive = "keep-alive" in connection_tokens
+
+    if method == "HEAD" or code in (204, 304) or code // 100 == 1:
+        return iter(()), keep_alive
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        return connection.iter_chunked(), keep_alive
+    if "content-length" in headers:
+        return connection.iter_length(int(headers["content-length"])), \
+            keep_alive
+    # The body ends when the host closes the connection.
+    return connection.iter_until_close(), False
+
+
+_default_session = Session()
+atexit.register(_default_session.close)
+
+
+def set_cache(cache):
+    """Set the cache of the responses to GET and POST, None to disable it."""
+    _default_session.cache = cache
+
+
+def get_cache():
+    """Return the cache of the responses to GET and POST, None if disabled."""
+    return _default_session.cache
+
+
+def GET(url: str, headers=None, stream=False):
+    """Perform an HTTP GET request. Return response as a Response object.
 
     Args:
         url (str): The URL to perform the GET request on.
-        data (str): Data to sent in request body. Defaults to empty string.
         headers (dict): Dictionary containing key-value pairs representing the
             request headers. Default is None.
+        stream (bool): Return the response before reading its body, to iterate
+            over it with iter_content. Default is False.
 
-    Returns:
+    Return:
         Response: The response from the host.
     """
-    if not headers:
-        headers = {}
+    return _default_session.get(url, headers=headers, stream=stream)
 
-    # Extract components from URL. If port is not specified default to 80.
-    parsed_url = urlparse(url)
-    netloc = parsed_url.netloc
-    host = parsed_url.hostname
-    port = parsed_url.port or 80
-    path = parsed_url.path or "/"
-    query = parsed_url.query
-    request_uri = "{}?{}".format(path, query) if query else path
-
-    # Add standard headers.
-    headers.setdefault("Host", host)
-    headers.setdefault("User-Agent", "Concordia-HTTP/1.0")
-    headers.setdefault("Content-Length", str(len(data)))
 
-    # Construct HTTP request message.
-    request_line = "POST {} HTTP/1.0".format(request_uri)
-    headers_line = "".join(
-        "{}:{}\r\n".format(k, v) for k, v in headers.items())
-    request = "\r\n".join((request_line, headers_line, data))
+def POST(url: str, data="", headers=None, stream=False):
+    """Perform an HTTP POST request. Return response as a Response object.
 
-    # Open a socket, connect to host, send request, and retrieve response.
-    sock = socket.create_connection((host, port))
-    sock.sendall(request.encode("UTF-8"))
-    response = _recvall(sock).decode("UTF-8")
+    Args:
+        url (str): The URL to perform the GET request on.
+        data (str): Data to sent in request body. Defaults to empty string.
+        headers (dict): Dictionary containing key-value pairs representing the
+            request headers. Default is None.
+        stream (bool): Return the response before reading its body, to iterate
+            over it with iter_content. Default is False.
 
-    return Response(response)
+    Returns:
+        Response: The response from the host.
+    """
+    return _default_session.post(url, data=data, headers=headers,
+                                 stream=stream)
@@ -0,0 +1,39 @@
+import socket
+from threading import Thread
+import bench
+
+
+def _serve(listener, response: bytes):
+    """Answer each request with the response and close the connection."""
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        with conn:
+            conn.recv(65536)
+            conn.sendall(response)
+
+
+def _run(response: bytes):
+    listener = socket.create_server(("127.0.0.1", 0))
+    Thread(target=_serve, args=(listener, response), daemon=True).start()
+    try:
+        return bench.run("http://127.0.0.1:{}/".format(
+            listener.getsockname()[1]), requests=6, concurrency=2, timeout=5)
+    finally:
+        listener.close()
+
+
+def test_malformed_responses_counted_as_errors():
+    report = _run(b"garbage\r\n\r\n")
+    assert report["requests"] == 0
+    assert report["errors"] == 6
+
+
+def test_responses_counted():
+    report = _run(b"HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\n"
+                  b"Connection: close\r\n\r\nno")
+    assert report["requests"] == 6 and report["errors"] == 0
+    assert report["non_2xx"] == 6
+    assert sum(n for _, n in report["histogram"]) == 6
@@ -0,0 +1,64 @@
+import time
+from email.utils import formatdate
+from cache import Cache, _lifetime
+
+
+def _date(timestamp: float):
+    return formatdate(timestamp, usegmt=True)
+
+
+def test_lifetime_directives():
+    assert _lifetime(200, {"cache-control": "max-age=60"}) == 60
+    assert _lifetime(200, {"cache-control": 'public, max-age="60"'}) == 60
+    assert _lifetime(200, {"cache-control": "max-age=x"}) == 0
+    assert _lifetime(200, {"cache-control": "no-store, max-age=60"}) is False
+    assert _lifetime(200, {"cache-control": "No-Cache, max-age=60"}) == 0
+    # max-age takes precedence over Expires.
+    now = time.time()
+    assert _lifetime(200, {"cache-control": "max-age=60", "date": _date(now),
+                           "expires": _date(now + 3600)}) == 60
+
+
+def test_lifetime_expires():
+    now = time.time()
+    assert _lifetime(200, {"date": _date(now),
+                           "expires": _date(now + 300)}) == 300
+    assert _lifetime(200, {"date": _date(now),
+                           "expires": _date(now - 300)}) == 0
+    # An invalid date means already expired.
+    assert _lifetime(200, {"date": _date(now), "expires": "0"}) == 0
+    assert _lifetime(301, {"date": _date(now), "expires": "0"}) == 0
+
+
+def test_lifetime_heuristic():
+    now = time.time()
+    headers = {"date": _date(now), "last-modified": _date(now - 1000)}
+    assert _lifetime(200, headers) == 100
+    headers["last-modified"] = _date(now - 100 * 86400)
+    assert _lifetime(200, headers) == 86400
+    assert _lifetime(200, {"date": _date(now)}) == 0
+    # Permanent redirects without explicit freshness do not expire.
+    assert _lifetime(301, {}) is None
+    assert _lifetime(308, {"last-modified": _date(now - 1000)}) is None
+    assert _lifetime(302, {}) == 0
+
+
+def test_freshness(tmp_path):
+    cache = Cache(str(tmp_path))
+    url = "http://example.com/a"
+    head = b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nAge: 50"
+    assert b"".join(cache.store(url, None, head, [b"body"])) == b"body"
+    entry, body = cache.lookup(url)
+    assert b"".join(body) == b"body"
+    assert entry.is_fresh()
+    assert not entry.is_fresh(time.time() + 10)
+    assert not cache.is_fresh(entry, {"Cache-Control": "no-cache"})
+    assert not cache.is_fresh(entry, {"cache-control": "max-age=0"})
+    # Reloaded from the directory.
+    entry, body = Cache(str(tmp_path)).lookup(url)
+    body.close()
+    assert entry.is_fresh() and not entry.is_fresh(time.time() + 10)
+
+    # Neither fresh nor revalidatable, not stored.
+    cache.store("http://example.com/b", None, b"HTTP/1.1 200 OK", [b"x"])
+    assert cache.lookup("http://example.com/b") == (None, None)
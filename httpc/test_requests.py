@@ -0,0 +1,227 @@
+import os
+import socket
+import struct
+import subprocess
+import sys
+from threading import Event, Thread
+from requests import Session
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+class Server:
+    """HTTP server answering each request with the result of a function.
+
+    The function is called with the number of the connection, starting at 1,
+    and the request line. It returns the response data, bytes or an iterator
+    over the parts of the data to send one after the other, and what to do
+    with the connection after sending it: "keep" it open, "close" it or
+    "reset" it.
+
+    Attributes:
+        url (str): URL of the server.
+        requests (list): The requests received as (connection number, request
+            line).
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.url = "http://127.0.0.1:{}".format(
+            self.listener.getsockname()[1])
+        self.requests = []
+        Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _accept(self):
+        number = 0
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            number += 1
+            Thread(target=self._serve, args=(conn, number), daemon=True).start()
+
+    def _serve(self, conn, number):
+        buffer = b""
+        with conn:
+            while True:
+                while b"\r\n\r\n" not in buffer:
+                    data = conn.recv(65536)
+                    if not data:
+                        return
+                    buffer += data
+                head, buffer = buffer.split(b"\r\n\r\n", 1)
+                length = 0
+                for line in head.split(b"\r\n")[1:]:
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                while len(buffer) < length:
+                    buffer += conn.recv(65536)
+                buffer = buffer[length:]
+                request_line = head.split(b"\r\n", 1)[0].decode()
+                self.requests.append((number, request_line))
+                data, then = self.respond(number, request_line)
+                for part in [data] if isinstance(data, bytes) else data:
+                    conn.sendall(part)
+                if then == "reset":
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                    struct.pack("ii", 1, 0))
+                if then != "keep":
+                    return
+
+
+def test_connection_reused():
+    with Server(lambda number, line: (OK, "keep")) as server, \
+            Session() as session:
+        for path in ("/a", "/b", "/c"):
+            assert session.get(server.url + path).content == b"ok"
+        response = session.post(server.url + "/d", data="body")
+        assert response.code == 200
+        assert server.requests == [(1, "GET /a HTTP/1.1"),
+                                   (1, "GET /b HTTP/1.1"),
+                                   (1, "GET /c HTTP/1.1"),
+                                   (1, "POST /d HTTP/1.1")]
+
+
+def test_connection_not_reused():
+    close = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+    with Server(lambda number, line: (close, "close")) as server, \
+            Session() as session:
+        session.get(server.url + "/a")
+        session.get(server.url + "/b")
+        assert [number for number, _ in server.requests] == [1, 2]
+    # Closed by the host while idle, without telling
+    with Server(lambda number, line: (OK, "close")) as server, \
+            Session() as session:
+        session.get(server.url + "/a")
+        assert session.get(server.url + "/b").content == b"ok"
+        assert [number for number, _ in server.requests] == [1, 2]
+    # Expired
+    with Server(lambda number, line: (OK, "keep")) as server, \
+            Session(idle_timeout=0) as session:
+        session.get(server.url + "/a")
+        session.get(server.url + "/b")
+        assert [number for number, _ in server.requests] == [1, 2]
+
+
+def test_request_sent_again():
+    def respond(number, line):
+        # The first connection is closed before answering its second request
+        if number == 1 and line == "GET /b HTTP/1.1":
+            return b"", "close"
+        return OK, "keep"
+
+    with Server(respond) as server, Session() as session:
+        session.get(server.url + "/a")
+        assert session.get(server.url + "/b").content == b"ok"
+        assert server.requests == [(1, "GET /a HTTP/1.1"),
+                                   (1, "GET /b HTTP/1.1"),
+                                   (2, "GET /b HTTP/1.1")]
+
+
+def test_idle_connections_per_host():
+    with Server(lambda number, line: (OK, "keep")) as server, \
+            Session(max_idle_per_host=2) as session:
+        responses = [session.get(server.url + "/" + str(i), stream=True)
+                     for i in range(3)]
+        for response in responses:
+            assert response.content == b"ok"
+        pool = list(session.pools.values())[0]
+        assert len(pool) == 2
+        # The most recently used connection is reused first. A streamed
+        # response closed before its body is read closes its connection.
+        session.get(server.url + "/unread", stream=True).close()
+        session.get(server.url + "/next")
+        session.get(server.url + "/last")
+        assert [number for number, _ in server.requests] == [1, 2, 3, 3, 2, 2]
+
+
+def test_chunked_body():
+    chunked = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+               b"5;name=value\r\nhello\r\n6\r\n world\r\n"
+               b"0\r\nX-Trailer: 1\r\n\r\n")
+    with Server(lambda number, line: (chunked, "keep")) as server, \
+            Session() as session:
+        assert session.get(server.url + "/a").content == b"hello world"
+        with session.get(server.url + "/b", stream=True) as response:
+            assert list(response.iter_content()) == [b"hello", b" world"]
+        # The trailers were consumed, the connection is reused
+        assert [number for number, _ in server.requests] == [1, 1]
+
+
+def test_streamed_body():
+    sent = Event()
+    body = os.urandom(300000)
+
+    def respond(number, line):
+        def parts():
+            yield b"HTTP/1.1 200 OK\r\nContent-Length: 300000\r\n\r\n"
+            # The rest of the body is sent once the response is returned
+            sent.wait(5)
+            yield body
+        return parts(), "keep"
+
+    with Server(respond) as server, Session() as session:
+        response = session.get(server.url + "/a", stream=True)
+        sent.set()
+        chunks = list(response.iter_content())
+        assert len(chunks) > 1 and b"".join(chunks) == body
+        try:
+            list(response.iter_content())
+            assert False, "RuntimeError not raised"
+        except RuntimeError:
+            pass
+        assert list(session.pools.values())[0]
+
+
+def test_body_until_close():
+    def respond(number, line):
+        return b"HTTP/1.1 200 OK\r\n\r\nuntil the end", "close"
+
+    with Server(respond) as server, Session() as session:
+        assert session.get(server.url + "/a").content == b"until the end"
+        session.get(server.url + "/b")
+        assert [number for number, _ in server.requests] == [1, 2]
+
+    reset = Event()
+
+    def respond_reset(number, line):
+        def parts():
+            yield b"HTTP/1.1 200 OK\r\n\r\npartial"
+            reset.wait(5)
+        return parts(), "reset"
+
+    with Server(respond_reset) as server, Session() as session:
+        response = session.get(server.url + "/a", stream=True)
+        reset.set()
+        # A reset is not the end of the body
+        try:
+            response.content
+            assert False, "ConnectionError not raised"
+        except ConnectionError:
+            pass
+
+
+def test_get_output(tmp_path):
+    body = os.urandom(200000)
+    response = b"HTTP/1.1 200 OK\r\nContent-Length: 200000\r\n\r\n" + body
+    output = tmp_path / "body"
+    with Server(lambda number, line: (response, "keep")) as server:
+        subprocess.run([sys.executable, os.path.dirname(__file__), "get", "-o",
+                        str(output), server.url + "/a"], check=True)
+    assert output.read_bytes() == body
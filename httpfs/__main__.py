@@ -1,6 +1,8 @@
 import argparse
 import logger
 import http_fs
+import http_server
+import file_manager
 
 DEFAULT_PORT = 8080
 
@@ -28,8 +30,204 @@ parser.add_argument(
      ),
     default='.',
     metavar='PATH-TO-DIR')
+parser.add_argument(
+    '--engine',
+    dest='engine',
+    choices=('threaded', 'async'),
+    help=(
+        'Serves connections with a pool of worker threads (threaded) or on an asyncio '
+        'event loop that can hold many idle connections (async). Default is threaded.'),
+    default='threaded')
+parser.add_argument(
+    '--keep-alive-timeout',
+    dest='keep_alive_timeout',
+    type=float,
+    help=(
+        'Seconds a connection is kept open waiting for the first byte of a request. '
+        'The threaded engine closes idle connections early when others wait for a worker. '
+        'Default is {}.'.format(http_server.http_server_keep_alive_timeout)),
+    default=http_server.http_server_keep_alive_timeout,
+    metavar='SECONDS')
+parser.add_argument(
+    '--header-timeout',
+    dest='header_timeout',
+    type=float,
+    help=(
+        'Seconds to receive the request line and headers once their first byte arrived, '
+        'slower requests are answered with 408. Default is {}.'.format(http_server.http_server_header_timeout)),
+    default=http_server.http_server_header_timeout,
+    metavar='SECONDS')
+parser.add_argument(
+    '--body-timeout',
+    dest='body_timeout',
+    type=float,
+    help=(
+        'Seconds to wait for the next part of a request body. '
+        'Default is {}.'.format(http_server.http_server_body_timeout)),
+    default=http_server.http_server_body_timeout,
+    metavar='SECONDS')
+parser.add_argument(
+    '--min-body-rate',
+    dest='min_body_rate',
+    type=int,
+    help=(
+        'Bytes per second a request body must be received at on average once the body timeout '
+        'passed, 0 disables the check. Default is {}.'.format(http_server.http_server_min_body_rate)),
+    default=http_server.http_server_min_body_rate,
+    metavar='BYTES')
+parser.add_argument(
+    '--max-requests',
+    dest='max_requests',
+    type=int,
+    help=(
+        'Maximum number of requests served on one connection. '
+        'Default is {}.'.format(http_server.http_server_max_keep_alive_requests)),
+    default=http_server.http_server_max_keep_alive_requests,
+    metavar='N')
+parser.add_argument(
+    '--threads',
+    dest='pool_size',
+    type=int,
+    help=(
+        'Number of worker threads serving connections, or running the request handlers '
+        'with the async engine. '
+        'Default is {}.'.format(http_server.http_server_pool_size)),
+    default=http_server.http_server_pool_size,
+    metavar='N')
+parser.add_argument(
+    '--queue-size',
+    dest='queue_size',
+    type=int,
+    help=(
+        'Number of accepted connections (requests with the async engine) waiting for a worker thread. '
+        'When full, they are answered with 503. Default is {}.'.format(http_server.http_server_queue_size)),
+    default=http_server.http_server_queue_size,
+    metavar='N')
+parser.add_argument(
+    '--backlog',
+    dest='backlog',
+    type=int,
+    help=(
+        'Number of connections waiting to be accepted by the listening socket. '
+        'Default is {}.'.format(http_server.http_server_backlog)),
+    default=http_server.http_server_backlog,
+    metavar='N')
+parser.add_argument(
+    '--max-body-size',
+    dest='max_body_size',
+    type=int,
+    help=(
+        'Largest request body accepted in bytes, larger uploads are answered with 413. '
+        'Default is {}.'.format(http_server.http_server_max_body_size)),
+    default=http_server.http_server_max_body_size,
+    metavar='BYTES')
+parser.add_argument(
+    '--upload-buffer',
+    dest='upload_buffer',
+    type=int,
+    help=(
+        'Memory used to stream an upload to disk in bytes. '
+        'Default is {}.'.format(http_server.http_server_upload_buffer_size)),
+    default=http_server.http_server_upload_buffer_size,
+    metavar='BYTES')
+parser.add_argument(
+    '--cache-size',
+    dest='cache_size',
+    type=int,
+    help=(
+        'Memory used to cache the content of small files in bytes, 0 disables the cache. '
+        'Default is {}.'.format(file_manager.file_manager_cache.max_size)),
+    default=file_manager.file_manager_cache.max_size,
+    metavar='BYTES')
+parser.add_argument(
+    '--gzip-cache-size',
+    dest='gzip_cache_size',
+    type=int,
+    help=(
+        'Memory used to keep the gzip compressed variants of the files in bytes, 0 disables '
+        'compression. Default is {}.'.format(file_manager.file_manager_gzip_cache.max_size)),
+    default=file_manager.file_manager_gzip_cache.max_size,
+    metavar='BYTES')
+parser.add_argument(
+    '--durability',
+    dest='durability',
+    choices=file_manager.DURABILITY_MODES,
+    help=(
+        'When an upload is made durable before it is acknowledged: never fsynced (none), fsynced '
+        'alone (per-write) or fsynced in a batch with the concurrent uploads (group). '
+        'Default is {}.'.format(file_manager.file_manager_durability)),
+    default=file_manager.file_manager_durability)
+parser.add_argument(
+    '--commit-window',
+    dest='commit_window',
+    type=float,
+    help=(
+        'Seconds a group commit waits for more uploads to join its batch. '
+        'Default is {}.'.format(file_manager.file_manager_commit_window)),
+    default=file_manager.file_manager_commit_window,
+    metavar='SECONDS')
+parser.add_argument(
+    '--storage',
+    dest='storage',
+    choices=('directory', 'content'),
+    help=(
+        'Stores each upload as a plain file (directory), or stores each distinct content once in '
+        '.httpfs-blobs and hard links the uploaded names to it (content). Default is directory.'),
+    default='directory')
+parser.add_argument(
+    '--workers',
+    dest='workers',
+    type=int,
+    help=(
+        'Number of worker processes sharing the port with SO_REUSEPORT, each running the engine. '
+        'Writes are locked across the processes with fcntl locks. '
+        'Default is 0, which serves in a single process.'),
+    default=0,
+    metavar='N')
+parser.add_argument(
+    '--access-log',
+    dest='access_log',
+    help=(
+        'Writes a line per request to this file: time, client, method, path, status, bytes sent '
+        'and duration in seconds. Workers append to the same file. Default is no access log.'),
+    default=None,
+    metavar='PATH')
+parser.add_argument(
+    '--access-log-max-bytes',
+    dest='access_log_max_bytes',
+    type=int,
+    help=(
+        'Size past which the access log is rotated, 0 never rotates it. '
+        'Default is {}.'.format(logger.access_log_max_bytes)),
+    default=logger.access_log_max_bytes,
+    metavar='BYTES')
+parser.add_argument(
+    '--access-log-backups',
+    dest='access_log_backups',
+    type=int,
+    help=(
+        'Number of rotated access logs kept. '
+        'Default is {}.'.format(logger.access_log_backups)),
+    default=logger.access_log_backups,
+    metavar='N')
 
 args = parser.parse_args()
 
 logger.set_logger(args.verbose)
-http_fs.start_file_server('127.0.0.1', port=args.port, directory=args.dir)
+logger.set_access_log(args.access_log, args.access_log_max_bytes, args.access_log_backups)
+http_server.set_keep_alive(args.keep_alive_timeout, args.max_requests)
+http_server.set_timeouts(args.header_timeout, args.body_timeout, args.min_body_rate)
+http_server.set_upload_limits(args.max_body_size, args.upload_buffer)
+file_manager.set_cache(args.cache_size)
+file_manager.set_gzip_cache(args.gzip_cache_size)
+file_manager.set_durability(args.durability, args.commit_window)
+file_manager.set_storage(args.storage)
+http_fs.start_file_server(
+    '127.0.0.1',
+    port=args.port,
+    directory=args.dir,
+    engine=args.engine,
+    workers=args.workers,
+    pool_size=args.pool_size,
+    queue_size=args.queue_size,
+    backlog=args.backlog)
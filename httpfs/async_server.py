@@ -0,0 +1,276 @@
+"""Implements the asyncio engine of the HTTP server.
+
+Connections are served by coroutines on a single event loop, so an idle
+connection only costs a socket and a coroutine instead of a thread. The
+requests are parsed on the loop and handed to the HTTPHandler in an executor
+thread, so the handlers and their blocking file I/O run unchanged.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logger
+import http_server
+from http_server import HTTPServer, Request, RequestBody, RequestPreamble, RequestTimeout, keep_alive_requested, \
+    record_request
+
+SENDFILE_BLOCK_SIZE = 262144
+
+
+def start_server(host, port: int, HTTPHandlerImplClass, pool_size: int = http_server.http_server_pool_size,
+                 queue_size: int = http_server.http_server_queue_size, backlog: int = http_server.http_server_backlog,
+                 reuse_port: bool = False):
+    """Start the HTTP server listening on port and using HTTPHandlerImplClass(HTTPHandler) to handle requests
+    Requests waiting for an executor thread are limited to queue_size, past that they are answered with a 503.
+    When the loop is stopped by an exception, the requests being handled get up to
+    http_server_shutdown_timeout to finish.
+    :param host: hostname of the server.
+    :param port: port to listen for new connection.
+    :param HTTPHandlerImplClass: HTTPHandler implementation to handle request
+    :param pool_size: Number of executor threads running the handlers.
+    :param queue_size: Number of requests waiting for an executor thread.
+    :param backlog: Number of connections waiting to be accepted by the listening socket.
+    :param reuse_port: Sets SO_REUSEPORT so several processes can listen on the port.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = AsyncEngine(loop, HTTPHandlerImplClass, pool_size, queue_size)
+    server = loop.run_until_complete(
+        asyncio.start_server(engine.serve_connection, host, port, backlog=backlog, reuse_port=reuse_port or None,
+                             limit=http_server.http_server_max_preamble_size))
+    logger.write('HTTP server (async) listening at {}', port)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        http_server.http_server_stopping.set()
+        loop.run_until_complete(engine.finish(http_server.http_server_shutdown_timeout))
+        loop.run_until_complete(server.wait_closed())
+        engine.executor.shutdown(wait=False)
+        loop.close()
+
+
+class AsyncConnection:
+    """Socket-like adapter given to HTTPServer in the executor threads.
+    Writes are scheduled on the event loop and wait for the transport to drain.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter):
+        self.loop = loop
+        self.writer = writer
+
+    def sendall(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop).result()
+
+    def sendfile(self, file, offset: int = 0, count: int = None):
+        """Sends count bytes of the file from offset.
+        The transport only takes bytes, so the file is read and written in blocks.
+        """
+        file.seek(offset)
+        remaining = count
+        while remaining is None or remaining > 0:
+            block = file.read(SENDFILE_BLOCK_SIZE if remaining is None else min(SENDFILE_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            self.sendall(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+    async def _write(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class AsyncReader:
+    """Reader adapter given to RequestBody in the executor threads.
+    Reads are scheduled on the event loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, reader: asyncio.StreamReader):
+        self.loop = loop
+        self.reader = reader
+
+    def readinto(self, b, deadline: float = None):
+        view = memoryview(b)
+        read = self.reader.read(len(view))
+        if deadline is not None:
+            read = _before(read, deadline, 'body')
+        data = asyncio.run_coroutine_threadsafe(read, self.loop).result()
+        view[:len(data)] = data
+        return len(data)
+
+
+async def _read_preamble(reader: asyncio.StreamReader, first: bytes):
+    """Reads the rest of the request line and headers, up to the empty line.
+    Lines may end with CRLF or a bare LF, as in the SocketReader of the threaded engine.
+    :param first: The first byte of the preamble, already read.
+    :return: (bytes) The preamble including the empty line.
+    """
+    preamble = bytearray(first)
+    while True:
+        line = await reader.readuntil(b'\n')
+        preamble += line
+        if len(preamble) > http_server.http_server_max_preamble_size:
+            raise asyncio.LimitOverrunError('Request preamble too large', len(preamble))
+        if line in (b'\n', b'\r\n') and len(preamble) > len(line):
+            return bytes(preamble)
+
+
+async def _before(awaitable, deadline: float, phase: str):
+    """Awaits until the deadline (time.monotonic(), the clock of the event loop), raising RequestTimeout past it"""
+    try:
+        return await asyncio.wait_for(awaitable, max(0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        raise RequestTimeout(phase)
+
+
+class LoopConnection:
+    """Socket-like adapter for the responses sent from the event loop itself.
+    Writes are buffered by the transport, the caller drains the writer.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def sendall(self, data):
+        self.writer.write(bytes(data))
+
+
+class AsyncEngine:
+    """Serves the connections accepted by the event loop.
+
+    Attributes:
+        executor (ThreadPoolExecutor): Threads running the HTTPHandler.
+        pending (int): Number of requests handed to the executor and not done yet.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, HTTPHandlerImplClass, pool_size: int, queue_size: int):
+        self.loop = loop
+        self.HTTPHandlerImplClass = HTTPHandlerImplClass
+        self.executor = ThreadPoolExecutor(pool_size)
+        self.max_pending = pool_size + queue_size
+        self.pending = 0
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves requests on the connection with the same keep-alive rules as the threaded engine.
+        """
+        client_addr = writer.get_extra_info('peername')
+        logger.write('Connection accepted from {}', client_addr)
+        conn = AsyncConnection(self.loop, writer)
+        http_server.active_connections.inc()
+        try:
+            for served in range(http_server.http_server_max_keep_alive_requests):
+                try:
+                    # Idle until the first byte, then the rest of the preamble has its own deadline
+                    first = await asyncio.wait_for(reader.readexactly(1), http_server.http_server_keep_alive_timeout)
+                    preamble = await _before(_read_preamble(reader, first),
+                                             time.monotonic() + http_server.http_server_header_timeout, 'header')
+                except asyncio.TimeoutError:
+                    http_server.timeouts_total.inc(('idle',))
+                    break
+                except RequestTimeout as err:
+                    http_server.timeouts_total.inc((err.phase,))
+                    server = await self._send_error(writer, 408, 'Request Timeout')
+                    record_request(client_addr, None, server, 0, time.perf_counter())
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    server = await self._send_error(writer, 431, 'Request Header Fields Too Large')
+                    record_request(client_addr, None, server, 0, time.perf_counter())
+                    break
+                started = time.perf_counter()
+                try:
+                    request_preamble = RequestPreamble(preamble.decode('UTF-8'))
+                    data_length = int(request_preamble.headers.get('Content-Length', 0))
+                    if data_length < 0:
+                        raise ValueError('Negative Content-Length: {}'.format(data_length))
+                except ValueError as err:
+                    logger.write(err)
+                    server = await self._send_error(writer, 400, 'Bad Request')
+                    record_request(client_addr, None, server, len(preamble), started)
+                    break
+                logger.write('Headers:\n{}', request_preamble.headers)
+
+                if 'Transfer-Encoding' in request_preamble.headers:
+                    # Same framing rule as the threaded engine
+                    server = await self._send_error(writer, 411, 'Length Required')
+                    record_request(client_addr, request_preamble, server, len(preamble), started)
+                    break
+
+                if data_length > http_server.http_server_max_body_size:
+                    server = await self._send_error(writer, 413, 'Payload Too Large')
+                    record_request(client_addr, request_preamble, server, len(preamble), started)
+                    break
+
+                if self.pending >= self.max_pending:
+                    logger.write('Executor queue full, rejecting request')
+                    server = await self._send_error(writer, 503, 'Service Unavailable',
+                                                    {'Retry-After': http_server.http_server_retry_after})
+                    record_request(client_addr, request_preamble, server, len(preamble), started)
+                    break
+
+                if request_preamble.headers.get('Expect', '').lower() == '100-continue':
+                    HTTPServer(LoopConnection(writer)).send_continue()
+
+                request = Request(request_preamble, RequestBody(AsyncReader(self.loop, reader), data_length))
+                last = served + 1 == http_server.http_server_max_keep_alive_requests or \
+                    http_server.http_server_stopping.is_set()
+                server = HTTPServer(conn, keep_alive=keep_alive_requested(request_preamble) and not last,
+                                    chunked=request_preamble.http_version == 'HTTP/1.1')
+                self.pending += 1
+                try:
+                    await self.loop.run_in_executor(self.executor, self._handle, request, server)
+                finally:
+                    self.pending -= 1
+                try:
+                    if not server.keep_alive or not server.response_sent:
+                        break
+                    await self._drain(reader, request.body)
+                finally:
+                    record_request(client_addr, request_preamble, server,
+                                   len(preamble) + data_length - request.body.remaining, started)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except RequestTimeout as err:
+            http_server.timeouts_total.inc((err.phase,))
+        finally:
+            http_server.active_connections.dec()
+            writer.close()
+
+    async def finish(self, timeout: float):
+        """Waits up to timeout seconds for the requests handed to the executor"""
+        deadline = self.loop.time() + timeout
+        while self.pending and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+    def _handle(self, request: Request, server: HTTPServer):
+        """Runs the HTTPHandler in an executor thread"""
+        try:
+            self.HTTPHandlerImplClass(request, server).handle()
+        except RequestTimeout as err:
+            http_server.request_timed_out(server, err)
+        except Exception as inst:
+            logger.write(inst)
+            if not server.response_sent:
+                server.send_error(500, 'Internal Server Error')
+
+    @staticmethod
+    async def _drain(reader: asyncio.StreamReader, body: RequestBody):
+        """Reads and discards the part of the body the handler did not read"""
+        while body.remaining:
+            data = await _before(reader.read(min(body.remaining, http_server.http_server_upload_buffer_size)),
+                                 body.deadline(), 'body')
+            if not data:
+                raise ConnectionError('Connection closed before the end of the request body')
+            body.remaining -= len(data)
+
+    @staticmethod
+    async def _send_error(writer: asyncio.StreamWriter, status: int, msg: str, headers: dict = None):
+        """Sends an error from the event loop without waiting for an executor thread
+        :return: (HTTPServer) The server which sent the error.
+        """
+        server = HTTPServer(LoopConnection(writer))
+        server.send_error(status, msg, headers)
+        await writer.drain()
+        return server
@@ -0,0 +1,64 @@
+"""Benchmark of the durability modes of the file manager.
+
+Writes small files from concurrent threads with each durability mode and reports the write
+throughput and latency. The files are written in a temporary directory created in --dir, which
+should be on the disk to measure: fsync costs nothing on a tmpfs.
+
+Usage: python3 httpfs/bench_durability.py [--threads N] [--duration SECONDS] [--size BYTES] [--dir PATH]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from threading import Thread
+import file_manager
+
+
+def writer(index: int, data: bytes, deadline: float, latencies: list):
+    i = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        file_manager.write_file('bench-{}-{}'.format(index, i % 16), data)
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def run(mode: str, args):
+    directory = tempfile.mkdtemp(prefix='httpfs-durability-', dir=args.dir)
+    try:
+        file_manager.set_dir(directory)
+        file_manager.set_durability(mode, args.commit_window)
+        data = os.urandom(args.size)
+        latencies = [[] for _ in range(args.threads)]
+        deadline = time.perf_counter() + args.duration
+        threads = [Thread(target=writer, args=(i, data, deadline, latencies[i])) for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        commits = file_manager.file_manager_committer.commits if file_manager.file_manager_committer else None
+    finally:
+        file_manager.set_dir('.')
+        shutil.rmtree(directory, ignore_errors=True)
+    latencies = sorted(latency for thread in latencies for latency in thread)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000
+    batch = ' writes/commit={:.1f}'.format(len(latencies) / commits) if commits else ''
+    print('{:<10} {:>8.0f} writes/s  p50={:.3f} ms  p99={:.3f} ms{}'.format(
+        mode, len(latencies) / args.duration, p50, p99, batch))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the durability modes of the file manager.')
+    parser.add_argument('--threads', type=int, default=16, metavar='N')
+    parser.add_argument('--duration', type=float, default=3, metavar='SECONDS')
+    parser.add_argument('--size', type=int, default=4096, metavar='BYTES')
+    parser.add_argument('--commit-window', type=float, default=file_manager.file_manager_commit_window,
+                        metavar='SECONDS')
+    parser.add_argument('--dir', default='.', metavar='PATH')
+    args = parser.parse_args()
+
+    for mode in file_manager.DURABILITY_MODES:
+        run(mode, args)
@@ -0,0 +1,136 @@
+"""Benchmark of the threaded and async engines of httpfs.
+
+For each engine, starts httpfs on loopback, opens a number of idle keep-alive
+connections, then measures the GET throughput of a few busy clients while the
+idle connections are held. Reports the server memory and thread count.
+
+Usage: python3 httpfs/bench_engines.py [--idle N] [--clients N] [--duration SECONDS]
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+
+HTTPFS = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_httpfs(port: int, directory: str, *args):
+    """Starts httpfs in a subprocess and waits until it accepts connections"""
+    process = subprocess.Popen([sys.executable, HTTPFS, '-p', str(port), '-d', directory] + list(args), cwd=directory)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('httpfs did not start')
+
+
+def read_response(sock: socket.socket, buffered: bytes = b''):
+    """Reads one response, returns (status, whether the server closes the connection, left over bytes)"""
+    data = buffered
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    head, data = data.split(b'\r\n\r\n', 1)
+    lines = head.decode('UTF-8').split('\r\n')
+    headers = dict((k.strip(), v.strip()) for k, v in (line.split(':', 1) for line in lines[1:]))
+    length = int(headers.get('Content-Length', 0))
+    while len(data) < length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return int(lines[0].split()[1]), headers.get('Connection') == 'close', data[length:]
+
+
+def client(port: int, path: str, deadline: float, results: list):
+    """Sends keep-alive GET requests until the deadline, reconnecting when the server closes"""
+    request = 'GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode('UTF-8')
+    ok = errors = 0
+    sock = None
+    while time.time() < deadline:
+        try:
+            if sock is None:
+                sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+                buffered = b''
+            sock.sendall(request)
+            status, close, buffered = read_response(sock, buffered)
+            if status == 200:
+                ok += 1
+            else:
+                errors += 1
+            if close:
+                sock.close()
+                sock = None
+        except OSError:
+            errors += 1
+            if sock:
+                sock.close()
+            sock = None
+    if sock:
+        sock.close()
+    results.append((ok, errors))
+
+
+def process_status(pid: int):
+    """Returns the VmRSS (kB) and thread count of a process"""
+    status = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            status[key] = value.strip().split(' ')[0]
+    return int(status['VmRSS']), int(status['Threads'])
+
+
+def run(engine: str, port: int, args):
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, 'small.txt'), 'w') as f:
+        f.write('x' * 1024)
+    process = start_httpfs(port, directory, '--engine', engine, '--keep-alive-timeout', '600')
+    idle = []
+    try:
+        for _ in range(args.idle):
+            try:
+                idle.append(socket.create_connection(('127.0.0.1', port), timeout=5))
+            except OSError:
+                break
+        time.sleep(0.5)
+        results = []
+        deadline = time.time() + args.duration
+        clients = [Thread(target=client, args=(port, '/small.txt', deadline, results)) for _ in range(args.clients)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        rss, threads = process_status(process.pid)
+    finally:
+        for sock in idle:
+            sock.close()
+        process.terminate()
+        process.wait()
+    ok = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    print('{:<9} idle={:<6} {:>9.0f} req/s  errors={:<6} rss={:>7} kB  threads={}'.format(
+        engine, len(idle), ok / args.duration, errors, rss, threads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the httpfs engines while holding idle connections.')
+    parser.add_argument('--idle', type=int, default=1000, metavar='N')
+    parser.add_argument('--clients', type=int, default=8, metavar='N')
+    parser.add_argument('--duration', type=float, default=5, metavar='SECONDS')
+    parser.add_argument('--port', type=int, default=8090, metavar='PORT')
+    args = parser.parse_args()
+
+    run('threaded', args.port, args)
+    run('async', args.port + 1, args)
@@ -0,0 +1,247 @@
+"""Load test of httpfs.
+
+Starts httpfs on loopback with a generated directory and drives it over N keep-alive
+connections, one workload after the other:
+    small   GET of a 1 KiB file
+    large   GET of a large file (1 MiB by default)
+    post    POST of a 4 KiB body, each connection writing its own files
+    list    GET of the directory listing
+    mixed   80% small GET, 10% large GET, 10% POST
+The load is closed loop by default: each connection sends its next request when the previous
+response is complete. With --rate, the load is open loop: requests are scheduled at a fixed total
+rate and their latency is measured from the scheduled time, so a slow server is not hidden by
+the clients slowing down with it.
+Reports the throughput and p50/p95/p99 latency of each workload, and writes them as JSON with
+--json to compare runs.
+
+Usage: python3 httpfs/bench_load.py [--workload NAME] [--connections N] [--duration SECONDS]
+                                    [--rate REQUESTS-PER-SECOND] [--json PATH] [-- HTTPFS-ARGS]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+from bench_engines import start_httpfs
+
+WORKLOADS = ('small', 'large', 'post', 'list', 'mixed')
+SMALL_SIZE = 1024
+POST_SIZE = 4096
+POST_FILES = 16
+
+
+class Client:
+    """Keep-alive connection sending requests and reading their responses."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.sock = None
+        self.buffer = bytearray()
+
+    def request(self, data: bytes):
+        """Sends a request and reads its response, reconnecting if the server closed the connection.
+        :return: (int) Status code of the response.
+        """
+        if self.sock is None:
+            self.sock = socket.create_connection(('127.0.0.1', self.port), timeout=30)
+            self.buffer = bytearray()
+        try:
+            self.sock.sendall(data)
+            status, close = self._read_response()
+        except OSError:
+            self.close()
+            raise
+        if close:
+            self.close()
+        return status
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    def _read_response(self):
+        head = self._read_until(b'\r\n\r\n').decode('UTF-8').split('\r\n')
+        headers = dict((k.strip().lower(), v.strip()) for k, v in (line.split(':', 1) for line in head[1:] if line))
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int(self._read_until(b'\r\n'), 16)
+                self._read(size + 2)
+                if not size:
+                    break
+        else:
+            self._read(int(headers.get('content-length', 0)))
+        return int(head[0].split()[1]), headers.get('connection') == 'close'
+
+    def _fill(self):
+        chunk = self.sock.recv(262144)
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        self.buffer += chunk
+
+    def _read_until(self, delimiter: bytes):
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(delimiter)]
+                return data
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            self._fill()
+
+    def _read(self, count: int):
+        while len(self.buffer) < count:
+            self._fill()
+        del self.buffer[:count]
+
+
+def get(path: str):
+    return 'GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode('UTF-8')
+
+
+def post(path: str, body: bytes):
+    return 'POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(
+        path, len(body)).encode('UTF-8') + body
+
+
+def requests_of(workload: str, connection: int):
+    """Returns the function choosing the next request of a connection, requests are prebuilt"""
+    rng = random.Random(connection)
+    small, large, listing = get('/small.txt'), get('/large.bin'), get('/?limit=100')
+    body = os.urandom(POST_SIZE)
+    posts = [post('/post-{}-{}.bin'.format(connection, i), body) for i in range(POST_FILES)]
+    if workload == 'small':
+        return lambda i: small
+    if workload == 'large':
+        return lambda i: large
+    if workload == 'post':
+        return lambda i: posts[i % POST_FILES]
+    if workload == 'list':
+        return lambda i: listing
+
+    def mixed(i):
+        choice = rng.random()
+        return small if choice < 0.8 else large if choice < 0.9 else posts[i % POST_FILES]
+    return mixed
+
+
+def run_connection(port: int, next_request, start: float, deadline: float, interval: float, result: dict):
+    """Sends requests until the deadline, closed loop if interval is None, one every interval otherwise"""
+    client = Client(port)
+    latencies = result['latencies']
+    i = 0
+    while True:
+        scheduled = time.perf_counter() if interval is None else start + i * interval
+        if scheduled >= deadline:
+            break
+        now = time.perf_counter()
+        if scheduled > now:
+            time.sleep(scheduled - now)
+        try:
+            status = client.request(next_request(i))
+            if 200 <= status < 300:
+                latencies.append(time.perf_counter() - scheduled)
+            else:
+                result['errors'] += 1
+        except OSError:
+            result['errors'] += 1
+        i += 1
+    client.close()
+
+
+def percentile(values: list, p: float):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def run_workload(workload: str, port: int, args):
+    results = [{'latencies': [], 'errors': 0} for _ in range(args.connections)]
+    interval = args.connections / args.rate if args.rate else None
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [Thread(target=run_connection, args=(port, requests_of(workload, i), start + i * (interval or 0) /
+                                                   args.connections, deadline, interval, results[i]))
+               for i in range(args.connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for r in results for latency in r['latencies'])
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'workload': workload,
+        'requests': len(latencies),
+        'errors': sum(r['errors'] for r in results),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+    }
+
+
+def make_directory(args):
+    """Creates the served directory with the files of the workloads"""
+    directory = tempfile.mkdtemp(prefix='httpfs-bench-')
+    with open(os.path.join(directory, 'small.txt'), 'wb') as f:
+        f.write(b'x' * SMALL_SIZE)
+    with open(os.path.join(directory, 'large.bin'), 'wb') as f:
+        f.write(os.urandom(args.large_size))
+    for i in range(args.files):
+        open(os.path.join(directory, 'file-{:06}.txt'.format(i)), 'wb').close()
+    return directory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of httpfs on loopback.')
+    parser.add_argument('--workload', choices=WORKLOADS + ('all',), default='all')
+    parser.add_argument('--connections', type=int, default=8, metavar='N')
+    parser.add_argument('--duration', type=float, default=5, metavar='SECONDS')
+    parser.add_argument('--rate', type=float, default=None, metavar='REQUESTS-PER-SECOND',
+                        help='Total request rate of an open loop load, closed loop if not given.')
+    parser.add_argument('--large-size', type=int, default=1 << 20, metavar='BYTES')
+    parser.add_argument('--files', type=int, default=1000, metavar='N', help='Files in the listed directory.')
+    parser.add_argument('--port', type=int, default=8092, metavar='PORT')
+    parser.add_argument('--json', default=None, metavar='PATH', help='Writes the results to this file.')
+    parser.add_argument('httpfs_args', nargs=argparse.REMAINDER,
+                        help='Arguments of httpfs after --, e.g. -- --engine async --workers 4')
+    args = parser.parse_args()
+    httpfs_args = [a for a in args.httpfs_args if a != '--']
+
+    directory = make_directory(args)
+    process = start_httpfs(args.port, directory, *httpfs_args)
+    results = []
+    try:
+        for workload in WORKLOADS if args.workload == 'all' else (args.workload,):
+            result = run_workload(workload, args.port, args)
+            results.append(result)
+            print('{workload:<6} {throughput:>9} req/s  p50={p50_ms} ms  p95={p95_ms} ms  p99={p99_ms} ms  '
+                  'max={max_ms} ms  errors={errors}'.format(**result))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json:
+        report = {
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('json', 'httpfs_args')},
+            'httpfs_args': httpfs_args,
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
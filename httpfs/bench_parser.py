@@ -0,0 +1,104 @@
+"""Micro-benchmark of the request parsing path.
+
+Compares the byte-at-a-time preamble reader the server used to have with the
+buffered SocketReader. Requests are written to one end of a socket pair and
+parsed from the other end, counting receive syscalls.
+
+Usage: python3 httpfs/bench_parser.py [-n REQUESTS] [-b BODY-SIZE]
+"""
+
+import argparse
+import socket
+import time
+from http_server import SocketReader, RequestPreamble
+
+
+class CountingSocket:
+    """Wraps a socket and counts the receive syscalls made on it."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size: int):
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+
+def legacy_parse(sock):
+    """Previous parsing path: 1 byte recv for the preamble, bytes concatenation for the body."""
+    data = b''
+    while True:
+        line = b''
+        while True:
+            last_buff = sock.recv(1)
+            if not last_buff:
+                break
+            line += last_buff
+            if line.endswith(b'\r\n'):
+                break
+        if line == b'\r\n' or line == b'\n':
+            break
+        data += line
+    preamble = RequestPreamble(data.decode('UTF-8'))
+    body = b''
+    if 'Content-Length' in preamble.headers:
+        length = int(preamble.headers['Content-Length'])
+        while len(body) < length:
+            last_buff = sock.recv(min(8192, length - len(body)))
+            if not last_buff:
+                break
+            body += last_buff
+    return preamble, body
+
+
+def buffered_parse(reader: SocketReader):
+    """Current parsing path."""
+    preamble = RequestPreamble(reader.read_preamble().decode('UTF-8'))
+    body = b''
+    if 'Content-Length' in preamble.headers:
+        body = reader.read_body(int(preamble.headers['Content-Length']))
+    return preamble, body
+
+
+def build_request(body_size: int):
+    headers = [
+        'POST /some/file.txt HTTP/1.0',
+        'Host: localhost:8080',
+        'User-Agent: Concordia-HTTP/1.0',
+        'Accept: */*',
+        'Accept-Encoding: gzip, deflate',
+        'Content-Type: text/plain',
+        'Content-Length: {}'.format(body_size),
+    ]
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('UTF-8') + b'x' * body_size
+
+
+def run(name, parse, requests: int, request: bytes):
+    client, server = socket.socketpair()
+    counter = CountingSocket(server)
+    reader = SocketReader(counter)
+    parse_one = (lambda: parse(counter)) if parse is legacy_parse else (lambda: parse(reader))
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.sendall(request)
+        parse_one()
+    elapsed = time.perf_counter() - start
+    client.close()
+    server.close()
+    print('{:<10} {:>10.0f} req/s {:>8.1f} recv/req'.format(name, requests / elapsed, counter.calls / requests))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the httpfs request parser.')
+    parser.add_argument('-n', dest='requests', type=int, default=20000, metavar='REQUESTS')
+    parser.add_argument('-b', dest='body_size', type=int, default=512, metavar='BODY-SIZE')
+    args = parser.parse_args()
+
+    request = build_request(args.body_size)
+    run('legacy', legacy_parse, args.requests, request)
+    run('buffered', buffered_parse, args.requests, request)
@@ -0,0 +1,79 @@
+"""In memory index of the files of a directory"""
+
+import os
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from threading import Lock
+
+
+class DirectoryIndex:
+    """Sorted list of the names of the regular files in a directory.
+
+    The directory is scanned with os.scandir the first time and again whenever its modification
+    time changes. A write of the file manager changes the directory by renaming its file into it:
+    when the index was up to date just before the rename, the file is added and the modification
+    time after the rename is recorded, so the write does not cost a scan. Otherwise the changes
+    made outside the server or by another worker process are picked up by the next scan. A change
+    made by someone else between the two stat calls around a rename would be missed until the
+    next change of the directory.
+
+    Attributes:
+        path (str): Path to the directory.
+        exclude_prefix (str): Names starting with this prefix are not indexed.
+        names (list): Sorted file names.
+        scans (int): Number of times the directory was scanned.
+    """
+    def __init__(self, path: str, exclude_prefix: str = None):
+        self.path = path
+        self.exclude_prefix = exclude_prefix
+        self.names = []
+        self.mtime = None
+        self.scans = 0
+        self.mutex = Lock()
+
+    def page(self, prefix: str = '', cursor: str = None, limit: int = None):
+        """Returns the file names starting with prefix, in order, after the cursor.
+        :param prefix: Only names starting with prefix are returned.
+        :param cursor: Only names after cursor are returned, pass the cursor returned by the previous page.
+        :param limit: Maximum number of names returned, None for all.
+        :return: (names, cursor) The names and the cursor of the next page, None if this is the last page.
+        """
+        self._refresh()
+        with self.mutex:
+            start = bisect_left(self.names, prefix)
+            if cursor is not None:
+                start = max(start, bisect_right(self.names, cursor))
+            # All the names starting with prefix sort before prefix + the largest code point
+            end = bisect_left(self.names, prefix + chr(0x10FFFF), start) if prefix else len(self.names)
+            if limit is not None and end - start > limit:
+                names = self.names[start:start + limit]
+                return names, names[-1] if names else None
+            return self.names[start:end], None
+
+    @contextmanager
+    def adding(self, name: str):
+        """Context of the change of the directory creating or replacing the file name, such as the
+        rename of a written file. Nothing is recorded if the change raises."""
+        with self.mutex:
+            before = os.stat(self.path).st_mtime_ns
+            yield
+            if before != self.mtime:
+                return
+            self.mtime = os.stat(self.path).st_mtime_ns
+            index = bisect_left(self.names, name)
+            if index == len(self.names) or self.names[index] != name:
+                self.names.insert(index, name)
+
+    def _refresh(self):
+        """Rescans the directory if it changed since the last scan."""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with os.scandir(self.path) as entries:
+            names = sorted(
+                entry.name for entry in entries
+                if entry.is_file() and not (self.exclude_prefix and entry.name.startswith(self.exclude_prefix)))
+        with self.mutex:
+            self.names = names
+            self.mtime = mtime
+            self.scans += 1
@@ -1,37 +1,227 @@
 """File Server Manager - Cheap Thread safety
 
-Thread safety is handled at the directory level:
-    Only one thread can write to any file in the directory at a time
-    Multiple read can be active at a time.
+Thread safety is handled at the file level:
+    Only one thread can write to a file at a time
+    Multiple read of a file can be active at a time.
     Writer Priority
+    Operations on different files do not wait on each other.
+Writes are staged in a temporary file, only the rename is done under the write lock.
+Depending on the durability mode, a write is fsynced before it is acknowledged, alone or in a
+group commit with the concurrent writes.
+When several processes serve the directory, the rename is also done under an fcntl lock shared
+by the processes.
 """
 
+import gzip
+import hashlib
 import os
-from rwlock import FileManagerLock
+import stat
+import tempfile
+from contextlib import contextmanager, nullcontext, ExitStack
+from rwlock import FileLockRegistry, ProcessLock
+from lru_cache import LRUCache
+from dir_index import DirectoryIndex
+from group_commit import GroupCommitter, fsync_directory
+from storage import STORAGES, DirectoryStorage, HashingWriter
+import metrics
 
 file_manager_directory = '.'
-file_manager_lock = FileManagerLock()
+file_manager_locks = FileLockRegistry()
+# Names starting with this prefix are used by the server and are neither listed nor served
+file_manager_reserved_prefix = '.httpfs'
+# Uploads in progress are written to temporary files with this prefix, in a hidden directory so they
+# do not change the modification time of the listed directory
+file_manager_temp_prefix = '.httpfs-upload-'
+file_manager_temp_directory = '.httpfs-uploads'
+# Lock shared with the other processes serving the directory, None when the process is alone
+file_manager_process_lock = None
+file_manager_process_lock_name = '.httpfs.lock'
+# Content of the small files, validated with their inode, size and modification time
+file_manager_cache = LRUCache(32 << 20)
+file_manager_cache_max_file_size = 1 << 20
+# gzip variants of the files, compressed once per version of a file. An empty value marks a file
+# that does not compress well, it still counts the overhead of an entry toward the size limit.
+file_manager_gzip_cache = LRUCache(32 << 20)
+file_manager_gzip_min_size = 1024
+file_manager_gzip_max_size = 8 << 20
+file_manager_gzip_min_ratio = 0.9
+file_manager_index = DirectoryIndex(file_manager_directory, file_manager_reserved_prefix)
+# 'none': the writes are left to the page cache, 'per-write': each write fsyncs its file and the
+# directory, 'group': the writes are fsynced in batches by file_manager_committer
+DURABILITY_MODES = ('none', 'per-write', 'group')
+file_manager_durability = 'none'
+file_manager_commit_window = 0.002
+file_manager_committer = None
+# Backend storing the written files, one of STORAGES
+file_manager_storage = DirectoryStorage(file_manager_directory)
 
+# Caches reported in the metrics, by name
+file_manager_caches = (('content', file_manager_cache), ('gzip', file_manager_gzip_cache))
+
+
+def _cache_metric(attribute: str):
+    """Returns a function reading a counter of the caches for the metrics"""
+    return lambda: {(name,): getattr(cache, attribute) for name, cache in file_manager_caches}
+
+
+metrics.Counter('httpfs_cache_hits_total', 'Cache lookups finding an up to date value.', ('cache',),
+                function=_cache_metric('hits'))
+metrics.Counter('httpfs_cache_misses_total', 'Cache lookups finding no value or a stale one.', ('cache',),
+                function=_cache_metric('misses'))
+metrics.Counter('httpfs_cache_evictions_total', 'Values dropped to make room for new ones.', ('cache',),
+                function=_cache_metric('evictions'))
+metrics.Gauge('httpfs_cache_size_bytes', 'Total size of the cached values, with a fixed overhead per entry.', ('cache',),
+              function=_cache_metric('size'))
 
 def set_dir(path: str = '.'):
     """Sets the directory for the file manager
     :param path: Path to the directory
     """
-    global file_manager_directory
+    global file_manager_directory, file_manager_index
     if os.path.isdir(path):
         file_manager_directory = path
+        file_manager_index = DirectoryIndex(path, file_manager_reserved_prefix)
+        file_manager_cache.clear()
+        file_manager_gzip_cache.clear()
+        if file_manager_process_lock:
+            set_process_shared(True)
+        set_storage(storage_name())
     else:
         raise RuntimeError('The given path is not a directory')
 
 
+def set_storage(name: str = 'directory'):
+    """Sets the backend storing the written files
+    :param name: 'directory' to store each file as a plain file, 'content' to store each distinct
+        content once and link the files to it.
+    """
+    global file_manager_storage
+    if name not in STORAGES:
+        raise ValueError('Unknown storage {}'.format(name))
+    file_manager_storage = STORAGES[name](file_manager_directory, _exclusive)
+
+
+def storage_name():
+    """Returns the name of the storage backend"""
+    for name, storage in STORAGES.items():
+        if type(file_manager_storage) is storage:
+            return name
+
+
+def content_tag(st: os.stat_result):
+    """Returns a tag of the content of a file, the same for all the files with the same content,
+    or None if the storage backend does not know it.
+    :param st: Status of the file from stat_file.
+    :return: (str) sha256 of the content or None
+    """
+    return file_manager_storage.content_tag(st)
+
+
+def set_process_shared(shared: bool = True):
+    """Sets whether other processes write to the directory at the same time, like the workers of
+    the pre-fork mode. The writes then also hold an fcntl lock on a hidden file of the directory.
+    Must be called in each process, after the fork.
+    :param shared: True to lock the writes across processes.
+    """
+    global file_manager_process_lock
+    if file_manager_process_lock:
+        file_manager_process_lock.close()
+        file_manager_process_lock = None
+    if shared:
+        file_manager_process_lock = ProcessLock(_path(file_manager_process_lock_name))
+
+
+def set_durability(mode: str = 'none', commit_window: float = 0.002):
+    """Sets when the writes are made durable
+    :param mode: 'none' to leave the writes to the page cache, 'per-write' to fsync each write,
+        'group' to fsync the concurrent writes together.
+    :param commit_window: Seconds the group commit waits for more writes to join a batch.
+    """
+    global file_manager_durability, file_manager_commit_window, file_manager_committer
+    if mode not in DURABILITY_MODES:
+        raise ValueError('Unknown durability mode {}'.format(mode))
+    file_manager_durability = mode
+    file_manager_commit_window = commit_window
+    file_manager_committer = None
+    if mode == 'group':
+        file_manager_committer = GroupCommitter(commit_window)
+        file_manager_committer.start()
+
+
+def _restart_committer():
+    """The group commit thread does not survive a fork, the child process starts its own"""
+    if file_manager_committer:
+        set_durability(file_manager_durability, file_manager_commit_window)
+
+
+os.register_at_fork(after_in_child=_restart_committer)
+
+
+def set_cache(size: int = 32 << 20, max_file_size: int = 1 << 20):
+    """Sets the limits of the file content cache
+    :param size: Total size of the cached files in bytes, 0 disables the cache.
+    :param max_file_size: Files larger than this are never cached.
+    """
+    global file_manager_cache_max_file_size
+    file_manager_cache.clear()
+    file_manager_cache.max_size = size
+    file_manager_cache_max_file_size = min(size, max_file_size)
+
+
+def set_gzip_cache(size: int = 32 << 20):
+    """Sets the limit of the gzip variant cache
+    :param size: Total size of the compressed files in bytes, 0 disables compression.
+    """
+    file_manager_gzip_cache.clear()
+    file_manager_gzip_cache.max_size = size
+
+
+def cache_stats():
+    """Returns the entries, size, hits, misses and evictions counters of the file content cache
+    :return: (dict) Cache counters
+    """
+    return file_manager_cache.stats()
+
+
+def gzip_cache_stats():
+    """Returns the entries, size, hits, misses and evictions counters of the gzip variant cache
+    :return: (dict) Cache counters
+    """
+    return file_manager_gzip_cache.stats()
+
+
 def list_dir():
     """Returns a list of all files in the directory
     :return: List of files in the directory
     """
-    return [
-        f for f in os.listdir(file_manager_directory)
-        if os.path.isfile("/".join((file_manager_directory, f)))
-    ]
+    return file_manager_index.page()[0]
+
+
+def list_dir_page(prefix: str = '', cursor: str = None, limit: int = None):
+    """Returns a page of the sorted list of files in the directory
+    :param prefix: Only files starting with prefix are listed.
+    :param cursor: Only files after the cursor are listed, pass the cursor returned for the previous page.
+    :param limit: Maximum number of files listed, None for all.
+    :return: (files, cursor) Files of the page and the cursor of the next page, None if this is the last page.
+    """
+    return file_manager_index.page(prefix, cursor, limit)
+
+
+def _path(filename: str):
+    """Returns the path of a file in the directory"""
+    return os.path.join(file_manager_directory, filename)
+
+
+def _reserved(filename: str):
+    """Returns whether the name is one of the files used by the server"""
+    return filename.startswith(file_manager_reserved_prefix)
+
+
+def _check_file(filename: str):
+    """Throws an error if the filename is not a file directly in the directory"""
+    # Do not continue if there's a directory or the name isn't a file
+    if os.path.dirname(filename) or _reserved(filename) or not os.path.isfile(_path(filename)):
+        raise ValueError("Invalid filename")
 
 
 def get_file(filename: str):
@@ -47,30 +237,241 @@ def get_file(filename: str):
         files = os.listdir('/')
         return files.join('\n')
 
-    # Do not continue if there's a directory or the name isn't a file
-    if os.path.dirname(filename) or not os.path.isfile(filename):
+    _check_file(filename)
+
+    with file_manager_locks.read(filename):
+        with open(_path(filename), mode='r') as f:
+            read_data =  f.read()
+    return read_data
+
+
+def stat_file(filename: str):
+    """Returns the status of a file without opening it
+    Throws an error if the file is a directory or a subdirectory exists
+
+    :param filename: File name
+    :return: (os.stat_result) Status of the file
+    """
+    if os.path.dirname(filename) or _reserved(filename):
+        raise ValueError("Invalid filename")
+    try:
+        st = os.stat(_path(filename))
+    except OSError:
+        raise ValueError("Invalid filename")
+    if not stat.S_ISREG(st.st_mode):
         raise ValueError("Invalid filename")
+    return st
+
+
+def read_file(filename: str, st: os.stat_result = None):
+    """Retrieve the data of a small file, from the cache if the file did not change since it was cached.
+    Throws an error if the file is a directory or a subdirectory exists
+
+    :param filename: File name
+    :param st: Status of the file if the caller already has it from stat_file.
+    :return: (bytes) Data of the file, or None if the file is too large to be cached.
+    """
+    st = st or stat_file(filename)
 
-    file_manager_lock.read_acquire()
+    data = file_manager_cache.get(filename, _validator(st))
+    if data is not None or st.st_size > file_manager_cache_max_file_size:
+        return data
+
+    with file_manager_locks.read(filename):
+        f = open(_path(filename), mode='rb')
+    with f:
+        # The file may have been replaced since the stat
+        st = os.fstat(f.fileno())
+        data = f.read()
+    file_manager_cache.put(filename, data, _validator(st))
+    return data
+
+
+def read_gzip(filename: str, st: os.stat_result = None):
+    """Retrieve the gzip compressed data of a file. A file is only compressed once per version.
+    Throws an error if the file is a directory or a subdirectory exists
+
+    :param filename: File name
+    :param st: Status of the file if the caller already has it from stat_file.
+    :return: (bytes) Compressed data of the file, or None if the file is too small, too large
+        or does not compress well.
+    """
+    st = st or stat_file(filename)
+    if not file_manager_gzip_cache.max_size or not \
+            file_manager_gzip_min_size <= st.st_size <= min(file_manager_gzip_max_size, file_manager_gzip_cache.max_size):
+        return None
+
+    data = file_manager_gzip_cache.get(filename, _validator(st))
+    if data is None:
+        with open_file(filename) as f:
+            st = os.fstat(f.fileno())
+            raw_data = f.read()
+        data = gzip.compress(raw_data, mtime=0)
+        if len(data) > file_manager_gzip_min_ratio * len(raw_data):
+            data = b''
+        file_manager_gzip_cache.put(filename, data, _validator(st))
+    return data or None
+
+
+def _validator(st: os.stat_result):
+    """Returns what identifies a version of a file: a write replaces the inode, an edit in place
+    changes the size or modification time."""
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+@contextmanager
+def open_file(filename: str):
+    """Opens a file for reading in binary mode
+    The read lock is only held while opening: writes replace the file instead of rewriting it,
+    so the open file keeps its content until it is closed.
+    Throws an error if the file is a directory or a subdirectory exists
+
+    :param filename: File name
+    :return: (BufferedReader) The open file
+    """
+    _check_file(filename)
+
+    with file_manager_locks.read(filename):
+        f = open(_path(filename), mode='rb')
+    with f:
+        yield f
+
+
+@contextmanager
+def open_files(filenames):
+    """Opens several files for reading in binary mode, as they were at the same instant
+    The read locks of all the files are taken, in sorted order, then the files are opened and the
+    locks released: no write can land between the opening of two of the files.
+    Names which are not files directly in the directory are skipped.
+
+    :param filenames: File names, duplicates are only opened once.
+    :return: (list) (name, BufferedReader) of the open files, in the order of filenames.
+    """
+    names = [name for name in dict.fromkeys(filenames) if not os.path.dirname(name) and not _reserved(name)]
+    files = {}
     try:
-        with open(filename, mode='r') as f:
-            read_data =  f.read()
+        with ExitStack() as locks:
+            for name in sorted(names):
+                locks.enter_context(file_manager_locks.read(name))
+            for name in names:
+                try:
+                    f = open(_path(name), mode='rb')
+                except OSError:
+                    continue
+                files[name] = f
+                if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                    del files[name]
+                    f.close()
+        yield [(name, files[name]) for name in names if name in files]
     finally:
-        file_manager_lock.read_release()
-    return read_data
+        for f in files.values():
+            f.close()
 
 
-def write_file(filename: str, data: str):
+def write_file(filename: str, data, buffer_size: int = 65536):
     """Writes the data to the given file
+    The data is first written to a temporary file in file_manager_temp_directory without holding the lock,
+    the temporary file then replaces the file under the write lock.
+    Returns once the write is durable if the durability mode asks for it.
     :param filename: File name
-    :param data: (str) Data to write, txt only.
+    :param data: (str, bytes or file-like object with readinto) Data to write.
+    :param buffer_size: Size of the blocks copied from a file-like object.
     """
     if os.path.dirname(filename):
         raise ValueError("Filename specifies an existing directory.")
+    if _reserved(filename):
+        raise ValueError("Filename is reserved by the server.")
 
-    file_manager_lock.write_acquire()
+    directory = file_manager_directory
+    committer = file_manager_committer
+    storage = file_manager_storage
+    temp_directory = os.path.join(directory, file_manager_temp_directory)
     try:
-        with open(filename, mode='w') as f:
-            f.write(data)
-    finally:
-        file_manager_lock.write_release()
+        fd, temp_path = tempfile.mkstemp(prefix=file_manager_temp_prefix, dir=temp_directory)
+    except FileNotFoundError:
+        os.makedirs(temp_directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=file_manager_temp_prefix, dir=temp_directory)
+    try:
+        with open(fd, mode='wb') as f:
+            out = HashingWriter(f, hashlib.sha256()) if storage.hashes else f
+            if isinstance(data, str):
+                out.write(data.encode('UTF-8'))
+            elif isinstance(data, (bytes, bytearray)):
+                out.write(data)
+            else:
+                _copy(data, out, buffer_size)
+            digest = out.hash.hexdigest() if storage.hashes else None
+            # mkstemp creates the file readable by the owner only
+            os.fchmod(f.fileno(), _file_mode(filename))
+            f.flush()
+            if committer:
+                committer.commit(f.fileno(), directory, lambda: _replace(storage, temp_path, filename, digest))
+                return
+            if file_manager_durability == 'per-write':
+                os.fsync(f.fileno())
+
+        _replace(storage, temp_path, filename, digest)
+        if file_manager_durability == 'per-write':
+            fsync_directory(directory)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _replace(storage: DirectoryStorage, temp_path: str, filename: str, digest: str = None):
+    """Replaces the file by the written temporary file under the write lock"""
+    path = storage.store(temp_path, digest)
+    try:
+        with _exclusive(filename):
+            try:
+                replaced = os.stat(_path(filename))
+            except OSError:
+                replaced = None
+            if replaced and os.path.samestat(replaced, os.stat(path)):
+                # The same content again: a rename between two links of a file does nothing
+                os.remove(path)
+                return
+            with file_manager_index.adding(filename):
+                os.replace(path, _path(filename))
+            file_manager_cache.invalidate(filename)
+            file_manager_gzip_cache.invalidate(filename)
+    except BaseException:
+        if path != temp_path:
+            os.remove(path)
+        raise
+    if replaced:
+        storage.release(replaced)
+
+
+@contextmanager
+def _exclusive(name: str):
+    """Holds the write lock of a name, across processes if the directory is shared"""
+    with file_manager_locks.write(name), _process_lock(name):
+        yield
+
+
+def _process_lock(filename: str):
+    """Returns the context holding the lock of a file across processes, if the directory is shared"""
+    return file_manager_process_lock.hold(filename) if file_manager_process_lock else nullcontext()
+
+
+def _copy(source, destination, buffer_size: int):
+    """Copies a file-like object with readinto to a file, one block at a time"""
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        count = source.readinto(buffer)
+        if not count:
+            break
+        destination.write(view[:count])
+
+
+def _file_mode(filename: str):
+    """Returns the permissions of the file, or the default permissions of a new file"""
+    try:
+        return stat.S_IMODE(os.stat(_path(filename)).st_mode)
+    except OSError:
+        return 0o644
@@ -0,0 +1,99 @@
+"""Group commit of durable writes"""
+
+import os
+import time
+from queue import Queue, Empty
+from threading import Event, Thread
+import metrics
+
+commit_batch_size = metrics.Histogram(
+    'httpfs_commit_batch_size', 'Writes made durable by one group commit.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class GroupCommitter(Thread):
+    """Makes the writes durable in batches.
+
+    A writer fsyncs its temporary file, hands over the function renaming it, then waits. The data
+    fsyncs of the writers run in parallel, outside of any lock, and the file system merges them in
+    its journal commits. The committer thread waits for the commit window to let more writers join,
+    then renames the whole batch and fsyncs each directory once: the directory fsync, which every
+    write needs after its rename, is shared by the batch.
+
+    Attributes:
+        window (float): Seconds a batch stays open after its first write.
+        max_batch (int): Maximum number of writes in a batch.
+        commits (int): Number of batches committed.
+    """
+
+    def __init__(self, window: float = 0.002, max_batch: int = 256):
+        super().__init__()
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = Queue()
+        self.commits = 0
+        self.setDaemon(True)
+
+    def commit(self, fd: int, directory: str, replace):
+        """Makes a write durable, returns once its batch is committed.
+        Throws the error of the fsync or of replace if the write failed.
+        :param fd: Open file descriptor of the written temporary file.
+        :param directory: Directory of the file.
+        :param replace: Function renaming the temporary file to its name.
+        """
+        os.fsync(fd)
+        job = _Commit(directory, replace)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error:
+            raise job.error
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            if self.window:
+                time.sleep(self.window)
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        for job in batch:
+            try:
+                job.replace()
+            except Exception as err:
+                job.error = err
+        for directory in {job.directory for job in batch if not job.error}:
+            try:
+                fsync_directory(directory)
+            except OSError as err:
+                for job in batch:
+                    if job.directory == directory:
+                        job.error = job.error or err
+        self.commits += 1
+        commit_batch_size.observe(len(batch))
+        for job in batch:
+            job.done.set()
+
+
+class _Commit:
+    """A write waiting for its group commit"""
+    __slots__ = ('directory', 'replace', 'error', 'done')
+
+    def __init__(self, directory: str, replace):
+        self.directory = directory
+        self.replace = replace
+        self.error = None
+        self.done = Event()
+
+
+def fsync_directory(directory: str):
+    """Makes the renames in a directory durable"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,52 +1,357 @@
 import logger
+import metrics
 import http_server
+import async_server
+import prefork
 import json
-from file_manager import set_dir, list_dir, get_file, write_file
+import mimetypes
+import os
+import stat
+import tarfile
+from fnmatch import fnmatchcase
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs
+from file_manager import set_dir, set_process_shared, list_dir_page, stat_file, read_file, read_gzip, open_file, \
+    open_files, write_file, content_tag
 from http_server import HTTPHandler
 
+LISTING_BLOCK_SIZE = 1000
+MAX_RANGES = 16
+# Path of the metrics in the Prometheus text format, it hides a file with the same name
+METRICS_PATH = '/_metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Path of the batch fetch: GET with a glob or POST with a list of names, answered with a tar archive
+BATCH_PATH = '/_batch'
+BATCH_MAX_FILES = 500
+BATCH_MAX_REQUEST_SIZE = 1 << 20
+BATCH_BLOCK_SIZE = 65536
+TAR_BLOCK_SIZE = 512
+TAR_RECORD_SIZE = 10240
+INCOMPRESSIBLE_SUBTYPES = {'zip', 'gzip', 'x-gzip', 'x-bzip2', 'x-xz', 'x-7z-compressed', 'x-rar-compressed',
+                           'pdf', 'x-tar', 'octet-stream'}
 
-def start_file_server(host, port: int, directory: str = '.'):
+
+def start_file_server(host, port: int, directory: str = '.', engine: str = 'threaded', workers: int = 0,
+                      **server_options):
     """Start the HTTP file server with host and listening on port This will use http_server module.
     Uses the HTTPHandlerFs as the HTTPHandler
     :param host: hostname of the server.
     :param port: port to listen for new connection.
     :param directory: (str) Directory for the file server. Defaults to current directory.
+    :param engine: (str) 'threaded' to serve each connection with a worker thread,
+        'async' to serve the connections on an asyncio event loop.
+    :param workers: (int) Number of worker processes sharing the port, 0 to serve in this process.
+    :param server_options: Connection pool options passed on to start_server.
     """
     set_dir(directory)
-    http_server.start_server(host, port, HTTPHandlerFs)
+    if workers:
+        def start_worker():
+            set_process_shared(True)
+            _start_server(host, port, engine, reuse_port=True, **server_options)
+        prefork.start_workers(workers, start_worker)
+    else:
+        _start_server(host, port, engine, **server_options)
+
+
+def _start_server(host, port: int, engine: str, **server_options):
+    """Starts the server of the engine with HTTPHandlerFs"""
+    if engine == 'async':
+        async_server.start_server(host, port, HTTPHandlerFs, **server_options)
+    else:
+        http_server.start_server(host, port, HTTPHandlerFs, **server_options)
+
+
+def _content_type(filename: str):
+    """Returns the Content-Type of a file from its extension"""
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def _etag(st, encoding: str = None):
+    """Returns the entity tag of a version of a file: the hash of its content if the storage knows it,
+    otherwise from its inode, size and modification time.
+    Each content encoding of the file gets its own tag.
+    """
+    tag = content_tag(st) or '{:x}-{:x}-{:x}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+    return '"{}-{}"'.format(tag, encoding) if encoding else '"{}"'.format(tag)
+
+
+def _compressible(content_type: str):
+    """Returns whether files of this type may be worth compressing. Formats which are already
+    compressed are excluded, the others are only sent compressed if they compress well."""
+    kind, _, subtype = content_type.partition('/')
+    if kind in ('image', 'audio', 'video'):
+        return subtype == 'svg+xml'
+    return subtype not in INCOMPRESSIBLE_SUBTYPES
+
+
+def _accepts_gzip(headers: dict):
+    """Returns whether the Accept-Encoding header of the request allows gzip"""
+    qvalues = {}
+    for coding in headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+
+def _parse_ranges(header: str, size: int):
+    """Parses a Range header: bytes=first-last, bytes=first- or bytes=-suffix_length, comma separated.
+    :param header: Value of the Range header
+    :param size: Size of the file
+    :return: list of (first, last) byte positions, [] if none can be satisfied, None if the header
+        is invalid and should be ignored.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    try:
+        for spec in specs:
+            first, dash, last = spec.strip().partition('-')
+            # int() would also take signs and underscores
+            if not dash or not all(part.isdigit() for part in (first, last) if part):
+                return None
+            if not first:
+                length = int(last)
+                if length > 0 and size > 0:
+                    ranges.append((max(0, size - length), size - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+            if first < 0 or (last is not None and last < first):
+                return None
+            if first < size:
+                ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+    except ValueError:
+        return None
+    return ranges
+
+
+def _listing_json(files: list, cursor: str):
+    """Yields the JSON directory listing, LISTING_BLOCK_SIZE files at a time"""
+    yield b'{"files": ['
+    for i in range(0, len(files), LISTING_BLOCK_SIZE):
+        block = ", ".join(json.dumps(f) for f in files[i:i + LISTING_BLOCK_SIZE])
+        yield ((", " if i else "") + block).encode('UTF-8')
+    yield '], "next_cursor": {}}}'.format(json.dumps(cursor)).encode('UTF-8')
+
+
+def _tar_stream(files: list):
+    """Yields a tar archive of open files, in blocks of about BATCH_BLOCK_SIZE bytes.
+    The headers and content of small files are grouped in the same block.
+    :param files: list of (name, open file)
+    """
+    block = bytearray()
+    # Bytes yielded so far, the archive is padded to a whole number of records
+    total = 0
+    for name, f in files:
+        st = os.fstat(f.fileno())
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = stat.S_IMODE(st.st_mode)
+        block += info.tobuf(tarfile.PAX_FORMAT, 'UTF-8', 'surrogateescape')
+        remaining = st.st_size
+        while remaining:
+            data = f.read(min(remaining, BATCH_BLOCK_SIZE))
+            if not data:
+                # Truncated in place outside the server, the archive still needs the announced size
+                data = bytes(min(remaining, BATCH_BLOCK_SIZE))
+            remaining -= len(data)
+            block += data
+            if len(block) >= BATCH_BLOCK_SIZE:
+                yield bytes(block)
+                total += len(block)
+                block.clear()
+        block += bytes(-st.st_size % TAR_BLOCK_SIZE)
+    # End of archive: two empty blocks, padded to a whole record
+    block += bytes(2 * TAR_BLOCK_SIZE)
+    total += len(block)
+    block += bytes(-total % TAR_RECORD_SIZE)
+    yield bytes(block)
 
 
 class HTTPHandlerFs(HTTPHandler):
     def do_GET(self):
-        logger.write('Handler GET requestURL: {}'.format(self.request.preamble.url))
+        logger.write('Handler GET requestURL: {}', self.request.preamble.url)
 
-        url = self.request.preamble.url
+        url, _, query = self.request.preamble.url.partition("?")
         if url == "/":
-            files = json.dumps({'files': list_dir()})
-            self.server.send_response(files, {"Content-Type": "application/json"})
+            self._send_listing(parse_qs(query))
+        elif url == METRICS_PATH:
+            self.server.send_response(metrics.render(), {'Content-Type': METRICS_CONTENT_TYPE})
+        elif url == BATCH_PATH:
+            pattern = parse_qs(query).get('glob', [None])[0]
+            if pattern is None:
+                self.server.send_error("400", "Bad Request")
+                return
+            # Only the names starting with the part of the pattern before the first wildcard can match
+            wildcards = [i for i in (pattern.find(c) for c in '*?[') if i >= 0]
+            prefix = pattern[:min(wildcards)] if wildcards else pattern
+            self._send_batch([name for name in list_dir_page(prefix)[0] if fnmatchcase(name, pattern)])
         elif not url.startswith("/"):
             self.server.send_error("400", "Bad Request")
         else:
             try:
-                self.server.send_response(get_file(url.lstrip("/")), {"Content-Type": "text/*"})
+                self._send_file(url.lstrip("/"))
             except Exception as err:
                 logger.write(err)
-                self.server.send_error("404", "Not Found")
+                if not self.server.response_sent:
+                    self.server.send_error("404", "Not Found")
+
+    def _send_file(self, filename: str):
+        """Sends a file, or the part of it the request asks for
+        Compressible files are sent gzip compressed to clients accepting it.
+        """
+        st = stat_file(filename)
+        content_type = _content_type(filename)
+        etag = _etag(st)
+        gzip_etag = _etag(st, 'gzip')
+        validators = {"ETag": etag, "Last-Modified": formatdate(st.st_mtime, usegmt=True)}
+        headers = {"Content-Type": content_type, "Accept-Ranges": "bytes"}
+        if _compressible(content_type):
+            headers["Vary"] = "Accept-Encoding"
+
+        matched_etag = self._not_modified(st, (etag, gzip_etag))
+        if matched_etag:
+            self.server.send_not_modified(dict(validators, ETag=matched_etag))
+            return
+        ranges = self._requested_ranges(st, validators)
+        if ranges == []:
+            self.server.send_error(416, "Range Not Satisfiable",
+                                   {"Content-Range": "bytes */{}".format(st.st_size)})
+            return
+
+        # Ranges are positions in the uncompressed file
+        if ranges is None and "Vary" in headers and _accepts_gzip(self.request.preamble.headers):
+            data = read_gzip(filename, st)
+            if data is not None:
+                headers.update(validators, ETag=gzip_etag)
+                headers["Content-Encoding"] = "gzip"
+                self.server.send_response(data, headers)
+                return
+
+        headers.update(validators)
+        data = None if ranges else read_file(filename, st)
+        if data is not None:
+            self.server.send_response(data, headers)
+        else:
+            with open_file(filename) as f:
+                self.server.send_file(f, headers, ranges)
+
+    def _not_modified(self, st, etags: tuple):
+        """Checks the conditional headers of the request against the current version of the file.
+        If-None-Match takes precedence over If-Modified-Since.
+        :param etags: Entity tags of the variants of the file, the uncompressed one first.
+        :return: (str) The entity tag of the variant the client has, None if it must be sent.
+        """
+        headers = self.request.preamble.headers
+        if 'If-None-Match' in headers:
+            tags = [t.strip() for t in headers['If-None-Match'].split(',')]
+            # Weak comparison, a W/ prefix does not matter for GET
+            tags = [t[2:] if t.startswith('W/') else t for t in tags]
+            if '*' in tags:
+                return etags[0]
+            return next((etag for etag in etags if etag in tags), None)
+        if 'If-Modified-Since' in headers:
+            try:
+                since = parsedate_to_datetime(headers['If-Modified-Since']).timestamp()
+            except (TypeError, ValueError):
+                return None
+            return etags[0] if int(st.st_mtime) <= since else None
+        return None
+
+    def _requested_ranges(self, st, validators: dict):
+        """Returns the byte ranges of the Range header that apply to the current version of the file.
+        :return: list of (first, last) byte positions, [] if none can be satisfied,
+            None to send the whole file.
+        """
+        headers = self.request.preamble.headers
+        if 'Range' not in headers:
+            return None
+        # The range only applies to the version of the file the client has
+        if 'If-Range' in headers and headers['If-Range'] not in validators.values():
+            return None
+        return _parse_ranges(headers['Range'], st.st_size)
+
+    def _send_listing(self, query: dict):
+        """Sends a page of the directory listing as JSON: {"files": [...], "next_cursor": ...}
+        The query can have a prefix, a cursor and a limit on the number of files.
+        """
+        try:
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            if limit is not None and limit < 1:
+                raise ValueError('Invalid limit {}'.format(limit))
+        except ValueError as err:
+            logger.write(err)
+            self.server.send_error("400", "Bad Request")
+            return
+        files, cursor = list_dir_page(query.get('prefix', [''])[0], query.get('cursor', [None])[0], limit)
+        listing = _listing_json(files, cursor)
+        if len(files) <= LISTING_BLOCK_SIZE:
+            self.server.send_response(b''.join(listing), {"Content-Type": "application/json"})
+        else:
+            self.server.send_stream(listing, {"Content-Type": "application/json"})
+
+    def _send_batch(self, names: list):
+        """Sends the files as a tar archive, as they were at the same instant. Missing files are skipped,
+        the X-Batch-Files header has the number of files in the archive.
+        """
+        if len(names) > BATCH_MAX_FILES:
+            logger.write('Batch of {} files, the limit is {}', len(names), BATCH_MAX_FILES)
+            self.server.send_error("400", "Bad Request")
+            return
+        with open_files(names) as files:
+            self.server.send_stream(_tar_stream(files), {"Content-Type": "application/x-tar",
+                                                         "X-Batch-Files": len(files)})
+
+    def _post_batch(self):
+        """Sends the files named in the request body, {"files": [...]} like the listing or a JSON list"""
+        if self.request.body.length > BATCH_MAX_REQUEST_SIZE:
+            self.server.send_error(413, 'Payload Too Large')
+            return
+        try:
+            names = json.loads(self.request.body.read().decode('UTF-8'))
+            if isinstance(names, dict):
+                names = names['files']
+            if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+                raise ValueError('Batch names must be a list of strings')
+        except (ValueError, KeyError) as err:
+            logger.write(err)
+            self.server.send_error("400", "Bad Request")
+            return
+        self._send_batch(names)
 
     def do_POST(self):
-        logger.write('Handler POST requestURL: {}'.format(self.request.preamble.url))
+        logger.write('Handler POST requestURL: {}', self.request.preamble.url)
 
         url = self.request.preamble.url
         if not url.startswith("/"):
             self.server.send_error("400", "Bad Request")
+        elif url == BATCH_PATH:
+            self._post_batch()
         else:
             try:
-                write_file(url.lstrip("/"), self.request.body)
+                write_file(url.lstrip("/"), self.request.body, http_server.http_server_upload_buffer_size)
                 self.server.send_response()
+            except http_server.RequestTimeout:
+                # Answered with 408 by the server
+                raise
             except Exception as err:
                 logger.write(err)
                 self.server.send_error("400", "Bad Request")
             logger.write('File correctly added')
 
     def do_invalid_method(self):
-        logger.write('Invalid Method \n{}'.format(self.request))
+        logger.write('Invalid Method \n{}', self.request)
+        self.server.send_error(501, 'Not Implemented')
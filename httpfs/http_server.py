@@ -1,163 +1,642 @@
 """Implements the socket listener and parsing of input."""
 
+import os
+import select
 import socket
+import time
+import uuid
 import logger
-from threading import Thread
+import metrics
+from threading import Event, Thread, active_count
+from queue import Queue, Full
 from abc import ABC, abstractmethod
 
-http_server_version = 'HTTP/1.0'
+http_server_version = 'HTTP/1.1'
 http_server_name = 'PoorServer'
 http_server_CRLF = '\r\n'.encode('UTF-8')
 http_server_CR = '\r'.encode('UTF-8')
 http_server_LF = '\n'.encode('UTF-8')
+http_server_max_preamble_size = 16384
+http_server_buffer_size = 65536
+http_server_keep_alive_timeout = 15.0
+# Seconds between the checks of the connection queue by a worker waiting on an idle connection
+http_server_idle_poll_interval = 0.1
+http_server_max_keep_alive_requests = 100
+http_server_pool_size = 64
+http_server_queue_size = 256
+http_server_backlog = 128
+http_server_retry_after = 1
+http_server_max_body_size = 1 << 30
+http_server_upload_buffer_size = 65536
+http_server_shutdown_timeout = 10.0
+# Seconds to receive the whole request line and headers once their first byte arrived
+http_server_header_timeout = 10.0
+# Seconds to wait for the next part of a request body
+http_server_body_timeout = 30.0
+# Bytes per second a request body must be received at on average, after the first body timeout
+http_server_min_body_rate = 1024
+# Set when the server stops: the connections are closed after their current request
+http_server_stopping = Event()
+# Methods reported in the metrics, the others are counted as 'other'
+http_server_known_methods = {'GET', 'POST', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'PATCH'}
+
+requests_total = metrics.Counter(
+    'httpfs_requests_total', 'Requests answered, by method and status code.', ('method', 'status'))
+request_duration_seconds = metrics.Histogram(
+    'httpfs_request_duration_seconds', 'Time from the end of the request headers to the end of the response.',
+    ('method',))
+received_bytes_total = metrics.Counter(
+    'httpfs_received_bytes_total', 'Bytes of the request headers and bodies.', ('method',))
+sent_bytes_total = metrics.Counter(
+    'httpfs_sent_bytes_total', 'Bytes of the responses.', ('method',))
+timeouts_total = metrics.Counter(
+    'httpfs_timeouts_total', 'Connections closed by a timeout: idle, header or body.', ('phase',))
+active_connections = metrics.Gauge(
+    'httpfs_active_connections', 'Connections being served.')
+metrics.Gauge('httpfs_threads', 'Threads of the process.', function=active_count)
+
+
+def set_keep_alive(timeout: float = 15.0, max_requests: int = 100):
+    """Sets the persistent connection limits
+    :param timeout: Seconds an idle connection is kept open waiting for the next request.
+    :param max_requests: Maximum number of requests served on one connection.
+    """
+    global http_server_keep_alive_timeout, http_server_max_keep_alive_requests
+    if timeout <= 0 or max_requests < 1:
+        raise ValueError('Keep-alive timeout and max requests must be positive')
+    http_server_keep_alive_timeout = timeout
+    http_server_max_keep_alive_requests = max_requests
+
+
+def set_timeouts(header_timeout: float = 10.0, body_timeout: float = 30.0, min_body_rate: int = 1024):
+    """Sets the deadlines protecting the server from slow clients. The idle deadline is the keep-alive timeout.
+    :param header_timeout: Seconds to receive the request line and headers once the first byte arrived.
+    :param body_timeout: Seconds to wait for the next part of a request body.
+    :param min_body_rate: Bytes per second a request body must be received at on average, once
+        body_timeout seconds passed, 0 to disable the check.
+    """
+    global http_server_header_timeout, http_server_body_timeout, http_server_min_body_rate
+    if header_timeout <= 0 or body_timeout <= 0 or min_body_rate < 0:
+        raise ValueError('Invalid timeouts')
+    http_server_header_timeout = header_timeout
+    http_server_body_timeout = body_timeout
+    http_server_min_body_rate = min_body_rate
+
+
+def set_upload_limits(max_body_size: int = 1 << 30, buffer_size: int = 65536):
+    """Sets the limits of the request bodies
+    :param max_body_size: Largest Content-Length accepted, larger requests are answered with 413.
+    :param buffer_size: Memory used to stream a request body, in bytes.
+    """
+    global http_server_max_body_size, http_server_upload_buffer_size
+    if max_body_size < 0 or buffer_size < 1:
+        raise ValueError('Invalid upload limits')
+    http_server_max_body_size = max_body_size
+    http_server_upload_buffer_size = buffer_size
+
+
+def record_request(client_addr, preamble: 'RequestPreamble', server: 'HTTPServer', received: int, started: float):
+    """Records a request in the metrics and the access log
+    :param client_addr: Address of the client.
+    :param preamble: Request line and headers, None if they were not read or could not be parsed.
+    :param server: HTTPServer which answered the request.
+    :param received: Bytes read for the request.
+    :param started: time.perf_counter() when the request headers were read.
+    """
+    duration = time.perf_counter() - started
+    method = preamble.http_method if preamble else None
+    logger.access(client_addr, method or '-', preamble.url if preamble else '-', server.status or '-',
+                  server.bytes_sent, duration)
+    method = (method if method in http_server_known_methods else 'other') if method else 'unknown'
+    key = (method,)
+    requests_total.inc((method, server.status or 'none'))
+    request_duration_seconds.observe(duration, key)
+    received_bytes_total.inc(key, received)
+    sent_bytes_total.inc(key, server.bytes_sent)
+
+
+def keep_alive_requested(preamble: 'RequestPreamble'):
+    """Returns whether the client wants the connection to stay open after the response.
+    HTTP/1.1 connections are persistent unless the client sends Connection: close,
+    HTTP/1.0 connections only if the client sends Connection: keep-alive.
+    """
+    tokens = [t.strip().lower() for t in preamble.headers.get('Connection', '').split(',')]
+    if 'close' in tokens:
+        return False
+    return preamble.http_version == 'HTTP/1.1' or 'keep-alive' in tokens
 
 
-def _recvline(sock: socket.socket):
-    """Receive a single line from the socket until EOF, close, or CRLF and
-    return as a byte string.
+class PreambleTooLarge(Exception):
+    """Raised when the request line and headers exceed the preamble size limit."""
+    pass
+
+
+class RequestTimeout(Exception):
+    """Raised when a request is not received before its deadline.
+
+    Attributes:
+        phase (str): 'header' or 'body'.
     """
-    BUFFER_SIZE = 1
-
-    data = b""
-    while True:
-        last_buff = sock.recv(BUFFER_SIZE)
-        if not last_buff:
-            break
-        data += last_buff
-        if data.endswith(http_server_CRLF):
-            break
-    return data
-
-
-def _recvall(sock: socket.socket, length: int):
-    """Receive all data from the socket until length, EOF, or close and return
-    as a byte string.
+    def __init__(self, phase: str):
+        super().__init__('Timeout receiving the request {}'.format(phase))
+        self.phase = phase
+
+
+class SocketReader:
+    """Buffered reader over a connection socket.
+
+    Data is received with recv_into into a single reusable buffer, so the
+    preamble costs one syscall per segment instead of one per byte. Bytes
+    received past the end of a request stay buffered for the next read.
     """
-    BUFFER_SIZE = 8192
 
-    data = b""
-    while True:
-        last_buff = sock.recv(BUFFER_SIZE)
-        data += last_buff
-        if not last_buff or len(data) >= length:
-            break
-    return data
+    def __init__(self, sock: socket.socket, buffer_size: int = None):
+        """
+        :param sock: connection socket, its timeout is the idle deadline.
+        :param buffer_size: Size of the receive buffer. Must be larger than the preamble size limit.
+        """
+        self.sock = sock
+        self._buffer = bytearray(buffer_size or http_server_buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.recv_calls = 0
+
+    def buffered(self):
+        """Returns the number of bytes received but not consumed yet."""
+        return self._end - self._start
+
+    def read_preamble(self, max_size: int = None):
+        """Receives the request line and headers up to and including the empty line.
+        Waiting for the first byte is bounded by the socket timeout, the rest of the preamble must
+        arrive within http_server_header_timeout, or RequestTimeout is raised.
+        :param max_size: Maximum size of the preamble in bytes.
+        :return: (bytes) The preamble, or None if the connection closed before any data.
+        """
+        max_size = max_size or http_server_max_preamble_size
+        search_from = self._start
+        deadline = time.monotonic() + http_server_header_timeout if self.buffered() else None
+        while True:
+            end = self._find_preamble_end(search_from)
+            if end - self._start > max_size or (end < 0 and self.buffered() > max_size):
+                raise PreambleTooLarge()
+            if end >= 0:
+                preamble = bytes(self._view[self._start:end])
+                self._start = end
+                return preamble
+            # The terminator may straddle the boundary of the next segment.
+            search_from = max(self._start, self._end - 3)
+            count, shift = self._fill(deadline, 'header')
+            if deadline is None:
+                deadline = time.monotonic() + http_server_header_timeout
+            search_from -= shift
+            if not count:
+                if self.buffered():
+                    raise ConnectionError('Connection closed in the middle of the request preamble')
+                return None
+
+    def read_body(self, length: int):
+        """Receives the request body of length bytes.
+        Stops early if the connection is closed.
+        :param length: Content-Length of the body.
+        :return: (bytearray) Data of the body.
+        """
+        body = bytearray(length)
+        body_view = memoryview(body)
+        received = 0
+        while received < length:
+            count = self.readinto(body_view[received:])
+            if not count:
+                del body[received:]
+                break
+            received += count
+        return body
+
+    def readinto(self, b, deadline: float = None):
+        """Receives data into b, from the buffer first, then directly from the socket.
+        :param b: Writable buffer
+        :param deadline: time.monotonic() past which RequestTimeout is raised, None to wait for
+            the socket timeout.
+        :return: (int) Number of bytes received, 0 if the connection is closed.
+        """
+        view = memoryview(b)
+        if self.buffered():
+            count = min(len(view), self.buffered())
+            view[:count] = self._view[self._start:self._start + count]
+            self._start += count
+            return count
+        self.recv_calls += 1
+        return self._recv_into(view, deadline, 'body')
+
+    def _find_preamble_end(self, search_from: int):
+        """Returns the index right after the empty line ending the preamble, or -1."""
+        ends = []
+        crlf = self._buffer.find(b'\n\r\n', search_from, self._end)
+        if crlf >= 0:
+            ends.append(crlf + 3)
+        lf = self._buffer.find(b'\n\n', search_from, self._end)
+        if lf >= 0:
+            ends.append(lf + 2)
+        return min(ends) if ends else -1
+
+    def _fill(self, deadline: float = None, phase: str = None):
+        """Receives the next segment into the buffer, compacting it first if it is full.
+        :return: (received, shift) Number of bytes received and how far the data was moved back.
+        """
+        shift = 0
+        if self._end == len(self._buffer):
+            shift = self._start
+            self._buffer[:self.buffered()] = self._view[self._start:self._end]
+            self._end -= shift
+            self._start = 0
+        count = self._recv_into(self._view[self._end:], deadline, phase)
+        self.recv_calls += 1
+        self._end += count
+        return count, shift
+
+    def _recv_into(self, view, deadline: float, phase: str):
+        """recv_into bounded by the deadline instead of the socket timeout, if there is one"""
+        if deadline is None:
+            return self.sock.recv_into(view)
+        timeout = self.sock.gettimeout()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RequestTimeout(phase)
+        self.sock.settimeout(remaining)
+        try:
+            return self.sock.recv_into(view)
+        except socket.timeout:
+            raise RequestTimeout(phase)
+        finally:
+            self.sock.settimeout(timeout)
 
 
-def start_server(host, port: int, HTTPHandlerImplClass):
+def start_server(host, port: int, HTTPHandlerImplClass, pool_size: int = http_server_pool_size,
+                 queue_size: int = http_server_queue_size, backlog: int = http_server_backlog,
+                 reuse_port: bool = False):
     """Start the HTTP server listening on port and using HTTPHandlerImplClass(HTTPHandler) to handle requests
+    Accepted connections are queued up for a fixed pool of worker threads. When the queue is full,
+    new connections are answered right away with a 503.
+    When the server is stopped by an exception (KeyboardInterrupt, SystemExit), it stops accepting
+    and waits up to http_server_shutdown_timeout for the connections being served.
     :param host: hostname of the server.
     :param port: port to listen for new connection.
     :param HTTPHandlerImplClass: HTTPHandler implementation to handle request
+    :param pool_size: Number of worker threads serving connections.
+    :param queue_size: Number of accepted connections waiting for a worker.
+    :param backlog: Number of connections waiting to be accepted by the listening socket.
+    :param reuse_port: Sets SO_REUSEPORT so several processes can listen on the port.
     """
+    connections = Queue(maxsize=queue_size)
+    for _ in range(pool_size):
+        worker = WorkerThread(connections, host, HTTPHandlerImplClass)
+        worker.setDaemon(True)
+        worker.start()
+
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         listener.bind((host, port))
-        listener.listen(5)
-        logger.write('HTTP server listening at {}'.format(port))
+        listener.listen(backlog)
+        logger.write('HTTP server listening at {}', port)
         while True:
             conn, addr = listener.accept()
-            handler_thread = ConnectionHandlerThread(conn, host, addr,
-                                                     HTTPHandlerImplClass)
-            handler_thread.setDaemon(True)
-            handler_thread.start()
+            try:
+                connections.put_nowait((conn, addr))
+            except Full:
+                logger.write('Connection queue full, rejecting {}', addr)
+                _reject(conn, addr)
     finally:
         listener.close()
+        _finish(connections)
+
+
+def _finish(connections: Queue):
+    """Stops keeping the connections alive and waits for the connections being served, up to
+    http_server_shutdown_timeout."""
+    http_server_stopping.set()
+    deadline = time.monotonic() + http_server_shutdown_timeout
+    while connections.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def _reject(conn: socket.socket, addr):
+    """Answers a connection with 503 without reading its request and closes it."""
+    try:
+        conn.settimeout(1)
+        server = HTTPServer(conn)
+        server.send_error(503, 'Service Unavailable', {'Retry-After': http_server_retry_after})
+        record_request(addr, None, server, 0, time.perf_counter())
+        conn.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+class WorkerThread(Thread):
+    """Worker of the connection pool. Serves the queued up connections one at a time.
+    """
+
+    def __init__(self, connections: Queue, server_host, HTTPHandlerImplClass):
+        """
+        :param connections: Queue of (connection socket, client address) to serve.
+        :param server_host: Host of the server.
+        :param HTTPHandlerImplClass: HTTPHandler implementation to handle request
+        """
+        super().__init__()
+        self.connections = connections
+        self.server_host = server_host
+        self.HTTPHandlerImplClass = HTTPHandlerImplClass
 
+    def run(self):
+        while True:
+            conn, addr = self.connections.get()
+            try:
+                ConnectionHandler(conn, self.server_host, addr, self.HTTPHandlerImplClass, self.connections).run()
+            finally:
+                self.connections.task_done()
 
-class ConnectionHandlerThread(Thread):
-    """Instantiated when a new connection is accepted
+
+class ConnectionHandler:
+    """Instantiated when a worker picks up a new connection
     """
 
     def __init__(self, conn: socket.socket, server_host, client_addr,
-                 HTTPHandlerImplClass):
+                 HTTPHandlerImplClass, connections: Queue = None):
         """
-        Setup the connection thread.
+        Setup the connection handler.
         :param conn: connection socket.
         :param server_host: Host of the server.
         :param client_addr: (host, port) Client details of the connection.
         :param HTTPHandlerImplClass: HTTPHandler implementation to handle request
+        :param connections: Queue of the connections waiting for a worker. The connection is not kept
+            alive while others are waiting.
         """
-        super().__init__()
         self.conn = conn
         self.client_addr = client_addr
         self.server_host = server_host
         self.HTTPHandlerImplClass = HTTPHandlerImplClass
+        self.connections = connections
 
     def run(self):
-        logger.write('Connection accepted from {}'.format(self.client_addr))
+        """Serves requests on the connection until the client closes it, a request asks
+        to close it, the keep-alive limits are reached or an error occurs.
+        Pipelined requests are answered in order. The worker is given up to the queued up
+        connections instead of waiting on an idle connection.
+        """
+        logger.write('Connection accepted from {}', self.client_addr)
+        active_connections.inc()
+        reader = SocketReader(self.conn)
+        server = HTTPServer(self.conn)
         try:
-            server = HTTPServer(self.conn)
-            request_preamble = self._recv_preamble()
-            logger.write('Headers:\n{}'.format(request_preamble.headers))
-            request_data = b''
-
-            if 'Content-Length' in request_preamble.headers:
-                data_length = request_preamble.headers['Content-Length']
-                request_data = _recvall(self.conn, int(data_length))
-                logger.write('Data:\n{}'.format(request_data))
-
-            request = Request(request_preamble,
-                              request_data.decode('UTF-8'))
-            http_handler = self.HTTPHandlerImplClass(request, server)
-            http_handler.handle()
+            self.conn.settimeout(http_server_keep_alive_timeout)
+            for served in range(http_server_max_keep_alive_requests):
+                server = HTTPServer(self.conn)
+                if served and not self._wait_for_request(reader):
+                    break
+                try:
+                    preamble = reader.read_preamble()
+                except socket.timeout:
+                    timeouts_total.inc(('idle',))
+                    break
+                if preamble is None:
+                    break
+                started = time.perf_counter()
+                try:
+                    request_preamble = RequestPreamble(preamble.decode('UTF-8'))
+                    data_length = int(request_preamble.headers.get('Content-Length', 0))
+                    if data_length < 0:
+                        raise ValueError('Negative Content-Length: {}'.format(data_length))
+                except ValueError as err:
+                    logger.write(err)
+                    server.send_error(400, 'Bad Request')
+                    record_request(self.client_addr, None, server, len(preamble), started)
+                    break
+                logger.write('Headers:\n{}', request_preamble.headers)
+                if 'Transfer-Encoding' in request_preamble.headers:
+                    # Request bodies are only framed by Content-Length, a chunked body would be parsed as
+                    # the next request
+                    server.send_error(411, 'Length Required')
+                    record_request(self.client_addr, request_preamble, server, len(preamble), started)
+                    break
+                if data_length > http_server_max_body_size:
+                    server.send_error(413, 'Payload Too Large')
+                    record_request(self.client_addr, request_preamble, server, len(preamble), started)
+                    break
+
+                if request_preamble.headers.get('Expect', '').lower() == '100-continue':
+                    server.send_continue()
+
+                request = Request(request_preamble, RequestBody(reader, data_length))
+                last = served + 1 == http_server_max_keep_alive_requests or http_server_stopping.is_set() or \
+                    self._others_waiting()
+                server = HTTPServer(self.conn, keep_alive=keep_alive_requested(request_preamble) and not last,
+                                    chunked=request_preamble.http_version == 'HTTP/1.1')
+                http_handler = self.HTTPHandlerImplClass(request, server)
+                try:
+                    http_handler.handle()
+                    # Skip the part of the body the handler did not read to get to the next request
+                    if server.keep_alive:
+                        request.body.drain()
+                except RequestTimeout as err:
+                    request_timed_out(server, err)
+                    break
+                except Exception as inst:
+                    logger.write(inst)
+                    if not server.response_sent:
+                        server.send_error(500, 'Internal Server Error')
+                    break
+                finally:
+                    record_request(self.client_addr, request_preamble, server,
+                                   len(preamble) + data_length - request.body.remaining, started)
+                # Without a response the client can only tell the request is done by the close
+                if not server.keep_alive or not server.response_sent:
+                    break
+        except PreambleTooLarge:
+            server.send_error(431, 'Request Header Fields Too Large')
+            record_request(self.client_addr, None, server, reader.buffered(), time.perf_counter())
+        except RequestTimeout as err:
+            request_timed_out(server, err)
+            record_request(self.client_addr, None, server, reader.buffered(), time.perf_counter())
         except Exception as inst:
-            logger(inst)
-            server.send_error(500, 'Internal Server Error')
+            logger.write(inst)
+            if not server.response_sent:
+                server.send_error(500, 'Internal Server Error')
         finally:
+            active_connections.dec()
             self.conn.close()
 
-    def _recv_preamble(self):
-        """Receives all the headers from the socket and return a RequestPreamble.
+    def _others_waiting(self):
+        """Returns whether connections are queued up waiting for a worker"""
+        return self.connections is not None and not self.connections.empty()
+
+    def _wait_for_request(self, reader: 'SocketReader'):
+        """Waits for the next request on a connection kept alive, checking the connection queue
+        every http_server_idle_poll_interval.
+        :return: False if the connection should be closed: the keep-alive timeout expired or
+            other connections are waiting for a worker.
         """
-        data = b''
+        if reader.buffered() or self.connections is None:
+            return True
+        deadline = time.monotonic() + http_server_keep_alive_timeout
         while True:
-            last_line = _recvline(self.conn)
-                # if last_line.endswith(http_server_CRLF + http_server_CRLF):
-                #     data += last_line
-                #     break
-            if http_server_CRLF == last_line or http_server_LF == last_line:
-                break
-            else:
-                data += last_line
-        return RequestPreamble(data.decode('UTF-8'))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timeouts_total.inc(('idle',))
+                return False
+            if select.select([self.conn], [], [], min(remaining, http_server_idle_poll_interval))[0]:
+                return True
+            if self._others_waiting():
+                logger.write('Closing idle connection from {}, connections are waiting', self.client_addr)
+                return False
+
+
+def request_timed_out(server: 'HTTPServer', err: RequestTimeout):
+    """Answers a request which was not received in time with 408, unless a response was already sent"""
+    logger.write(err)
+    timeouts_total.inc((err.phase,))
+    server.keep_alive = False
+    if not server.response_sent:
+        server.send_error(408, 'Request Timeout')
 
 
-# TODO handling response and error
 class HTTPServer:
     """Represent the HTTPServer connection to a client.
     Used to send response to the client.
+
+    Attributes:
+        keep_alive (bool): Whether the connection stays open after the response.
+        chunked (bool): Whether the client accepts a chunked transfer encoding (HTTP/1.1).
+        response_sent (bool): Whether a response was sent.
+        status (str): Status code of the response, None before it is sent.
+        bytes_sent (int): Bytes written to the connection.
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, keep_alive: bool = False, chunked: bool = False):
         self.conn = conn
+        self.keep_alive = keep_alive
+        self.chunked = chunked
+        self.response_sent = False
+        self.status = None
+        self.bytes_sent = 0
+
+    def send_continue(self):
+        """Sends the interim 100 Continue response to a client waiting to send the request body
+        """
+        self._write('{} 100 Continue\r\n\r\n'.format(http_server_version).encode('UTF-8'))
 
-    def send_error(self, status: int, msg: str):
+    def send_error(self, status: int, msg: str, headers: dict = None):
         """Send an error to the client with no data
         :param status: int Status code
         :param msg: str Status message
+        :param headers: dict Extra response headers
         """
-        response_line = self._build_response_line(status, msg)
-        response = "\r\n".join(
-            (response_line, 'Server: {}'.format(http_server_name),
-             'Content-Length: 0', "\r\n"))
-        self.conn.sendall(response.encode('UTF-8'))
-        self.conn.close()
-
-    def send_response(self, data: str = '', headers = {}):
+        headers = dict(headers or {})
+        headers['Content-Length'] = 0
+        self._send(status, msg, headers)
+
+    def send_response(self, data: str = '', headers: dict = None):
         """Sends a response to the client with a data block
         :param data: str Data block
+        :param headers: dict Extra response headers
         """
-        response_line = self._build_response_line(200, 'OK')
+        data = data.encode('UTF-8') if isinstance(data, str) else data
+        headers = dict(headers or {})
         headers.setdefault("Content-Length", len(data))
+        self._send(200, 'OK', headers, data)
 
-        headers_line = "".join("{}:{}\r\n".format(k, v) for k, v in headers.items())
-        response = "\r\n".join(
-            (response_line, "Server: {}".format(http_server_name),
-             headers_line, '\r\n', data))
-
-        self.conn.sendall(response.encode('UTF-8'))
-        self.conn.close()
+    def send_not_modified(self, headers: dict = None):
+        """Sends a 304 Not Modified response, telling the client its copy is up to date
+        :param headers: dict Validators of the resource (ETag, Last-Modified)
+        """
+        self._send(304, 'Not Modified', dict(headers or {}))
+
+    def send_file(self, file, headers: dict = None, ranges: list = None):
+        """Sends a response to the client with the content of a file as data block.
+        The headers are sent first, then the file is copied to the socket by the kernel with sendfile.
+        :param file: File open in binary mode
+        :param headers: dict Extra response headers
+        :param ranges: list of (first, last) byte positions to send instead of the whole file.
+            A single range is sent as a 206 with Content-Range, several as a multipart/byteranges 206.
+        """
+        headers = dict(headers or {})
+        size = os.fstat(file.fileno()).st_size
+        status, msg = 206, 'Partial Content'
+        closing = b''
+        if not ranges:
+            status, msg = 200, 'OK'
+            parts = [(b'', 0, size)]
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+            parts = [(b'', first, last - first + 1)]
+        else:
+            boundary = uuid.uuid4().hex
+            part_type = headers.pop('Content-Type', 'application/octet-stream')
+            headers['Content-Type'] = 'multipart/byteranges; boundary={}'.format(boundary)
+            parts = [(('\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, part_type, first, last, size)).encode('UTF-8'), first, last - first + 1)
+                for first, last in ranges]
+            closing = '\r\n--{}--\r\n'.format(boundary).encode('UTF-8')
+        headers['Content-Length'] = sum(len(head) + count for head, _, count in parts) + len(closing)
+        self._send(status, msg, headers)
+        try:
+            for head, offset, count in parts:
+                if head:
+                    self._write(head)
+                if count:
+                    self.conn.sendfile(file, offset, count)
+                    self.bytes_sent += count
+            if closing:
+                self._write(closing)
+        except Exception:
+            # The client can not tell where this response ends anymore
+            self.keep_alive = False
+            raise
+
+    def send_stream(self, chunks, headers: dict = None):
+        """Sends a response to the client with a data block of unknown length, produced chunk by chunk.
+        HTTP/1.1 clients get a chunked transfer encoding, others read until the connection is closed.
+        :param chunks: Iterable of bytes
+        :param headers: dict Extra response headers
+        """
+        headers = dict(headers or {})
+        if self.chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            self.keep_alive = False
+        self._send(200, 'OK', headers)
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if self.chunked:
+                    chunk = b''.join(('{:x}\r\n'.format(len(chunk)).encode('UTF-8'), chunk, b'\r\n'))
+                self._write(chunk)
+            if self.chunked:
+                self._write(b'0\r\n\r\n')
+        except Exception:
+            self.keep_alive = False
+            raise
+
+    def _send(self, status: int, msg: str, headers: dict, data: bytes = b''):
+        """Sends the response line, headers and data block in a single write"""
+        headers.setdefault('Connection', 'keep-alive' if self.keep_alive else 'close')
+        response_head = "".join(
+            "{}: {}\r\n".format(k, v)
+            for k, v in (('Server', http_server_name), *headers.items()))
+        response = "".join((self._build_response_line(status, msg), "\r\n", response_head, "\r\n"))
+        self.response_sent = True
+        self.status = str(status)
+        self._write(response.encode('UTF-8') + data)
+
+    def _write(self, data):
+        """Writes to the connection and counts the bytes sent"""
+        self.conn.sendall(data)
+        self.bytes_sent += len(data)
 
     @staticmethod
     def _build_response_line(status: int, msg: str):
@@ -170,7 +649,7 @@ class HTTPServer:
 
 
 class HTTPHandler(ABC):
-    """Base class for a HTTPHandler used by the ConnectionHandlerThread.
+    """Base class for a HTTPHandler used by the ConnectionHandler.
 
     Attributes:
         request (Request): Request from the HTTP connection.
@@ -184,7 +663,7 @@ class HTTPHandler(ABC):
     def handle(self):
         """Handles the request and calls the appropriate method handler
         """
-        logger.write('handling request\n{}'.format(self.request))
+        logger.write('handling request\n{}', self.request)
 
         if self.request.preamble.http_method == 'GET':
 
@@ -228,15 +707,76 @@ class RequestPreamble:
         # The first consecutive CRLF sequence demarcates the start of the
         # entity-body.
         preamble = preamble.strip()
-        request_line, *headers = preamble.split("\r\n")
+        request_line, *headers = preamble.splitlines()
         self.http_method, self.url, self.http_version = request_line.split()
-        headers = [self._remove_whitespace(s) for s in headers]
-        self.headers = dict(kv.split(":", maxsplit=1) for kv in headers)
+        # Header names are case insensitive, they are stored capitalized as in Content-Length.
+        self.headers = {}
+        for kv in headers:
+            k, v = kv.split(":", maxsplit=1)
+            self.headers[k.strip().title()] = v.strip()
 
-    @staticmethod
-    def _remove_whitespace(s: str):
-        """Return a string with all whitespace removed from the input."""
-        return "".join(s.split())
+
+class RequestBody:
+    """File-like reader of the request body.
+    The body is received from the connection as it is read, so it is never held in memory as a whole.
+
+    Attributes:
+        length (int): Content-Length of the body.
+        remaining (int): Number of bytes not read yet.
+    """
+
+    def __init__(self, reader, length: int):
+        """
+        :param reader: SocketReader of the connection, or any object with a readinto(b, deadline) method.
+        :param length: Content-Length of the body.
+        """
+        self.reader = reader
+        self.length = length
+        self.remaining = length
+        self.started = time.monotonic()
+
+    def deadline(self):
+        """Returns the time.monotonic() by which the next part of the body must be received:
+        after http_server_body_timeout, or sooner if the body is received slower than
+        http_server_min_body_rate on average.
+        """
+        deadline = time.monotonic() + http_server_body_timeout
+        if http_server_min_body_rate:
+            received = self.length - self.remaining
+            deadline = min(deadline, self.started + http_server_body_timeout + received / http_server_min_body_rate)
+        return deadline
+
+    def readinto(self, b):
+        """Reads the next part of the body into b.
+        Throws a ConnectionError if the connection is closed before the end of the body.
+        :param b: Writable buffer
+        :return: (int) Number of bytes read, 0 at the end of the body.
+        """
+        if not self.remaining:
+            return 0
+        count = self.reader.readinto(memoryview(b)[:self.remaining], self.deadline())
+        if not count:
+            raise ConnectionError('Connection closed before the end of the request body')
+        self.remaining -= count
+        return count
+
+    def read(self, size: int = -1):
+        """Reads size bytes of the body, or the rest of the body if size is negative.
+        :return: (bytes) Data of the body
+        """
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            received += self.readinto(view[received:])
+        return bytes(data)
+
+    def drain(self):
+        """Reads and discards the rest of the body."""
+        buffer = bytearray(min(self.remaining, http_server_upload_buffer_size))
+        while self.remaining:
+            self.readinto(buffer)
 
 
 class Request:
@@ -244,10 +784,10 @@ class Request:
 
     Attributes:
         preamble (RequestPreamble): Request preamble with request line and headers
-        body (str): The request body.
+        body (RequestBody): The request body.
     """
 
-    def __init__(self, preamble: RequestPreamble, body: str):
+    def __init__(self, preamble: RequestPreamble, body: RequestBody):
         self.preamble = preamble
         self.body = body
 
@@ -258,4 +798,4 @@ class Request:
                                          self.preamble.http_version)
         headers = "\n".join(
             "{}: {}".format(k, v) for k, v in self.preamble.headers.items())
-        return "\n".join((request_line, headers, self.body))
+        return "\n".join((request_line, headers, '<{} bytes of data>'.format(self.body.length)))
@@ -1,47 +1,212 @@
-"""Thread Safe Logging library"""
+"""Thread Safe Logging library
 
-from threading import Thread
-from queue import Queue
+Messages are formatted by the logger thread, only when they are output: callers pass the format
+string and its arguments, write('Connection from {}', addr), instead of a formatted message.
+The queues are bounded, when a queue is full the message is dropped and counted rather than
+blocking the caller. The logger thread writes the messages in batches and flushes the output
+at most every log_flush_interval seconds.
+"""
+
+from threading import Lock, Thread
+from queue import Queue, Empty, Full
+import os
 import sys
+import time
+import metrics
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
-log_queue = None
+log_thread = None
 log_verbose = False
+log_queue_size = 10000
+log_batch_size = 256
+log_flush_interval = 0.5
+# Thread writing the access log, None when there is no access log
+access_log_thread = None
+access_log_path = None
+access_log_max_bytes = 64 << 20
+access_log_backups = 5
+# Line of the access log: time, client, method, path, status, bytes sent, duration in seconds
+ACCESS_FORMAT = '{0:.3f} {1} {2} {3} {4} {5} {6:.6f}'
 
 
 def set_logger(verbose: bool = True):
     """Starts the logger thread
     :param verbose: Set to False to suppress logging
     """
-    global log_queue, log_verbose
+    global log_thread, log_verbose
     log_verbose = verbose
 
-    if not log_queue:
-        log_thread = LogThread(sys.stdout)
+    if not log_thread:
+        log_thread = LogThread(sys.stdout, log_queue_size)
         log_thread.setDaemon(True)
         log_thread.start()
-        log_queue = log_thread.queue
 
 
-def write(msg: str):
+def set_access_log(path: str = None, max_bytes: int = 64 << 20, backups: int = 5):
+    """Starts writing one line per request to a file
+    :param path: Path to the access log, None to disable it.
+    :param max_bytes: The file is rotated when it grows past this size, 0 never rotates it.
+    :param backups: Number of rotated files kept as path.1 ... path.N.
+    """
+    global access_log_thread, access_log_path, access_log_max_bytes, access_log_backups
+    access_log_path, access_log_max_bytes, access_log_backups = path, max_bytes, backups
+    access_log_thread = None
+    if path:
+        access_log_thread = LogThread(RotatingFile(path, max_bytes, backups), log_queue_size)
+        access_log_thread.setDaemon(True)
+        access_log_thread.start()
+
+
+def write(msg, *args):
     """Writes to the logging output
+    :param msg: Message, or format string of the message if args are given.
+    :param args: Arguments of the format string, formatted by the logger thread.
     """
-    if not log_queue:
+    if not log_thread:
         set_logger()
     if log_verbose:
-        log_queue.put(msg)
+        log_thread.put(msg, args)
+
+
+def access(client, method: str, path: str, status, size: int, duration: float):
+    """Writes a request to the access log, if there is one
+    :param client: Address of the client.
+    :param method: Method of the request.
+    :param path: Path of the request.
+    :param status: Status code of the response.
+    :param size: Bytes of the response.
+    :param duration: Seconds taken to answer the request.
+    """
+    if access_log_thread:
+        access_log_thread.put(ACCESS_FORMAT, (time.time(), client[0] if isinstance(client, tuple) else client,
+                                              method, path, status, size, duration))
+
+
+def dropped():
+    """Returns the number of messages dropped because a queue was full"""
+    return sum(thread.dropped for thread in (log_thread, access_log_thread) if thread)
+
+
+metrics.Counter('httpfs_log_dropped_total', 'Log messages dropped because the log queue was full.',
+                function=dropped)
+
+
+def _restart_after_fork():
+    """The logger threads do not survive a fork, the child process starts its own"""
+    global log_thread
+    if log_thread:
+        log_thread = None
+        set_logger(log_verbose)
+    if access_log_thread:
+        set_access_log(access_log_path, access_log_max_bytes, access_log_backups)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
 
 
 class LogThread(Thread):
     """Thread object to handle the log queue and output to the console
+
+    Attributes:
+        queue (Queue): Messages waiting to be written, as (format string, arguments).
+        dropped (int): Number of messages dropped because the queue was full.
     """
-    def __init__(self, log_destination):
+    def __init__(self, log_destination, queue_size: int = 0):
         super().__init__()
         self.log_destination = log_destination
-        self.queue = Queue()
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.reported = 0
+        self.mutex = Lock()
+
+    def put(self, msg, args: tuple = ()):
+        """Queues up a message without blocking, drops it if the queue is full"""
+        try:
+            self.queue.put_nowait((msg, args))
+        except Full:
+            with self.mutex:
+                self.dropped += 1
 
     def run(self):
+        last_flush = time.monotonic()
         while True:
-            self.log_destination.write(str(self.queue.get()) + '\n')
-            self.log_destination.flush()
-            self.queue.task_done()
+            try:
+                batch = [self.queue.get(timeout=log_flush_interval)]
+            except Empty:
+                self.log_destination.flush()
+                last_flush = time.monotonic()
+                continue
+            while len(batch) < log_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            lines = [_format(msg, args) for msg, args in batch]
+            dropped = self.dropped
+            if dropped != self.reported:
+                lines.append('{} log messages dropped'.format(dropped - self.reported))
+                self.reported = dropped
+            self.log_destination.write('\n'.join(lines) + '\n')
+            if time.monotonic() - last_flush >= log_flush_interval:
+                self.log_destination.flush()
+                last_flush = time.monotonic()
+            for _ in batch:
+                self.queue.task_done()
+
+
+def _format(msg, args: tuple):
+    try:
+        return msg.format(*args) if args else str(msg)
+    except (IndexError, KeyError, ValueError) as err:
+        return '{!r} {!r} ({})'.format(msg, args, err)
+
+
+class RotatingFile:
+    """File appended to by the logger thread, renamed to path.1 when it grows past max_bytes.
+    The previous path.1 is renamed to path.2 and so on, up to backups files.
+    The worker processes append to the same path: the first one to reach max_bytes rotates the
+    file, the others see the path was renamed and reopen it instead of rotating again.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'a', encoding='UTF-8')
+
+    def write(self, data: str):
+        self.file.write(data)
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def flush(self):
+        self.file.flush()
+
+    def rotate(self):
+        self.file.flush()
+        # Held until the file is closed, another process rotating it waits and then sees the rename
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            if self._is_current():
+                if self.backups:
+                    for index in range(self.backups - 1, 0, -1):
+                        if os.path.exists('{}.{}'.format(self.path, index)):
+                            os.replace('{}.{}'.format(self.path, index), '{}.{}'.format(self.path, index + 1))
+                    os.replace(self.path, '{}.1'.format(self.path))
+                else:
+                    os.remove(self.path)
+        finally:
+            self.file.close()
+        self.file = open(self.path, 'a', encoding='UTF-8')
+
+    def _is_current(self):
+        """Returns whether the path still names the open file"""
+        try:
+            return os.path.samestat(os.fstat(self.file.fileno()), os.stat(self.path))
+        except FileNotFoundError:
+            return False
@@ -0,0 +1,90 @@
+"""Thread safe LRU cache bounded by the size of its values in bytes"""
+
+from collections import OrderedDict
+from threading import Lock
+
+# Bytes counted for each entry on top of its value, for the key, the validator and the bookkeeping.
+# Bounds the number of entries with small or empty values.
+ENTRY_OVERHEAD = 256
+
+
+class LRUCache:
+    """Least recently used cache of bytes values.
+    Each value is stored with a validator, a lookup with a different validator is a miss and
+    drops the stale value. Each entry costs the size of its value plus ENTRY_OVERHEAD.
+
+    Attributes:
+        max_size (int): Maximum total cost of the entries in bytes.
+        size (int): Total cost of the entries in bytes.
+        hits (int): Number of lookups that found an up to date value.
+        misses (int): Number of lookups that found no value or a stale one.
+        evictions (int): Number of values dropped to make room for new ones.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.mutex = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, validator=None):
+        """Returns the value of key if its validator matches, None otherwise."""
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != validator:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value: bytes, validator=None):
+        """Stores the value of key, evicting the least recently used values to make room.
+        Values larger than the cache are not stored.
+        """
+        if _cost(value) > self.max_size:
+            return
+        with self.mutex:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (validator, value)
+            self.size += _cost(value)
+            while self.size > self.max_size:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops the value of key if it is cached."""
+        with self.mutex:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        """Drops all the values."""
+        with self.mutex:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns the counters of the cache as a dict."""
+        with self.mutex:
+            return {'entries': len(self.entries), 'size': self.size, 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _remove(self, key):
+        """Removes a value, the mutex must be held."""
+        validator, value = self.entries.pop(key)
+        self.size -= _cost(value)
+
+
+def _cost(value: bytes):
+    """Returns the bytes counted for an entry with this value"""
+    return len(value) + ENTRY_OVERHEAD
@@ -0,0 +1,144 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+The modules create their metrics at import, they are registered in metrics_registry and
+rendered in the order they were created. Recording takes a lock per metric and no allocation
+for an existing set of labels, so the metrics are always on.
+With several worker processes, each process reports its own metrics.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+# Upper bounds in seconds of the latency buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+metrics_registry = []
+
+
+def render():
+    """Returns all the registered metrics in the Prometheus text format
+    :return: (str) Text exposition of the metrics
+    """
+    lines = []
+    for metric in list(metrics_registry):
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for suffix, labels, value in metric.samples():
+            lines.append('{}{}{} {}'.format(metric.name, suffix, _format_labels(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    """Formats a sequence of (name, value) as {name="value",...}"""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                            .replace('\n', '\\n')) for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return '+Inf' if value == float('inf') else repr(value)
+    return str(value)
+
+
+class Metric:
+    """Base class of the metrics, a value per combination of label values.
+
+    Attributes:
+        name (str): Name of the metric.
+        help (str): Description of the metric.
+        labels (tuple): Names of the labels.
+        function: Called at rendering to get the values instead of recording them, returns a value
+            or a dict of values by tuple of label values.
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.mutex = Lock()
+        metrics_registry.append(self)
+
+    def get(self, label_values: tuple = ()):
+        """Returns the value recorded for the label values"""
+        with self.mutex:
+            return self.values.get(tuple(label_values), 0)
+
+    def samples(self):
+        """Returns the samples to render as (name suffix, labels, value)"""
+        if self.function:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self.mutex:
+                values = dict(self.values)
+        return [('', tuple(zip(self.labels, key)), value) for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+    type = 'counter'
+
+    def inc(self, label_values: tuple = (), amount=1):
+        with self.mutex:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+    type = 'gauge'
+
+    def set(self, value, label_values: tuple = ()):
+        with self.mutex:
+            self.values[label_values] = value
+
+    def inc(self, label_values: tuple = (), amount=1):
+        with self.mutex:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, label_values: tuple = (), amount=1):
+        self.inc(label_values, -amount)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, with their sum and count"""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, label_values: tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self.mutex:
+            entry = self.values.get(label_values)
+            if entry is None:
+                # Counts per bucket, then the count above the last bucket and the sum
+                entry = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def get(self, label_values: tuple = ()):
+        """Returns (count, sum) of the values observed for the label values"""
+        with self.mutex:
+            entry = self.values.get(tuple(label_values))
+            return (sum(entry[:-1]), entry[-1]) if entry else (0, 0.0)
+
+    def samples(self):
+        with self.mutex:
+            values = {key: list(entry) for key, entry in self.values.items()}
+        samples = []
+        for key, entry in sorted(values.items()):
+            labels = tuple(zip(self.labels, key))
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), entry):
+                count += bucket_count
+                samples.append(('_bucket', labels + (('le', _format_value(float(bound))),), count))
+            samples.append(('_sum', labels, entry[-1]))
+            samples.append(('_count', labels, count))
+        return samples
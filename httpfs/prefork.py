@@ -0,0 +1,121 @@
+"""Pre-fork mode: several worker processes serving the same port.
+
+Each worker is a forked process running its own server, the workers all listen on the port
+with SO_REUSEPORT and the kernel spreads the new connections between them, so the server is
+not limited to the one core the GIL allows a process. The supervisor process restarts the
+workers that exit and forwards SIGTERM and SIGINT to stop them gracefully.
+"""
+
+import os
+import signal
+import socket
+import sys
+import time
+import logger
+
+# Seconds the workers get to finish their requests once asked to stop, before they are killed
+prefork_shutdown_timeout = 15
+# A worker exiting sooner than this after its start is restarted with a delay
+prefork_min_uptime = 1.0
+
+
+def start_workers(workers: int, start_worker):
+    """Forks the workers and supervises them until they are stopped
+    :param workers: Number of worker processes.
+    :param start_worker: Function serving in a worker, called after the fork. It must listen with
+        SO_REUSEPORT and stop on SystemExit.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+    Supervisor(workers, start_worker).run()
+
+
+class Supervisor:
+    """Starts the workers and restarts them when they exit.
+
+    Attributes:
+        children (dict): Start time of the running workers by pid.
+        stopping (bool): Whether the workers were asked to stop.
+        restarts (int): Number of workers restarted.
+    """
+
+    def __init__(self, workers: int, start_worker):
+        self.workers = workers
+        self.start_worker = start_worker
+        self.children = {}
+        self.stopping = False
+        self.restarts = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGALRM, self._kill)
+        for _ in range(self.workers):
+            self._spawn()
+        logger.write('Supervisor {} started {} workers', os.getpid(), self.workers)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.write('Worker {} exited with status {}, restarting it', pid, status)
+            # Do not spin when the workers crash right away
+            if time.monotonic() - started < prefork_min_uptime:
+                time.sleep(prefork_min_uptime)
+            if not self.stopping:
+                self.restarts += 1
+                self._spawn()
+        logger.write('Supervisor {} stopped', os.getpid())
+
+    def _spawn(self):
+        """Forks a worker"""
+        pid = os.fork()
+        if pid == 0:
+            self._serve()
+        self.children[pid] = time.monotonic()
+
+    def _serve(self):
+        """Runs in the worker, never returns"""
+        status = 0
+        signal.signal(signal.SIGTERM, _exit)
+        signal.signal(signal.SIGINT, _exit)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        try:
+            self.start_worker()
+        except SystemExit:
+            pass
+        except BaseException as err:
+            logger.write('Worker {} failed: {}', os.getpid(), err)
+            status = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+
+    def _stop(self, signum, frame):
+        """Asks the workers to stop and kills them if they did not after the shutdown timeout"""
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.write('Stopping {} workers', len(self.children))
+        for pid in self.children:
+            _signal(pid, signal.SIGTERM)
+        signal.alarm(prefork_shutdown_timeout)
+
+    def _kill(self, signum, frame):
+        for pid in self.children:
+            _signal(pid, signal.SIGKILL)
+
+
+def _exit(signum, frame):
+    """Signal handler stopping the server of a worker"""
+    raise SystemExit(0)
+
+
+def _signal(pid: int, signum: int):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
@@ -1,4 +1,13 @@
+import os
+import time
+import zlib
+import metrics
 from threading import Lock
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class FileManagerLock:
@@ -56,3 +65,104 @@ class FileManagerLock:
             # Release reader block if this is the last writer in line
             if self.writer_count == 0:
                 self.block_reader.release()
+
+
+lock_wait_seconds = metrics.Histogram(
+    'httpfs_lock_wait_seconds', 'Time spent waiting for a file lock.', ('mode',))
+lock_hold_seconds = metrics.Histogram(
+    'httpfs_lock_hold_seconds', 'Time a file lock was held.', ('mode',))
+READ = ('read',)
+WRITE = ('write',)
+
+
+class FileLockRegistry:
+    """Reader/Writer lock per file name
+    A lock is created when a thread first asks for it and dropped when no thread holds it or waits
+    on it anymore, so the registry only holds the locks of the files in use.
+    """
+    def __init__(self):
+        self.locks = {}
+        self.mutex = Lock()
+
+    def __len__(self):
+        return len(self.locks)
+
+    @contextmanager
+    def read(self, name: str):
+        """Holds the read lock of a file for the duration of the context."""
+        lock = self._checkout(name)
+        try:
+            start = time.perf_counter()
+            lock.read_acquire()
+            acquired = time.perf_counter()
+            lock_wait_seconds.observe(acquired - start, READ)
+            try:
+                yield
+            finally:
+                lock.read_release()
+                lock_hold_seconds.observe(time.perf_counter() - acquired, READ)
+        finally:
+            self._checkin(name)
+
+    @contextmanager
+    def write(self, name: str):
+        """Holds the write lock of a file for the duration of the context."""
+        lock = self._checkout(name)
+        try:
+            start = time.perf_counter()
+            lock.write_acquire()
+            acquired = time.perf_counter()
+            lock_wait_seconds.observe(acquired - start, WRITE)
+            try:
+                yield
+            finally:
+                lock.write_release()
+                lock_hold_seconds.observe(time.perf_counter() - acquired, WRITE)
+        finally:
+            self._checkin(name)
+
+    def _checkout(self, name: str):
+        """Returns the lock of a file, creating it if needed, and counts the thread as a user."""
+        with self.mutex:
+            entry = self.locks.get(name)
+            if entry is None:
+                entry = self.locks[name] = [FileManagerLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, name: str):
+        """Removes the thread from the users of the lock and drops the lock if it was the last one."""
+        with self.mutex:
+            entry = self.locks[name]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[name]
+
+
+class ProcessLock:
+    """Exclusive lock per file name shared by all the processes serving a directory
+    Each name is mapped to one of a fixed number of stripes, a stripe is a byte of a lock file held
+    with an fcntl record lock. Record locks belong to the process, not to the thread, so the threads
+    of a process first take the mutex of the stripe: two threads never hold the same stripe.
+    """
+    def __init__(self, path: str, stripes: int = 64):
+        if fcntl is None:
+            raise RuntimeError('fcntl locks are not supported on this platform')
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.mutexes = [Lock() for _ in range(stripes)]
+
+    def close(self):
+        """Closes the lock file, releasing the locks held by the process."""
+        os.close(self.fd)
+
+    @contextmanager
+    def hold(self, name: str):
+        """Holds the lock of a file for the duration of the context."""
+        stripe = zlib.crc32(name.encode('UTF-8')) % len(self.mutexes)
+        with self.mutexes[stripe]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
@@ -0,0 +1,188 @@
+"""Storage backends of the file manager.
+
+A backend decides how a written temporary file is stored under its name. The files of the
+directory stay regular files in both backends, so reading, listing and caching them does not
+depend on the backend.
+"""
+
+import errno
+import os
+import logger
+from threading import Lock
+
+# Directory of the blobs of the content addressed storage, hidden like the other .httpfs files
+BLOB_DIRECTORY = '.httpfs-blobs'
+
+
+class DirectoryStorage:
+    """Stores each file as a plain file of the directory.
+
+    Attributes:
+        hashes (bool): Whether write_file must compute the sha256 of the written data.
+    """
+    hashes = False
+
+    def __init__(self, directory: str, lock=None):
+        """
+        :param directory: Directory of the files.
+        :param lock: Function returning a context holding an exclusive lock on a key, across
+            threads and processes.
+        """
+        self.directory = directory
+        self.lock = lock
+
+    def store(self, temp_path: str, digest: str = None):
+        """Prepares a written temporary file to be renamed to its name.
+        :param temp_path: Path of the written temporary file.
+        :param digest: sha256 of the data if the backend hashes.
+        :return: (str) Path to rename to the name of the file.
+        """
+        return temp_path
+
+    def release(self, st: os.stat_result):
+        """Called with the status of a file replaced by a write."""
+        pass
+
+    def content_tag(self, st: os.stat_result):
+        """Returns a tag of the content of a file, the same for every file with the same content,
+        or None if the backend does not know it."""
+        return None
+
+
+class ContentStorage(DirectoryStorage):
+    """Stores each distinct content once, as a blob named by its sha256 in BLOB_DIRECTORY.
+
+    The files of the directory are hard links to their blob. The link count of a blob counts its
+    files plus the blob itself: when a write replaces the last file of a blob, the blob is removed.
+    The blobs are created, linked and removed under the lock of their digest, never while the lock
+    of a file name is held.
+    Files written before the backend was selected stay plain files and have no content tag.
+
+    A file edited in place, bypassing write_file, edits its blob and every other file linked to it.
+    Such an edit is detected by the size and modification time recorded with the blob: the files of
+    the blob lose their content tag, and the next write of the original content replaces the blob
+    instead of linking to it. An edit keeping both the size and the modification time goes unnoticed.
+    """
+    hashes = True
+
+    def __init__(self, directory: str, lock=None):
+        super().__init__(directory, lock)
+        # Created with the first blob
+        self.blobs = os.path.join(directory, BLOB_DIRECTORY)
+        # (digest, size, mtime_ns) of the blobs by inode, rebuilt when the blob directory changes
+        self.digests = {}
+        self.mtime = None
+        self.mutex = Lock()
+
+    def store(self, temp_path: str, digest: str = None):
+        """Links the temporary file as a new blob, or links the existing blob with the same content
+        in its place."""
+        blob = os.path.join(self.blobs, digest)
+        with self.lock(_blob_key(digest)):
+            if self._edited(blob):
+                logger.write('Blob {} was modified outside the server, replacing it', digest)
+                # Its files keep the edited content, as plain files
+                os.remove(blob)
+            try:
+                try:
+                    os.link(temp_path, blob)
+                except FileNotFoundError:
+                    os.makedirs(self.blobs, exist_ok=True)
+                    os.link(temp_path, blob)
+                path = temp_path
+            except FileExistsError:
+                path = temp_path + '.link'
+                try:
+                    os.link(blob, path)
+                except OSError as err:
+                    if err.errno != errno.EMLINK:
+                        raise
+                    # Too many files share the blob, this one is stored as a plain file
+                    return temp_path
+                os.remove(temp_path)
+            st = os.stat(blob)
+        with self.mutex:
+            self.digests[st.st_ino] = (digest, st.st_size, st.st_mtime_ns)
+        return path
+
+    def release(self, st: os.stat_result):
+        """Removes the blob of the replaced file if no file links to it anymore."""
+        recorded = self._blob(st.st_ino)
+        if recorded is None:
+            return
+        blob = os.path.join(self.blobs, recorded[0])
+        with self.lock(_blob_key(recorded[0])):
+            try:
+                blob_st = os.stat(blob)
+            except FileNotFoundError:
+                return
+            if blob_st.st_ino == st.st_ino and blob_st.st_nlink == 1:
+                os.remove(blob)
+                with self.mutex:
+                    self.digests.pop(st.st_ino, None)
+
+    def content_tag(self, st: os.stat_result):
+        """Returns the sha256 of the file, None if it was modified in place since it was stored"""
+        recorded = self._blob(st.st_ino)
+        if recorded is None or recorded[1:] != (st.st_size, st.st_mtime_ns):
+            return None
+        return recorded[0]
+
+    def _edited(self, blob: str):
+        """Returns whether a blob was modified since it was stored"""
+        try:
+            st = os.stat(blob)
+        except FileNotFoundError:
+            return False
+        recorded = self._blob(st.st_ino)
+        return recorded is not None and recorded[1:] != (st.st_size, st.st_mtime_ns)
+
+    def _blob(self, inode: int):
+        """Returns (digest, size, mtime_ns) of the blob with this inode when it was stored, None if it
+        is not a blob"""
+        with self.mutex:
+            recorded = self.digests.get(inode)
+        if recorded is None:
+            # Blobs created by another process, or by a previous run
+            try:
+                mtime = os.stat(self.blobs).st_mtime_ns
+            except FileNotFoundError:
+                return None
+            if mtime != self.mtime:
+                with os.scandir(self.blobs) as entries:
+                    digests = {}
+                    for entry in entries:
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        digests[entry.inode()] = (entry.name, st.st_size, st.st_mtime_ns)
+                with self.mutex:
+                    # The status recorded when a blob was stored is kept, an edit since then stays visible
+                    for blob_inode, known in self.digests.items():
+                        if blob_inode in digests and digests[blob_inode][0] == known[0]:
+                            digests[blob_inode] = known
+                    self.digests = digests
+                    self.mtime = mtime
+                recorded = digests.get(inode)
+        return recorded
+
+
+STORAGES = {'directory': DirectoryStorage, 'content': ContentStorage}
+
+
+class HashingWriter:
+    """Writes to a file and computes the hash of the written data."""
+
+    def __init__(self, file, hash):
+        self.file = file
+        self.hash = hash
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+
+def _blob_key(digest: str):
+    """Returns the lock key of a blob, it can not collide with a file name"""
+    return BLOB_DIRECTORY + '/' + digest
@@ -1,5 +1,11 @@
-from file_manager import get_file, write_file
+from file_manager import get_file, write_file, read_file, set_dir, cache_stats, list_dir_page, file_manager_locks, \
+    set_process_shared, open_files, set_durability, set_storage, content_tag
 from threading import Thread
+import file_manager
+from rwlock import lock_wait_seconds, lock_hold_seconds
+import hashlib
+import os
+import time
 
 
 t_count = 0
@@ -9,7 +15,15 @@ def get_increment():
     t_count += 1
     return t_count
 
-def test_threads():
+def test_threads(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        run_threads()
+    finally:
+        set_dir('.')
+
+
+def run_threads():
     global t_count
     threads = []
     threads.append(Thread(target=reader, args=(get_increment(),)))
@@ -47,4 +61,215 @@ def writer(name):
     write_file(str(name), "mooooooo")
 
 
-test_threads()
+def test_locks_released(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        run_threads()
+        assert len(file_manager_locks) == 0
+    finally:
+        set_dir('.')
+
+
+def test_other_file_not_blocked():
+    with file_manager_locks.write('a.txt'):
+        t = Thread(target=lock_worker, args=(['b.txt'], 1, 0))
+        t.start()
+        t.join(timeout=2)
+        assert not t.is_alive()
+
+
+def test_contention_scaling():
+    one_file = lock_throughput(files=1, threads=8, ops=10, hold=0.002)
+    eight_files = lock_throughput(files=8, threads=8, ops=10, hold=0.002)
+    assert eight_files > 2 * one_file
+
+
+def test_cache(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        write_file('a.txt', 'first')
+        assert read_file('a.txt') == b'first'
+        hits = cache_stats()['hits']
+        assert read_file('a.txt') == b'first'
+        assert cache_stats()['hits'] == hits + 1
+
+        write_file('a.txt', 'second')
+        assert read_file('a.txt') == b'second'
+
+        # Edited outside of the file manager
+        with open(os.path.join(str(tmp_path), 'a.txt'), 'a') as f:
+            f.write(' edit')
+        assert read_file('a.txt') == b'second edit'
+    finally:
+        set_dir('.')
+
+
+def test_list_dir_page(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        for name in ('b1', 'a2', 'a1', 'a3'):
+            write_file(name, name)
+        assert list_dir_page(limit=2) == (['a1', 'a2'], 'a2')
+        assert list_dir_page(cursor='a2', limit=2) == (['a3', 'b1'], None)
+        assert list_dir_page(cursor='a1', limit=2) == (['a2', 'a3'], 'a3')
+        assert list_dir_page(prefix='a') == (['a1', 'a2', 'a3'], None)
+
+        write_file('a0', 'a0')
+        open(os.path.join(str(tmp_path), 'c0'), 'w').close()
+        assert list_dir_page() == (['a0', 'a1', 'a2', 'a3', 'b1', 'c0'], None)
+
+        # Changes made outside the server before a write are not hidden by the write
+        os.remove(os.path.join(str(tmp_path), 'b1'))
+        open(os.path.join(str(tmp_path), 'd0'), 'w').close()
+        write_file('a4', 'a4')
+        assert list_dir_page() == (['a0', 'a1', 'a2', 'a3', 'a4', 'c0', 'd0'], None)
+
+        # The writes update the index without rescanning the directory
+        scans = file_manager.file_manager_index.scans
+        for i in range(5):
+            write_file('e{}'.format(i), 'e')
+            assert list_dir_page(prefix='e')[0] == ['e{}'.format(j) for j in range(i + 1)]
+        assert file_manager.file_manager_index.scans == scans
+    finally:
+        set_dir('.')
+
+
+def test_process_shared(tmp_path):
+    set_dir(str(tmp_path))
+    set_process_shared(True)
+    try:
+        workers = [Thread(target=write_file, args=('shared', str(i) * 100)) for i in range(10)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        assert read_file('shared') in [(str(i) * 100).encode() for i in range(10)]
+        # The lock file is neither listed nor writable
+        assert os.path.exists(os.path.join(str(tmp_path), '.httpfs.lock'))
+        assert list_dir_page() == (['shared'], None)
+        try:
+            write_file('.httpfs.lock', 'x')
+            assert False
+        except ValueError:
+            pass
+    finally:
+        set_process_shared(False)
+        set_dir('.')
+
+
+def test_lock_metrics(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        writes = lock_wait_seconds.get(('write',))[0]
+        reads = lock_hold_seconds.get(('read',))[0]
+        write_file('measured', 'data')
+        read_file('measured')
+        assert lock_wait_seconds.get(('write',))[0] == writes + 1
+        assert lock_hold_seconds.get(('read',))[0] == reads + 1
+    finally:
+        set_dir('.')
+
+
+def test_open_files(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        write_file('one', '1')
+        write_file('two', '2')
+        with open_files(['two', 'missing', 'one', 'two', '../one']) as files:
+            # The open files keep their content when they are replaced
+            write_file('one', 'new')
+            assert [(name, f.read()) for name, f in files] == [('two', b'2'), ('one', b'1')]
+        assert len(file_manager_locks) == 0
+    finally:
+        set_dir('.')
+
+
+def test_durability(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        for mode in ('per-write', 'group'):
+            set_durability(mode)
+            workers = [Thread(target=write_file, args=('{}-{}'.format(mode, i), mode)) for i in range(8)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            assert read_file('{}-7'.format(mode)) == mode.encode()
+        assert list_dir_page(prefix='group') == (['group-{}'.format(i) for i in range(8)], None)
+    finally:
+        set_durability('none')
+        set_dir('.')
+
+
+def test_content_storage(tmp_path):
+    set_dir(str(tmp_path))
+    set_storage('content')
+    try:
+        write_file('a', 'same')
+        write_file('b', 'same')
+        write_file('b', 'same')
+        blob = os.path.join(str(tmp_path), '.httpfs-blobs', hashlib.sha256(b'same').hexdigest())
+        st = os.stat(os.path.join(str(tmp_path), 'a'))
+        assert os.path.samestat(st, os.stat(os.path.join(str(tmp_path), 'b')))
+        assert os.path.samestat(st, os.stat(blob)) and st.st_nlink == 3
+        assert content_tag(st) == hashlib.sha256(b'same').hexdigest()
+        assert sorted(os.listdir(str(tmp_path))) == ['.httpfs-blobs', '.httpfs-uploads', 'a', 'b']
+        assert os.listdir(os.path.join(str(tmp_path), '.httpfs-uploads')) == []
+        assert list_dir_page() == (['a', 'b'], None)
+        write_file('a', 'other')
+        write_file('b', 'other too')
+        assert not os.path.exists(blob)
+        assert read_file('a') == b'other' and len(os.listdir(os.path.dirname(blob))) == 2
+    finally:
+        set_storage('directory')
+        set_dir('.')
+
+
+def test_content_storage_edited_in_place(tmp_path):
+    set_dir(str(tmp_path))
+    set_storage('content')
+    try:
+        digest = hashlib.sha256(b'same').hexdigest()
+        write_file('a', 'same')
+        write_file('b', 'same')
+        with open(os.path.join(str(tmp_path), 'a'), 'ab') as f:
+            f.write(b' EDITED')
+        # The edit reaches the other file of the blob, neither keeps the tag of the stored content
+        assert read_file('b') == b'same EDITED'
+        assert content_tag(os.stat(os.path.join(str(tmp_path), 'a'))) is None
+        assert content_tag(os.stat(os.path.join(str(tmp_path), 'b'))) is None
+        # The next write of the content replaces the blob instead of linking to the edited one
+        write_file('c', 'same')
+        assert read_file('c') == b'same'
+        st = os.stat(os.path.join(str(tmp_path), 'c'))
+        assert content_tag(st) == digest and st.st_nlink == 2
+        set_storage('content')
+        assert content_tag(os.stat(os.path.join(str(tmp_path), 'a'))) is None
+        assert content_tag(st) == digest
+    finally:
+        set_storage('directory')
+        set_dir('.')
+
+
+def lock_worker(names, ops, hold):
+    for i in range(ops):
+        with file_manager_locks.write(names[i % len(names)]):
+            time.sleep(hold)
+
+
+def lock_throughput(files, threads, ops, hold):
+    """Writes per second with threads writing to files, each write holding the lock for hold seconds"""
+    names = ['file{}'.format(i) for i in range(files)]
+    workers = [Thread(target=lock_worker, args=(names[i % files:] + names[:i % files], ops, hold))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * ops / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    for files in (1, 2, 4, 8, 16):
+        print('{:>3} files: {:>7.0f} writes/s'.format(files, lock_throughput(files, threads=16, ops=50, hold=0.001)))
@@ -0,0 +1,130 @@
+from email.utils import formatdate
+from file_manager import gzip_cache_stats, set_dir, write_file
+from http_fs import BATCH_BLOCK_SIZE, TAR_RECORD_SIZE, HTTPHandlerFs, _parse_ranges, _tar_stream
+from test_http_server import exchange
+import gzip
+import io
+import os
+import tarfile
+
+
+def get(path: str, headers: dict = None):
+    """Sends a GET request to HTTPHandlerFs, returns the status code, headers and body of the response"""
+    lines = ''.join('{}: {}\r\n'.format(k, v) for k, v in (headers or {}).items())
+    request = 'GET {} HTTP/1.1\r\n{}Connection: close\r\n\r\n'.format(path, lines)
+    head, _, body = exchange(request.encode(), handler_class=HTTPHandlerFs).partition(b'\r\n\r\n')
+    status_line, *lines = head.decode().split('\r\n')
+    return int(status_line.split()[1]), dict(line.split(': ', 1) for line in lines), body
+
+
+def test_parse_ranges():
+    assert _parse_ranges('bytes=0-99', 1000) == [(0, 99)]
+    assert _parse_ranges('bytes=900-', 1000) == [(900, 999)]
+    assert _parse_ranges('bytes=990-2000', 1000) == [(990, 999)]
+    assert _parse_ranges('bytes=0-0, 5-9,20-', 30) == [(0, 0), (5, 9), (20, 29)]
+
+
+def test_parse_ranges_suffix():
+    assert _parse_ranges('bytes=-100', 1000) == [(900, 999)]
+    # A suffix longer than the file is the whole file
+    assert _parse_ranges('bytes=-5000', 1000) == [(0, 999)]
+    # Nothing to satisfy: an empty suffix, or any suffix of an empty file
+    assert _parse_ranges('bytes=-0', 1000) == []
+    assert _parse_ranges('bytes=-10', 0) == []
+
+
+def test_parse_ranges_unsatisfiable():
+    # Answered with 416
+    assert _parse_ranges('bytes=1000-', 1000) == []
+    assert _parse_ranges('bytes=2000-3000', 1000) == []
+    assert _parse_ranges('bytes=0-', 0) == []
+    # Only the satisfiable ranges are kept
+    assert _parse_ranges('bytes=2000-3000, 0-9', 1000) == [(0, 9)]
+
+
+def test_parse_ranges_invalid():
+    # Ignored, the whole file is sent
+    for header in ('items=0-9', 'bytes=9-0', 'bytes=abc', 'bytes=5', 'bytes=-x', 'bytes=1-2-3', 'bytes=--5', 'bytes=-',
+                   'bytes=+1-5', 'bytes=1_0-20'):
+        assert _parse_ranges(header, 1000) is None, header
+    assert _parse_ranges('bytes=' + ','.join(['0-1'] * 1000), 1000) is None
+
+
+def test_tar_stream(tmp_path):
+    sizes = {'a': 70000, 'b': 10, 'c': 0, 'd': BATCH_BLOCK_SIZE}
+    files = []
+    for name, size in sizes.items():
+        (tmp_path / name).write_bytes(name.encode() * size)
+        files.append((name, open(str(tmp_path / name), 'rb')))
+    try:
+        archive = b''.join(_tar_stream(files))
+    finally:
+        for _, f in files:
+            f.close()
+    assert len(archive) % TAR_RECORD_SIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        assert [(m.name, m.size) for m in tar.getmembers()] == list(sizes.items())
+        assert tar.extractfile('a').read() == b'a' * 70000
+
+
+def test_conditional_get(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        write_file('a.txt', 'hello')
+        code, headers, body = get('/a.txt')
+        assert code == 200 and body == b'hello'
+        etag, last_modified = headers['ETag'], headers['Last-Modified']
+        for conditions in ({'If-None-Match': etag}, {'If-None-Match': '"other", W/' + etag},
+                           {'If-None-Match': '*'}, {'If-Modified-Since': last_modified}):
+            code, headers, body = get('/a.txt', conditions)
+            assert code == 304 and body == b'', conditions
+            assert headers['ETag'] == etag and headers['Last-Modified'] == last_modified
+        # If-None-Match takes precedence over If-Modified-Since
+        assert get('/a.txt', {'If-None-Match': '"other"', 'If-Modified-Since': last_modified})[0] == 200
+        assert get('/a.txt', {'If-Modified-Since': formatdate(0, usegmt=True)})[0] == 200
+        assert get('/a.txt', {'If-Modified-Since': 'yesterday'})[0] == 200
+        # A new version of the file gets a new tag
+        write_file('a.txt', 'hello again')
+        code, headers, body = get('/a.txt', {'If-None-Match': etag})
+        assert code == 200 and body == b'hello again' and headers['ETag'] != etag
+    finally:
+        set_dir('.')
+
+
+def test_gzip_negotiation(tmp_path):
+    set_dir(str(tmp_path))
+    try:
+        text = 'compressible ' * 1000
+        write_file('a.txt', text)
+        code, headers, body = get('/a.txt', {'Accept-Encoding': 'deflate, gzip'})
+        assert code == 200 and headers['Content-Encoding'] == 'gzip' and headers['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(body) == text.encode() and int(headers['Content-Length']) == len(body)
+        gzip_etag = headers['ETag']
+        assert gzip_etag.endswith('-gzip"')
+        for accept in ('*;q=0.5', 'GZIP;q=1.0'):
+            assert get('/a.txt', {'Accept-Encoding': accept})[1].get('Content-Encoding') == 'gzip', accept
+        # Refused, or not offered
+        for accept in ('gzip;q=0', 'gzip;q=0, *', 'deflate', 'gzip;q=x', None):
+            code, headers, body = get('/a.txt', {'Accept-Encoding': accept} if accept else {})
+            assert 'Content-Encoding' not in headers and body == text.encode(), accept
+            assert headers['Vary'] == 'Accept-Encoding' and headers['ETag'] != gzip_etag
+        # Each variant is revalidated with its own tag
+        code, headers, _ = get('/a.txt', {'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+        assert code == 304 and headers['ETag'] == gzip_etag
+        # Ranges apply to the uncompressed file
+        code, headers, body = get('/a.txt', {'Accept-Encoding': 'gzip', 'Range': 'bytes=0-11'})
+        assert code == 206 and 'Content-Encoding' not in headers and body == b'compressible'
+
+        # Data which does not compress well is sent as is, and marked once in the variant cache
+        write_file('random.txt', os.urandom(4096))
+        misses = gzip_cache_stats()['misses']
+        for _ in range(2):
+            code, headers, body = get('/random.txt', {'Accept-Encoding': 'gzip'})
+            assert code == 200 and 'Content-Encoding' not in headers and len(body) == 4096
+        assert gzip_cache_stats()['misses'] == misses + 1
+        # Types which are already compressed are not negotiated
+        write_file('a.gz', gzip.compress(text.encode()))
+        code, headers, _ = get('/a.gz', {'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in headers and 'Vary' not in headers
+    finally:
+        set_dir('.')
@@ -0,0 +1,264 @@
+from http_server import ConnectionHandler, HTTPHandler, SocketReader, PreambleTooLarge, set_keep_alive, set_timeouts, \
+    timeouts_total
+from queue import Queue
+from threading import Thread
+import asyncio
+import re
+import async_server
+import socket
+import time
+
+
+class RecordingHandler(HTTPHandler):
+    """Answers each request with its body and records it"""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.request.preamble.url, b''))
+        self.server.send_response('ok')
+
+    def do_POST(self):
+        body = self.request.body.read()
+        self.requests.append((self.request.preamble.url, body))
+        self.server.send_response(body.decode())
+
+    def do_invalid_method(self):
+        self.server.send_error(501, 'Not Implemented')
+
+
+def receive_all(sock):
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def exchange(*segments, handler_class=RecordingHandler, half_close=True):
+    """Sends the segments to a ConnectionHandler over a socketpair, one send each, and returns all the
+    data received until the server closes the connection.
+    The client shuts its side down after the segments if half_close is set, otherwise it stays silent."""
+    RecordingHandler.requests = []
+    client, conn = socket.socketpair()
+    client.settimeout(5)
+    handler = Thread(target=ConnectionHandler(conn, 'localhost', ('test', 0), handler_class).run)
+    handler.start()
+    for segment in segments:
+        client.sendall(segment)
+    if half_close:
+        client.shutdown(socket.SHUT_WR)
+    data = receive_all(client)
+    handler.join()
+    client.close()
+    return data
+
+
+def async_exchange(*segments, half_close=True):
+    """Same as exchange, with the asyncio engine serving the connection"""
+    RecordingHandler.requests = []
+    loop = asyncio.new_event_loop()
+    engine = async_server.AsyncEngine(loop, RecordingHandler, 2, 2)
+    server = loop.run_until_complete(asyncio.start_server(engine.serve_connection, '127.0.0.1', 0))
+    thread = Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        client = socket.create_connection(server.sockets[0].getsockname()[:2], timeout=5)
+        for segment in segments:
+            client.sendall(segment)
+        if half_close:
+            client.shutdown(socket.SHUT_WR)
+        data = receive_all(client)
+        client.close()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        engine.executor.shutdown()
+        loop.close()
+    return data
+
+
+def status_lines(data: bytes):
+    """Status lines of the responses, a body without a line break runs into the next one"""
+    return re.findall(rb'HTTP/1\.[01] \d{3} [^\r\n]*', data)
+
+
+def test_transfer_encoding_rejected():
+    inner = b'POST /smuggled.txt HTTP/1.1\r\nContent-Length: 5\r\n\r\nowned'
+    body = b'%x\r\n' % len(inner) + inner + b'\r\n0\r\n\r\n'
+    request = b'POST /up.txt HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' + body
+    for send in (exchange, async_exchange):
+        assert status_lines(send(request)) == [b'HTTP/1.1 411 Length Required']
+        assert RecordingHandler.requests == []
+        both = b'POST /up.txt HTTP/1.1\r\nContent-Length: 3\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n'
+        assert status_lines(send(both)) == [b'HTTP/1.1 411 Length Required']
+
+
+def test_negative_content_length():
+    for send in (exchange, async_exchange):
+        for method in (b'GET', b'POST'):
+            data = send(method + b' /a.txt HTTP/1.1\r\nContent-Length: -5\r\n\r\nhello')
+            assert status_lines(data) == [b'HTTP/1.1 400 Bad Request']
+            assert RecordingHandler.requests == []
+
+
+def test_bare_lf_preamble():
+    for send in (exchange, async_exchange):
+        data = send(b'GET /a.txt HTTP/1.1\nConnection: close\n\n')
+        assert status_lines(data) == [b'HTTP/1.1 200 OK']
+        assert RecordingHandler.requests == [('/a.txt', b'')]
+        # An empty line with a CR after lines ending with a bare LF also ends the preamble
+        data = send(b'POST /b.txt HTTP/1.1\nContent-Length: 2\n\r\nhiGET /c.txt HTTP/1.1\r\n\r\n')
+        assert status_lines(data) == [b'HTTP/1.1 200 OK'] * 2
+        assert RecordingHandler.requests == [('/b.txt', b'hi'), ('/c.txt', b'')]
+
+
+def send_slowly(sock, segments):
+    for segment in segments:
+        sock.sendall(segment)
+        time.sleep(0.01)
+
+
+def test_preamble_split_across_reads():
+    client, conn = socket.socketpair()
+    # The terminator straddles the segments
+    segments = [b'GET /a HTTP/1.1\r\nHost: x\r', b'\n\r', b'\nPOST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\n', b'abc']
+    sender = Thread(target=send_slowly, args=(client, segments))
+    sender.start()
+    reader = SocketReader(conn)
+    assert reader.read_preamble() == b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+    assert reader.read_preamble() == b'POST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\n'
+    assert reader.read_body(3) == b'abc'
+    sender.join()
+    assert reader.recv_calls >= 3
+    client.close()
+    assert reader.read_preamble() is None
+    conn.close()
+
+
+def test_preamble_buffer_compaction():
+    client, conn = socket.socketpair()
+    reader = SocketReader(conn, buffer_size=64)
+    sender = Thread(target=send_slowly, args=(client, [b'GET /1 HTTP/1.1\r\nA: 12345678901234\r\n\r\nGET /2 HTTP/1.1\r\n',
+                                                       b'B: 1234567890123456789\r\n\r\n']))
+    sender.start()
+    assert reader.read_preamble() == b'GET /1 HTTP/1.1\r\nA: 12345678901234\r\n\r\n'
+    # The second preamble is moved to the front of the full buffer to receive its end
+    assert reader.read_preamble() == b'GET /2 HTTP/1.1\r\nB: 1234567890123456789\r\n\r\n'
+    sender.join()
+    client.sendall(b'GET /3 HTTP/1.1\r\n' + b'C: x\r\n' * 20)
+    try:
+        reader.read_preamble(max_size=48)
+        assert False, 'PreambleTooLarge not raised'
+    except PreambleTooLarge:
+        pass
+    client.close()
+    conn.close()
+
+
+def test_pipelining():
+    requests = (b'GET /1 HTTP/1.1\r\n\r\n'
+                b'POST /2 HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+                b'GET /3 HTTP/1.1\r\nConnection: close\r\n\r\n'
+                b'GET /4 HTTP/1.1\r\n\r\n')
+    for send in (exchange, async_exchange):
+        # One segment holding all the requests, then one byte per segment
+        for segments in ((requests,), [requests[i:i + 1] for i in range(len(requests))]):
+            data = send(*segments)
+            assert status_lines(data) == [b'HTTP/1.1 200 OK'] * 3
+            # The connection is closed after the request asking for it
+            assert RecordingHandler.requests == [('/1', b''), ('/2', b'hello'), ('/3', b'')]
+
+
+def test_idle_connection_released_to_queue():
+    connections = Queue()
+    client, conn = socket.socketpair()
+    client.settimeout(5)
+    handler = Thread(target=ConnectionHandler(conn, 'localhost', ('test', 0), RecordingHandler, connections).run)
+    handler.start()
+    client.sendall(b'GET /1 HTTP/1.1\r\n\r\n')
+    assert b'Connection: keep-alive' in client.recv(65536)
+    # A connection waits for a worker: the idle one is closed
+    started = time.monotonic()
+    connections.put(('waiting', None))
+    assert client.recv(65536) == b''
+    assert time.monotonic() - started < 2
+    handler.join()
+    client.close()
+
+
+def test_keep_alive_refused_while_queued():
+    connections = Queue()
+    connections.put(('waiting', None))
+    client, conn = socket.socketpair()
+    client.settimeout(5)
+    handler = Thread(target=ConnectionHandler(conn, 'localhost', ('test', 0), RecordingHandler, connections).run)
+    handler.start()
+    client.sendall(b'GET /1 HTTP/1.1\r\n\r\nGET /2 HTTP/1.1\r\n\r\n')
+    data = receive_all(client)
+    assert status_lines(data) == [b'HTTP/1.1 200 OK']
+    assert b'Connection: close' in data
+    handler.join()
+    client.close()
+
+
+def test_preamble_not_utf8():
+    for send in (exchange, async_exchange):
+        data = send(b'GET /a.txt HTTP/1.1\r\nX-Name: \xff\xfe\r\n\r\n')
+        assert status_lines(data) == [b'HTTP/1.1 400 Bad Request']
+        assert RecordingHandler.requests == []
+
+
+def test_timeouts():
+    set_timeouts(header_timeout=0.2, body_timeout=0.2, min_body_rate=0)
+    set_keep_alive(timeout=0.2)
+    try:
+        for send in (exchange, async_exchange):
+            counts = dict((phase, timeouts_total.values.get((phase,), 0)) for phase in ('idle', 'header', 'body'))
+            # Only part of the headers
+            data = send(b'GET /a HTTP/1.1\r\nHost: x', half_close=False)
+            assert status_lines(data) == [b'HTTP/1.1 408 Request Timeout']
+            # Only part of the body
+            data = send(b'POST /a HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc', half_close=False)
+            assert status_lines(data) == [b'HTTP/1.1 408 Request Timeout']
+            assert RecordingHandler.requests == []
+            # Nothing after a request: closed without a response
+            data = send(b'GET /a HTTP/1.1\r\n\r\n', half_close=False)
+            assert status_lines(data) == [b'HTTP/1.1 200 OK']
+            assert send(half_close=False) == b''
+            assert timeouts_total.values[('header',)] == counts['header'] + 1
+            assert timeouts_total.values[('body',)] == counts['body'] + 1
+            assert timeouts_total.values[('idle',)] == counts['idle'] + 2
+    finally:
+        set_timeouts()
+        set_keep_alive()
+
+
+def test_min_body_rate():
+    set_timeouts(header_timeout=1, body_timeout=0.2, min_body_rate=100)
+    try:
+        client, conn = socket.socketpair()
+        client.settimeout(5)
+        handler = Thread(target=ConnectionHandler(conn, 'localhost', ('test', 0), RecordingHandler).run)
+        handler.start()
+        client.sendall(b'POST /a HTTP/1.1\r\nContent-Length: 1000\r\n\r\n')
+        # Each byte arrives before the body timeout, the average rate is still too low
+        started = time.monotonic()
+        data = b''
+        while not data:
+            client.sendall(b'x')
+            time.sleep(0.05)
+            client.settimeout(0)
+            try:
+                data = client.recv(65536)
+            except BlockingIOError:
+                pass
+            client.settimeout(5)
+        assert status_lines(data) == [b'HTTP/1.1 408 Request Timeout']
+        assert time.monotonic() - started < 1
+        handler.join()
+        client.close()
+    finally:
+        set_timeouts()
@@ -0,0 +1,20 @@
+from logger import RotatingFile
+import os
+
+
+def test_rotation_shared_by_processes(tmp_path):
+    path = str(tmp_path / 'access.log')
+    # Two workers appending to the same path
+    first, second = RotatingFile(path, 10, 3), RotatingFile(path, 10, 3)
+    first.write('first 0123\n')
+    # The second worker still appends to the renamed file, it reopens the path without rotating again
+    second.write('second 0123\n')
+    first.write('a\n')
+    second.write('b\n')
+    first.flush()
+    second.flush()
+    assert sorted(os.listdir(str(tmp_path))) == ['access.log', 'access.log.1']
+    with open(path + '.1') as f:
+        assert f.read() == 'first 0123\nsecond 0123\n'
+    with open(path) as f:
+        assert f.read() == 'a\nb\n'
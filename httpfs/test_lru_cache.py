@@ -0,0 +1,19 @@
+from lru_cache import ENTRY_OVERHEAD, LRUCache
+
+
+def test_size_limit():
+    cache = LRUCache(4 * (ENTRY_OVERHEAD + 10))
+    for i in range(5):
+        cache.put(i, bytes(10), 'v')
+    assert len(cache) == 4 and cache.evictions == 1
+    assert cache.get(0, 'v') is None and cache.get(4, 'v') == bytes(10)
+    assert cache.get(4, 'other') is None and len(cache) == 3
+    assert cache.size == 3 * (ENTRY_OVERHEAD + 10)
+
+
+def test_empty_values_bounded():
+    cache = LRUCache(10 * ENTRY_OVERHEAD)
+    for i in range(1000):
+        cache.put(i, b'')
+    assert len(cache) == 10 and cache.size == cache.max_size
+    assert cache.get(999) == b''